@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Chintalagiri Shashank
+#
+# This file is part of pysamloader.
+
+# pysamloader is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pysamloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysamloader.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+End to end benchmarks against a simulated SAM-BA target.
+
+Connects, reads the chip ID and flash descriptors, and writes and
+verifies an image in each mode pysamloader supports, against the
+simulator in samba_sim.py. For each benchmark, the wall time, bytes and
+SAM-BA commands per second, and host CPU time per page are recorded.
+
+    $ python benchmarks/bench_flash.py -o results.json
+    $ python benchmarks/bench_flash.py --compare results.json
+
+Results are written as JSON, so that runs on different commits can be
+compared. With --compare, the run is checked against an earlier result
+file, and the exit status is 1 if any benchmark got slower by more
+than --threshold.
+
+The simulated link runs at --baud, with --page-busy and --erase-busy
+as the EFC busy times. Use --baud 0 to take the wire out of the
+picture and measure host side costs alone.
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from collections import OrderedDict
+
+from samba_sim import SimulatedTarget
+
+from pysamloader import __version__
+from pysamloader import log
+from pysamloader.samba import SamBAConnection
+from pysamloader.pysamloader import get_device
+from pysamloader.pysamloader import write
+from pysamloader.pysamloader import verify
+from pysamloader.pysamloader import read_chipid
+from pysamloader.pysamloader import read_flash_descriptors
+
+
+if sys.version_info >= (3, 3):
+    _cpu_time = time.process_time
+else:
+    _cpu_time = time.clock
+
+
+def _make_image(path, size, page_size):
+    """
+    Write a reproducible test image of size bytes to path. Every fourth
+    page is left erased, so that skipping erased pages has something to
+    skip.
+    """
+    rng = random.Random(0)
+    data = bytearray(rng.getrandbits(8) for _ in range(size))
+    for offset in range(0, size, 4 * page_size):
+        data[offset:offset + page_size] = b'\xff' * page_size
+    with open(path, 'wb') as f:
+        f.write(data)
+    return bytes(data)
+
+
+def _write(**kwargs):
+    def _run(samba, device, image):
+        write(samba, device, image, **kwargs)
+    return _run
+
+
+def _verify(**kwargs):
+    def _run(samba, device, image):
+        errors = verify(samba, device, image, **kwargs)
+        if errors:
+            raise RuntimeError("Verification failed with {0} errors"
+                               "".format(errors))
+    return _run
+
+
+# Benchmark name -> (function, whether it moves the image, whether the
+# image has to be in flash beforehand)
+BENCHMARKS = OrderedDict([
+    ('connect', (None, False, False)),
+    ('read_chipid',
+     (lambda samba, device, image: read_chipid(samba=samba), False, False)),
+    ('read_flash_descriptors',
+     (lambda samba, device, image: read_flash_descriptors(samba=samba),
+      False, False)),
+    ('write_raw', (_write(), True, False)),
+    ('write_raw_skip_erased', (_write(skip_erased=True), True, False)),
+    ('write_xmodem', (_write(xmodem=True), True, False)),
+    ('write_applet', (_write(applet=True), True, False)),
+    ('write_applet_xmodem', (_write(applet=True, xmodem=True), True, False)),
+    ('verify_bulk', (_verify(), True, True)),
+    ('verify_word', (_verify(bulk=False), True, True)),
+    ('verify_crc', (_verify(crc=True), True, True)),
+])
+
+
+def _connect(target, device, args):
+    return SamBAConnection(target.port, device=device,
+                           terminal=args.terminal,
+                           link_baud=args.link_baud)
+
+
+def _run_once(name, target, device, image, data, args):
+    function, moves_image, preload = BENCHMARKS[name]
+    target.reset()
+    if preload:
+        target.load(int(device.FS_ADDRESS, 16), data)
+    samba = None
+    try:
+        if function is None:
+            start_stats = target.stats()
+            start, cpu = time.time(), _cpu_time()
+            samba = _connect(target, device, args)
+        else:
+            samba = _connect(target, device, args)
+            start_stats = target.stats()
+            start, cpu = time.time(), _cpu_time()
+            function(samba, device, image)
+        elapsed, cpu = time.time() - start, _cpu_time() - cpu
+    finally:
+        if samba is not None:
+            samba.close()
+    stats = target.stats()
+    commands = sum(stats['commands'].values()) - \
+        sum(start_stats['commands'].values())
+    nbytes = len(data) if moves_image else 0
+    pages = len(data) // device.PAGE_SIZE if moves_image else 0
+    return OrderedDict([
+        ('seconds', elapsed),
+        ('bytes', nbytes),
+        ('bytes_per_s', nbytes / elapsed),
+        ('commands', commands),
+        ('commands_per_s', commands / elapsed),
+        ('cpu_seconds', cpu),
+        ('cpu_ms_per_page', 1000.0 * cpu / pages if pages else None),
+        ('wire_bytes', stats['rx_bytes'] + stats['tx_bytes'] -
+         start_stats['rx_bytes'] - start_stats['tx_bytes']),
+        ('efc_polls', stats['efc_polls'] - start_stats['efc_polls']),
+    ])
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def run(args):
+    device = get_device('ATSAM3U4E')
+    fd, image = tempfile.mkstemp(suffix='.bin')
+    os.close(fd)
+    target = SimulatedTarget(baud=args.baud, page_busy=args.page_busy,
+                             erase_busy=args.erase_busy,
+                             applet_byte_time=args.applet_byte_time)
+    results = OrderedDict()
+    try:
+        data = _make_image(image, args.size, device.PAGE_SIZE)
+        for name in args.only or BENCHMARKS:
+            runs = [_run_once(name, target, device, image, data, args)
+                    for _ in range(args.repeat)]
+            # The run with the median time is reported as a whole, so the
+            # numbers in each result belong together.
+            result = _median_run(runs)
+            results[name] = result
+            print("{0:<24} {1:8.3f} s {2:>10} B/s {3:>9} cmd/s {4}"
+                  "".format(name, result['seconds'],
+                            _fmt(result['bytes_per_s']),
+                            _fmt(result['commands_per_s']),
+                            _fmt_cpu(result['cpu_ms_per_page'])))
+    finally:
+        target.close()
+        os.unlink(image)
+    return results
+
+
+def _median_run(runs):
+    seconds = _median([r['seconds'] for r in runs])
+    return next(r for r in runs if r['seconds'] == seconds)
+
+
+def _fmt(value):
+    return '{0:.0f}'.format(value) if value else '-'
+
+
+def _fmt_cpu(value):
+    return '{0:.3f} ms CPU/page'.format(value) if value is not None else ''
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(base, current, threshold):
+    """
+    Print the change in time of each benchmark in current against base.
+    Returns the names of benchmarks which got slower by more than
+    threshold.
+    """
+    if base['config'] != current['config']:
+        print("Warning : the runs being compared used different settings")
+    print("{0:<24} {1:>10} {2:>10} {3:>8}".format('', 'base', 'current',
+                                                  'change'))
+    regressions = []
+    for name, result in current['results'].items():
+        if name not in base['results']:
+            continue
+        old, new = base['results'][name]['seconds'], result['seconds']
+        change = new / old - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print("{0:<24} {1:9.3f}s {2:9.3f}s {3:+7.1f}%{4}"
+              "".format(name, old, new, 100 * change, flag))
+    return regressions
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description="End to end benchmarks against a simulated SAM-BA "
+                    "target")
+    parser.add_argument('-o', '--output', metavar='file',
+                        help="Write the results to this JSON file")
+    parser.add_argument('--compare', metavar='file',
+                        help="Compare against the results in this JSON "
+                             "file")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Relative slowdown reported as a regression "
+                             "by --compare. Default 0.1")
+    parser.add_argument('--only', metavar='name', action='append',
+                        choices=list(BENCHMARKS),
+                        help="Run only this benchmark. May be given more "
+                             "than once.")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Runs of each benchmark. The median is "
+                             "reported. Default 3")
+    parser.add_argument('--size', type=int, default=16384,
+                        help="Size of the test image in bytes. "
+                             "Default 16384")
+    parser.add_argument('--baud', type=int, default=115200,
+                        help="Baud rate of the simulated link, or 0 for "
+                             "no pacing. Default 115200")
+    parser.add_argument('--link-baud', type=int,
+                        help="Baud rate to switch the link to once "
+                             "connected")
+    parser.add_argument('--terminal', action='store_true',
+                        help="Keep SAM-BA in terminal mode")
+    parser.add_argument('--page-busy', type=float, default=0.0023,
+                        help="EFC busy time for a page write, in seconds. "
+                             "Default 0.0023")
+    parser.add_argument('--erase-busy', type=float, default=0.05,
+                        help="EFC busy time for a full erase, in seconds. "
+                             "Default 0.05")
+    parser.add_argument('--applet-byte-time', type=float, default=1e-6,
+                        help="Time the CRC32 applet takes per byte, in "
+                             "seconds. Default 1e-6")
+    return parser
+
+
+def main():
+    args = _get_parser().parse_args()
+    log.set_level(logging.WARNING)
+    results = run(args)
+    report = OrderedDict([
+        ('pysamloader', __version__),
+        ('commit', _git_commit()),
+        ('python', platform.python_version()),
+        ('timestamp', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('config', OrderedDict([
+            ('size', args.size),
+            ('baud', args.baud),
+            ('link_baud', args.link_baud),
+            ('terminal', args.terminal),
+            ('page_busy', args.page_busy),
+            ('erase_busy', args.erase_busy),
+            ('applet_byte_time', args.applet_byte_time),
+        ])),
+        ('results', results),
+    ])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+        if compare(base, report, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Chintalagiri Shashank
+#
+# This file is part of pysamloader.
+
+# pysamloader is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pysamloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysamloader.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Microbenchmark for SAM-BA response parsing over a pyserial loopback port.
+
+Compares the byte-at-a-time response reader pysamloader used to have
+against the buffered reader in SamBAConnection. Each iteration writes a
+read_word style response into a ``loop://`` port and reads it back, as
+happens once per command on a real connection.
+
+    $ python benchmarks/bench_response.py [responses]
+
+"""
+
+from __future__ import print_function
+
+import sys
+import timeit
+
+from serial import serial_for_url
+
+from pysamloader.samba import SamBAConnection
+from pysamloader.samba import SamBAResponseBuffer
+
+
+RESPONSE = b'\n\r0x12345678\n\r>'
+
+
+def _legacy_retrieve_response(ser):
+    char = ''
+    data = ''
+    while char != '>':
+        data += char
+        char = ser.read(1).decode()
+    return data
+
+
+def _loopback_connection():
+    conn = SamBAConnection.__new__(SamBAConnection)
+    conn.ser = serial_for_url('loop://', baudrate=115200, timeout=1)
+    conn._rx = SamBAResponseBuffer()
+    conn.terminal = True
+    conn._tx_done = 0
+    return conn
+
+
+def _bench(read_one, conn, count):
+    def _run():
+        for _ in range(count):
+            conn.ser.write(RESPONSE)
+            read_one()
+
+    return timeit.timeit(_run, number=1)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    conn = _loopback_connection()
+
+    legacy = _bench(lambda: _legacy_retrieve_response(conn.ser), conn, count)
+    buffered = _bench(conn.retrieve_response, conn, count)
+
+    print("{0} responses of {1} bytes".format(count, len(RESPONSE)))
+    print("  legacy   : {0:8.3f} s  {1:10.1f} responses/s"
+          "".format(legacy, count / legacy))
+    print("  buffered : {0:8.3f} s  {1:10.1f} responses/s"
+          "".format(buffered, count / buffered))
+    print("  speedup  : {0:8.2f}x".format(legacy / buffered))
+
+
+if __name__ == '__main__':
+    main()
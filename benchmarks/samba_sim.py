@@ -0,0 +1,510 @@
+# Copyright (c) 2019 Chintalagiri Shashank
+#
+# This file is part of pysamloader.
+
+# pysamloader is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pysamloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysamloader.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Simulated SAM-BA target, served on a pty pair, for the benchmarks.
+
+The simulator models an ATSAM3U4E running the SAM-BA monitor closely
+enough for pysamloader to connect, read the chip ID, flash descriptors
+and unique identifier, and write and verify flash in every mode :
+
+  * terminal and binary (N#) modes, and the O, H, W, o, h, w, S, R, G,
+    V, N and T commands
+  * two EEFC planes, where data written to flash goes into the latch
+    and is programmed by a page write command, with configurable busy
+    times for page writes and erases
+  * the flash writer and CRC32 applets, which are recognised in SRAM
+    when G is called on them and are run natively
+
+Bytes are paced at the baud rate the UART is set to, in both
+directions, so that transfers take about as long as they would on the
+wire. Writing the UART baud rate generator changes the pace, as it
+would on the real part.
+
+The target runs in a separate process, so that the host CPU time
+measured by the benchmarks is not inflated by the simulator :
+
+    target = SimulatedTarget(baud=115200, page_busy=0.002)
+    samba = SamBAConnection(target.port, device=ATSAM3U4E)
+    ...
+    print(target.stats())
+    target.close()
+
+"""
+
+import os
+import pty
+import tty
+import time
+import zlib
+import struct
+import select
+import threading
+import multiprocessing
+from io import BytesIO
+from collections import Counter
+
+from xmodem import XMODEM
+
+from pysamloader.applet import FlashWriterApplet
+from pysamloader.applet import CRC32Applet
+
+
+CHIPID_CIDR = 0x400E0740
+CHIPID_EXID = 0x400E0744
+UART_BRGR = 0x400E0620
+
+MCK = 48000000
+VERSION = b'v1.1 Dec 15 2010 19:25:04'
+
+
+class _Port(object):
+    """ Master side of the pty, paced at the UART baud rate """
+    def __init__(self, fd, target):
+        self.fd = fd
+        self._target = target
+        self._pending = bytearray()
+        self._rx_clock = 0
+        self._tx_clock = 0
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+
+    def _byte_time(self):
+        return 10.0 / self._target.baud if self._target.baud else 0
+
+    def _fill(self, timeout):
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        if not r:
+            return True
+        try:
+            data = os.read(self.fd, 4096)
+        except OSError:
+            return False
+        if not data:
+            return False
+        # Bytes are not available until they have crossed the wire.
+        now = time.time()
+        self._rx_clock = max(self._rx_clock, now) + \
+            len(data) * self._byte_time()
+        _sleep_until(self._rx_clock)
+        self.rx_bytes += len(data)
+        self._pending += data
+        return True
+
+    def read(self, size, timeout=1.0):
+        """ Read upto size bytes. Returns None once the host hangs up. """
+        deadline = time.time() + timeout
+        while len(self._pending) < size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if not self._fill(remaining):
+                return None
+        data = bytes(self._pending[:size])
+        del self._pending[:size]
+        return data
+
+    def write(self, data):
+        self._tx_clock = max(self._tx_clock, time.time()) + \
+            len(data) * self._byte_time()
+        _sleep_until(self._tx_clock)
+        self.tx_bytes += len(data)
+        view = memoryview(bytes(data))
+        while view:
+            view = view[os.write(self.fd, view):]
+
+
+def _sleep_until(t):
+    delay = t - time.time()
+    if delay > 0:
+        time.sleep(delay)
+
+
+class _EEFC(object):
+    """ One Enhanced Embedded Flash Controller and its flash plane """
+    PAGE_SIZE = 256
+    LOCK_REGION_SIZE = 8192
+
+    def __init__(self, target, base, flash_base, size):
+        self._target = target
+        self.base = base
+        self.flash_base = flash_base
+        self.size = size
+        self.flash = bytearray(b'\xff' * size)
+        self._latch = bytearray(b'\xff' * self.PAGE_SIZE)
+        self._busy_until = 0
+        self._errors = 0
+        self._frr = []
+        self._uid_mode = False
+        self.fmr = 0
+        self.gpnvm = 0
+        self.uid = bytes(bytearray(range(16)))
+        self.polls = 0
+
+    def owns(self, address):
+        return self.flash_base <= address < self.flash_base + self.size
+
+    @property
+    def ready(self):
+        return not self._uid_mode and time.time() >= self._busy_until
+
+    def wait(self):
+        """ Wait for the controller to be ready, as an applet would """
+        _sleep_until(self._busy_until)
+
+    def read_reg(self, offset):
+        if offset == 0x0:
+            return self.fmr
+        elif offset == 0x8:
+            fsr = self._errors | (1 if self.ready else 0)
+            self._errors = 0
+            return fsr
+        elif offset == 0xC:
+            return self._frr.pop(0) if self._frr else 0
+        return 0
+
+    def write_reg(self, offset, value):
+        if offset == 0x0:
+            self.fmr = value
+        elif offset == 0x4:
+            self.command(value)
+
+    def command(self, value):
+        if value >> 24 != 0x5A:
+            self._errors |= 0x02
+            return
+        cmd = value & 0xFF
+        arg = (value >> 8) & 0xFFFF
+        if cmd == 0x00:
+            nlocks = self.size // self.LOCK_REGION_SIZE
+            self._frr = [0x00000000, self.size, self.PAGE_SIZE, 1, self.size,
+                         nlocks] + [self.LOCK_REGION_SIZE] * nlocks
+        elif cmd in (0x01, 0x03):
+            start = arg * self.PAGE_SIZE
+            if start >= self.size:
+                self._errors |= 0x02
+                return
+            page = self.flash[start:start + self.PAGE_SIZE]
+            if cmd == 0x01:
+                self._latch = bytearray(a & b for a, b in
+                                        zip(page, self._latch))
+            self.flash[start:start + self.PAGE_SIZE] = self._latch
+            self._latch = bytearray(b'\xff' * self.PAGE_SIZE)
+            self._busy_until = time.time() + self._target.page_busy
+        elif cmd == 0x05:
+            self.flash[:] = b'\xff' * self.size
+            self._busy_until = time.time() + self._target.erase_busy
+        elif cmd == 0x0B:
+            self.gpnvm |= 1 << arg
+        elif cmd == 0x0C:
+            self.gpnvm &= ~(1 << arg)
+        elif cmd == 0x0D:
+            self._frr = [self.gpnvm]
+        elif cmd == 0x0E:
+            self._uid_mode = True
+        elif cmd == 0x0F:
+            self._uid_mode = False
+        else:
+            self._errors |= 0x02
+
+    def read_flash(self, address, size):
+        offset = address - self.flash_base
+        if self._uid_mode:
+            return bytes(bytearray(self.uid[(offset + i) % 16]
+                                   for i in range(size)))
+        return bytes(self.flash[offset:offset + size])
+
+    def write_flash(self, address, data):
+        offset = (address - self.flash_base) % self.PAGE_SIZE
+        self._latch[offset:offset + len(data)] = data
+
+
+class SimulatedSAM3U(object):
+    """
+    The simulated ATSAM3U4E and its SAM-BA monitor. serve() runs the
+    monitor on a pty master file descriptor.
+    """
+    CIDR = 0x28100960
+
+    def __init__(self, baud=115200, page_busy=0.0, erase_busy=0.0,
+                 applet_byte_time=0.0):
+        self.initial_baud = baud
+        self.page_busy = page_busy
+        self.erase_busy = erase_busy
+        self.applet_byte_time = applet_byte_time
+        self.efcs = [_EEFC(self, 0x400E0800, 0x00080000, 0x20000),
+                     _EEFC(self, 0x400E0A00, 0x00100000, 0x20000)]
+        self.sram = [(0x20000000, bytearray(0x8000)),
+                     (0x20080000, bytearray(0x4000))]
+        self.port = None
+        self.reset()
+
+    def reset(self):
+        """ Power cycle the target, erasing its flash """
+        self.terminal = True
+        self.baud = self.initial_baud
+        self.regs = {CHIPID_CIDR: self.CIDR, CHIPID_EXID: 0,
+                     UART_BRGR: int(round(MCK / (16.0 * 115200)))}
+        if self.baud:
+            self.regs[UART_BRGR] = int(round(MCK / (16.0 * self.baud)))
+        for efc in self.efcs:
+            efc.__init__(self, efc.base, efc.flash_base, efc.size)
+        for _, mem in self.sram:
+            mem[:] = bytearray(len(mem))
+        self.commands = Counter()
+        if self.port:
+            self.port.rx_bytes = 0
+            self.port.tx_bytes = 0
+
+    def stats(self):
+        return {'commands': dict(self.commands),
+                'rx_bytes': self.port.rx_bytes if self.port else 0,
+                'tx_bytes': self.port.tx_bytes if self.port else 0,
+                'efc_polls': sum(efc.polls for efc in self.efcs)}
+
+    def load(self, address, data):
+        """ Place data directly in flash at address """
+        for efc in self.efcs:
+            if efc.owns(address):
+                offset = address - efc.flash_base
+                efc.flash[offset:offset + len(data)] = data
+                return
+
+    # Memory map
+    def _region(self, address):
+        for efc in self.efcs:
+            if efc.base <= address < efc.base + 0x10:
+                return 'efc', efc
+            if efc.owns(address):
+                return 'flash', efc
+        for base, mem in self.sram:
+            if base <= address < base + len(mem):
+                return 'sram', (base, mem)
+        return 'reg', None
+
+    def read(self, address, size):
+        kind, region = self._region(address)
+        if kind == 'efc':
+            if address - region.base == 0x8:
+                region.polls += 1
+            value = region.read_reg(address - region.base)
+            return struct.pack('<I', value)[:size]
+        elif kind == 'flash':
+            return region.read_flash(address, size)
+        elif kind == 'sram':
+            base, mem = region
+            return bytes(mem[address - base:address - base + size])
+        aligned = address & ~3
+        value = struct.pack('<I', self.regs.get(aligned, 0))
+        return value[address - aligned:address - aligned + size]
+
+    def write(self, address, data):
+        kind, region = self._region(address)
+        if kind == 'efc':
+            region.write_reg(address - region.base,
+                             struct.unpack('<I', data.ljust(4, b'\0'))[0])
+        elif kind == 'flash':
+            region.write_flash(address, data)
+        elif kind == 'sram':
+            base, mem = region
+            mem[address - base:address - base + len(data)] = data
+        else:
+            value = struct.unpack('<I', data.ljust(4, b'\0'))[0]
+            self.regs[address & ~3] = value
+            if address & ~3 == UART_BRGR and value and self.initial_baud:
+                self.baud = MCK / (16.0 * value)
+
+    # Monitor
+    def serve(self, fd):
+        self.port = _Port(fd, self)
+        command, number, address = None, 0, 0
+        while True:
+            c = self.port.read(1, timeout=0.5)
+            if c is None:
+                return
+            if not c:
+                continue
+            c = c.decode('latin-1')
+            if c == '#':
+                self.commands[command or '#'] += 1
+                self.execute(command, address, number)
+                command, number, address = None, 0, 0
+            elif c in '0123456789abcdefABCDEF' and command:
+                number = ((number << 4) | int(c, 16)) & 0xFFFFFFFF
+            elif c == ',':
+                address, number = number, 0
+            elif c not in '\x80\r\n ':
+                command, number = c, 0
+
+    def _put_value(self, data):
+        if self.terminal:
+            value = struct.unpack('<I', data.ljust(4, b'\0'))[0]
+            self.port.write('0x{0:0{1}x}\n\r'.format(value, 2 * len(data))
+                            .encode())
+        else:
+            self.port.write(data)
+
+    def execute(self, command, address, number):
+        if self.terminal:
+            self.port.write(b'\n\r')
+        if command == 'O':
+            self.write(address, struct.pack('<B', number & 0xFF))
+        elif command == 'H':
+            self.write(address, struct.pack('<H', number & 0xFFFF))
+        elif command == 'W':
+            self.write(address, struct.pack('<I', number))
+        elif command == 'o':
+            self._put_value(self.read(address, 1))
+        elif command == 'h':
+            self._put_value(self.read(address, 2))
+        elif command == 'w':
+            self._put_value(self.read(address, 4))
+        elif command == 'V':
+            self.port.write(VERSION + b'\n\r')
+        elif command == 'N':
+            self.terminal = False
+        elif command == 'T':
+            self.terminal = True
+            self.port.write(b'\n\r')
+        elif command == 'S':
+            self._receive_file(address, number)
+        elif command == 'R':
+            self._send_file(address, number)
+        elif command == 'G':
+            self._go(number)
+        if self.terminal:
+            self.port.write(b'>')
+
+    def _getc(self, size, timeout=1):
+        return self.port.read(size, timeout=timeout) or None
+
+    def _putc(self, data, timeout=1):
+        self.port.write(data)
+        return len(data)
+
+    def _receive_file(self, address, size):
+        buf = BytesIO()
+        XMODEM(self._getc, self._putc).recv(buf, crc_mode=1, quiet=True,
+                                            retry=4, timeout=2, delay=0.01)
+        data = buf.getvalue()
+        if size:
+            data = data[:size]
+        for i in range(0, len(data), 4):
+            self.write(address + i, data[i:i + 4])
+
+    def _send_file(self, address, size):
+        data = b''.join(self.read(address + i, min(4, size - i))
+                        for i in range(0, size, 4))
+        XMODEM(self._getc, self._putc).send(BytesIO(data), quiet=True,
+                                            retry=4, timeout=2)
+
+    # Applets
+    def _go(self, address):
+        for applet, run in ((FlashWriterApplet, self._run_flash_writer),
+                            (CRC32Applet, self._run_crc32)):
+            code = applet.CODE[applet.ENTRY_OFFSET:]
+            start = address + applet.ENTRY_OFFSET
+            if self.read(start, len(code)) == code:
+                run(address + applet.MAILBOX_OFFSET)
+                return
+
+    def _words(self, address, count):
+        return struct.unpack('<{0}I'.format(count),
+                             self.read(address, 4 * count))
+
+    def _run_flash_writer(self, mailbox):
+        nxt, buf0, buf1, efc_base, page_size, status = \
+            self._words(mailbox, 6)
+        efc = self._region(efc_base)[1]
+        buf = (buf0, buf1)[nxt]
+        fcr, page_address, count = self._words(buf, 3)
+        data = self.read(buf + 12, count * page_size)
+        for i in range(count):
+            efc.wait()
+            status |= efc.read_reg(0x8)
+            page = data[i * page_size:(i + 1) * page_size]
+            for offset in range(0, page_size, 4):
+                self.write(page_address + i * page_size + offset,
+                           page[offset:offset + 4])
+            efc.command(fcr + (i << 8))
+        self.write(mailbox, struct.pack('<I', nxt ^ 1))
+        self.write(mailbox + 20, struct.pack('<I', status))
+
+    def _run_crc32(self, mailbox):
+        address, length = self._words(mailbox, 2)
+        time.sleep(length * self.applet_byte_time)
+        crc = zlib.crc32(self.read(address, length)) & 0xFFFFFFFF
+        self.write(mailbox + 8, struct.pack('<I', crc))
+
+
+def _target_main(pipe, config):
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    target = SimulatedSAM3U(**config)
+    thread = threading.Thread(target=target.serve, args=(master,))
+    thread.daemon = True
+    thread.start()
+    pipe.send(os.ttyname(slave))
+    while True:
+        request = pipe.recv()
+        action, args = request[0], request[1:]
+        if action == 'close':
+            break
+        elif action == 'reset':
+            target.reset()
+            pipe.send(None)
+        elif action == 'load':
+            target.load(*args)
+            pipe.send(None)
+        elif action == 'stats':
+            pipe.send(target.stats())
+    os.close(slave)
+    os.close(master)
+
+
+class SimulatedTarget(object):
+    """
+    A SimulatedSAM3U running in a child process. Connect to it on port.
+    The keyword arguments are those of SimulatedSAM3U. A baud of 0
+    turns off pacing altogether.
+    """
+    def __init__(self, **config):
+        self._pipe, child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_target_main,
+                                                args=(child, config))
+        self._process.daemon = True
+        self._process.start()
+        child.close()
+        self.port = self._pipe.recv()
+
+    def _request(self, *request):
+        self._pipe.send(request)
+        return self._pipe.recv()
+
+    def reset(self):
+        return self._request('reset')
+
+    def load(self, address, data):
+        return self._request('load', address, bytes(data))
+
+    def stats(self):
+        return self._request('stats')
+
+    def close(self):
+        self._pipe.send(('close',))
+        self._process.join()
@@ -3,6 +3,7 @@
 import os
 import platform
 import PyInstaller.config
+from PyInstaller.utils.hooks import collect_submodules
 
 # Configure paths
 target = 'binary-{0}'.format(platform.system().lower())
@@ -24,7 +25,7 @@ a = Analysis(['run.py'],
              pathex=[os.path.split(SPECPATH)[0]],
              binaries=[],
              datas=[],
-             hiddenimports=[],
+             hiddenimports=collect_submodules('pysamloader.devices'),
              hookspath=[],
              runtime_hooks=[],
              excludes=[],
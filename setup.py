@@ -58,7 +58,8 @@ publish_requires = build_requires + ['twine', 'pygithub']
 
 setup(
     name="pysamloader",
-    use_scm_version={"root": ".", "relative_to": __file__},
+    use_scm_version={"root": ".", "relative_to": __file__,
+                     "write_to": "src/pysamloader/_version.py"},
     author="Chintalagiri Shashank",
     author_email="shashank@chintal.in",
     description="python library for writing flash on "
@@ -1,6 +1,26 @@
 
+
+import sys
+
 try:
     from ._version import __version__
 except ImportError:
-    from pkg_resources import get_distribution
-    __version__ = get_distribution('pysamloader').version
+    # Without a _version module written at install time, the version
+    # comes from the distribution metadata, which is slow to load. It is
+    # looked up only when asked for, where the interpreter allows.
+    def _get_version():
+        try:
+            from importlib.metadata import version
+        except ImportError:
+            from pkg_resources import get_distribution
+            return get_distribution('pysamloader').version
+        return version('pysamloader')
+
+    if sys.version_info >= (3, 7):
+        def __getattr__(name):
+            if name == '__version__':
+                return _get_version()
+            raise AttributeError("module {0!r} has no attribute {1!r}"
+                                 "".format(__name__, name))
+    else:
+        __version__ = _get_version()
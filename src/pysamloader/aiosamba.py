@@ -0,0 +1,486 @@
+# Copyright (c) 2019 Chintalagiri Shashank
+#
+# This file is part of pysamloader.
+
+# pysamloader is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pysamloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysamloader.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+asyncio counterpart to :class:`pysamloader.samba.SamBAConnection`.
+
+The transport's file descriptor is registered with the event loop, so a
+single thread can drive SAM-BA sessions on many ports at once. Local
+serial ports and socket:// transports are read this way. Transports
+without one, such as rfc2217://, are read in an executor thread instead.
+This module requires Python 3.5 or newer. Serial ports cannot be
+registered with the Windows proactor loop.
+
+    async with AsyncSamBAConnection('/dev/ttyUSB1', device=ATSAM3U4E) as s:
+        await s.write('app.bin')
+        errors = await s.verify('app.bin')
+
+The connection to SAM-BA is made exactly as SamBAConnection makes it,
+in an executor thread, and the monitor is then left in terminal mode.
+The flash is erased as planned by the erase module, as it is by write().
+
+Commands on one connection are serialized. If a coroutine is cancelled
+while its commands are in flight, any partially written command is still
+written out completely, and the responses to outstanding commands are
+drained before the next command is sent. The connection is thus always
+left in a known state.
+"""
+
+import os
+import asyncio
+import logging
+from io import BytesIO
+from functools import partial
+from binascii import hexlify
+
+from serial import SerialException
+
+from .samdevice import SAMDevice
+from .samba import SamBAConnection
+from .samba import SamBAConnectionError
+from .samba import SamBAResponseBuffer
+from .transport import transport_fd
+from .image import load_image
+from .erase import EraseSequence
+from .pysamloader import _page_time
+from .pysamloader import _interleave
+from .pysamloader import _plane_page_number
+from . import log
+
+logger = logging.getLogger('aiosamba')
+log.loggers.append(logger)
+
+
+def _adrstr(address):
+    return hex(address)[2:].zfill(8)
+
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except AttributeError:
+        # Python < 3.7, where this is the running loop inside a coroutine
+        return asyncio.get_event_loop()
+
+
+class AsyncSamBAConnection(object):
+
+    PIPELINE_WINDOW = SamBAConnection.PIPELINE_WINDOW
+    RESPONSE_LATENCY = SamBAConnection.RESPONSE_LATENCY
+
+    # Interval between EFC status polls, in seconds
+    EFC_POLL_INTERVAL = 0.01
+
+    # Timeout of each read of a transport which is read in an executor
+    # thread, in seconds. Closing the connection waits at most this long.
+    POLL_TIMEOUT = 0.05
+
+    def __init__(self, port='/dev/ttyUSB1', baud=115200, device=None,
+                 window=None, slow_connect=False, link_baud=None,
+                 loop=None):
+        """
+        port, baud, device, window, slow_connect and link_baud are as
+        for SamBAConnection. The connection uses loop if given, and
+        otherwise the loop it is connected from.
+        """
+        self._port = port
+        self._baud = baud
+        self._slow_connect = slow_connect
+        self._link_baud = link_baud
+        self.device = device
+        if not device:
+            self._device = SAMDevice()
+        else:
+            self._device = device()
+        self._fill = bytes([self._device.ERASED_VALUE])
+        self.window = self.PIPELINE_WINDOW if window is None else window
+        # The loop and the lock are bound in connect(), so that the
+        # connection can be made before the loop runs.
+        self._loop = loop
+        self._lock = None
+        self._rx = SamBAResponseBuffer()
+        self._data_waiter = None
+        self._lost = None
+        self._write_task = None
+        self._reader = None
+        self._outstanding = 0
+        self._fd = None
+        self.ser = None
+        self.version = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def response_timeout(self, nbytes=64):
+        """ Time to wait for a response of upto nbytes at the current baud """
+        baud = self.ser.baudrate if self.ser is not None else self._baud
+        return self.RESPONSE_LATENCY + (nbytes * 10.0) / baud
+
+    async def connect(self):
+        """
+        Open the port and connect to SAM-BA, as SamBAConnection does,
+        draining anything the monitor sends first and probing for its
+        prompt. SamBAConnectionError is raised if it cannot be found.
+        """
+        if self._loop is None:
+            self._loop = _running_loop()
+        self._lock = asyncio.Lock()
+        samba = await self._loop.run_in_executor(None, partial(
+            SamBAConnection, self._port, self._baud, self.device,
+            slow_connect=self._slow_connect, terminal=True,
+            link_baud=self._link_baud
+        ))
+        self.ser = samba.ser
+        self.version = samba.version
+        self._fd = transport_fd(self.ser)
+        if self._fd is not None:
+            self.ser.timeout = 0
+            self._loop.add_reader(self._fd, self._on_readable)
+        else:
+            self.ser.timeout = self.POLL_TIMEOUT
+            self._reader = self._loop.create_task(self._poll())
+        return self
+
+    def close(self):
+        if self.ser is None:
+            return
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+        else:
+            self._reader.cancel()
+        self.ser.close()
+        self.ser = None
+
+    # Transport
+
+    def _received(self, data):
+        self._rx.feed(data)
+        if self._data_waiter is not None and not self._data_waiter.done():
+            self._data_waiter.set_result(None)
+
+    def _connection_lost(self, reason):
+        """
+        The transport can no longer be read. Commands waiting for a
+        response, and any sent later, fail at once instead of timing out.
+        """
+        self._lost = SamBAConnectionError(
+            "Lost the connection to SAM-BA on {0} : {1}"
+            "".format(self._port, reason))
+        logger.error(self._lost.msg)
+        if self._data_waiter is not None and not self._data_waiter.done():
+            self._data_waiter.set_exception(self._lost)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            data, reason = b'', e
+        else:
+            reason = "the port was closed at the far end"
+        if not data:
+            # The reader would otherwise be called again at once, forever
+            self._loop.remove_reader(self._fd)
+            self._connection_lost(reason)
+            return
+        self._received(data)
+
+    def _read_waiting(self):
+        return self.ser.read(max(self.ser.in_waiting, 1))
+
+    async def _poll(self):
+        """ Read a transport without a file descriptor, in a thread """
+        while True:
+            try:
+                data = await self._loop.run_in_executor(None,
+                                                        self._read_waiting)
+            except (SerialException, EnvironmentError) as e:
+                self._connection_lost(e)
+                return
+            if data:
+                self._received(data)
+
+    async def _write(self, data):
+        if self._fd is None:
+            await self._loop.run_in_executor(None, self.ser.write, data)
+            return
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self._fd, view):]
+            except (BlockingIOError, InterruptedError):
+                writable = self._loop.create_future()
+                self._loop.add_writer(self._fd, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    self._loop.remove_writer(self._fd)
+
+    async def _write_command(self, msg):
+        await self._write(msg.encode())
+        self._outstanding += 1
+
+    async def _send(self, msg):
+        logger.debug("Writing to device : {0}".format(msg))
+        # A command is always written out in full, even if the caller is
+        # cancelled part way through. A truncated command followed by the
+        # next one would otherwise be executed by SAM-BA as garbage.
+        self._write_task = asyncio.ensure_future(self._write_command(msg))
+        await asyncio.shield(self._write_task)
+
+    async def _retrieve_response(self, timeout=None):
+        if timeout is None:
+            timeout = self.response_timeout()
+        deadline = self._loop.time() + timeout
+        data = self._rx.pop_response()
+        while data is None:
+            if self._lost is not None:
+                raise self._lost
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                raise SamBAConnectionError(
+                    "Read timed out on SAM-BA. Check your connections "
+                    "and device configuration and retry.")
+            self._data_waiter = self._loop.create_future()
+            try:
+                await asyncio.wait_for(self._data_waiter, remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._data_waiter = None
+            data = self._rx.pop_response()
+        self._outstanding -= 1
+        data = data.decode('latin-1')
+        logger.debug("Got response : {0}".format(data.strip()))
+        return data
+
+    async def _resync(self):
+        """
+        Discard the responses to commands left outstanding by an earlier
+        cancelled or failed operation.
+        """
+        logger.warning("Resynchronizing with SAM-BA on {0}"
+                       "".format(self._port))
+        if self._write_task is not None:
+            await self._write_task
+        try:
+            while self._outstanding:
+                await self._retrieve_response()
+        except SamBAConnectionError:
+            self._outstanding = 0
+            self._rx.clear()
+            self.ser.reset_input_buffer()
+
+    # Commands
+
+    async def command(self, msg, timeout=None):
+        """ Send a single command and return its response """
+        async with self._lock:
+            if self._outstanding:
+                await self._resync()
+            await self._send(msg)
+            return await self._retrieve_response(timeout)
+
+    async def pipeline(self, msgs):
+        """
+        Send a burst of independent commands, keeping upto window of them
+        in flight. Returns the list of responses, in order.
+        """
+        responses = []
+        async with self._lock:
+            if self._outstanding:
+                await self._resync()
+            for msg in msgs:
+                if self._outstanding >= self.window:
+                    responses.append(await self._retrieve_response())
+                await self._send(msg)
+            while self._outstanding:
+                responses.append(await self._retrieve_response())
+        return responses
+
+    async def write_word(self, address, contents):
+        """
+        Write 4 bytes at a specific address.
+        Both address and contents expected to be character strings
+
+        """
+        return await self.command("W{0},{1}#".format(address, contents))
+
+    async def read_word(self, address):
+        """
+        Read 4 bytes from a specific address.
+        Both address and returned contents are character strings
+
+        """
+        return await self.command("w{0},#".format(address))
+
+    async def efc_rstat(self, efc=None):
+        """
+        Read EFC status.
+        Returns True if EFC is ready, False if busy.
+
+        """
+        efc_status = await self.read_word((efc or self._device).EFC_FSR)
+        return bool(int(efc_status.strip(), 16) & 0x01)
+
+    async def efc_wready(self, efc=None):
+        """
+        Wait for EFC to report ready. As with SamBAConnection, the efc_
+        functions which take efc use the registers of that device
+        instance, such as one of its planes(), instead of the device's.
+        """
+        while not await self.efc_rstat(efc):
+            await asyncio.sleep(self.EFC_POLL_INTERVAL)
+
+    async def efc_ewp(self, pno, efc=None, command=None):
+        """
+        EFC trigger write page. Pno is an integer. The page is written
+        with the EFC command given, the device's WPC if none.
+        """
+        efc = efc or self._device
+        await self.write_word(efc.EFC_FCR,
+                              '5A{0}{1}'.format(hex(pno)[2:].zfill(4),
+                                                command or efc.WPC))
+
+    async def efc_eraseall(self, efc=None):
+        """
+        EFC Function to Erase All.
+        Returns True if the EFC completed the erase without errors.
+
+        """
+        efc = efc or self._device
+        await self.efc_wready(efc)
+        await self.write_word(efc.EFC_FCR, '5A0000{0}'.format(efc.EAC))
+        return await self._efc_wait_errors(efc)
+
+    async def efc_erasepages(self, farg, efc=None):
+        """
+        EFC Function to Erase Pages. farg is the command argument, an
+        integer, which gives the first page and the number of pages.
+        Returns True if the EFC completed the erase without errors.
+
+        """
+        efc = efc or self._device
+        await self.efc_wready(efc)
+        await self.write_word(efc.EFC_FCR,
+                              '5A{0}{1}'.format(hex(farg)[2:].zfill(4),
+                                                efc.EPA_COMMAND))
+        return await self._efc_wait_errors(efc)
+
+    async def _efc_wait_errors(self, efc):
+        # Error flags are cleared by reading the status register, so they
+        # are collected from every read made while waiting for the erase.
+        status = 0
+        fsr = 0
+        while not fsr & 0x01:
+            fsr = int((await self.read_word(efc.EFC_FSR)).strip(), 16)
+            status = status | fsr
+            if not fsr & 0x01:
+                await asyncio.sleep(self.EFC_POLL_INTERVAL)
+        return not status & efc.EFC_FSR_ERRORS
+
+    # Flash operations
+
+    def _image(self, image, start_page):
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            image = BytesIO(bytes(image))
+        return load_image(image, self._device, start_page)
+
+    async def _erase(self, image, erase):
+        """
+        Plan how image is to be erased and written, and run the erases
+        the plan needs, as pysamloader's write() does, see EraseSequence
+        in the erase module. Returns the ErasePlan.
+        """
+        device = self._device
+        sequence = EraseSequence(device, image, _page_time(self, device),
+                                 erase)
+        erases = sequence.erases
+        while erases:
+            ok = True
+            for plane, farg in erases:
+                if farg is None:
+                    ok = await self.efc_eraseall(plane) and ok
+                else:
+                    ok = await self.efc_erasepages(farg, plane) and ok
+            erases = sequence.erased(ok)
+        return sequence.plan
+
+    async def write_page(self, page_no, data, efc=None, command=None):
+        """
+        Write one page of data, padding it if it is short. page_no is
+        counted from the start of the plane of efc, and the page is
+        written with the EFC command given, as for efc_ewp().
+        """
+        efc = efc or self._device
+        page_size = efc.PAGE_SIZE
+        data = bytes(data) + self._fill * (page_size - len(data))
+        page_address = int(efc.FS_ADDRESS, 16) + page_no * page_size
+        await self.efc_wready(efc)
+        await self.pipeline(
+            "W{0},{1}#".format(_adrstr(page_address + i),
+                               hexlify(data[i:i+4][::-1]).decode())
+            for i in range(0, page_size, 4)
+        )
+        await self.efc_ewp(page_no, efc, command)
+
+    async def write(self, image, start_page=0, erase='auto'):
+        """
+        Write image to flash. image may be data, which is written from
+        start_page, or anything load_image() accepts. The flash is erased
+        as planned by the erase module in the given mode, one of
+        ERASE_MODES.
+        """
+        image = self._image(image, start_page)
+        plan = await self._erase(image, erase)
+        planes = self._device.planes()
+        for plane, page_address, data in _interleave(planes, image.pages()):
+            command = plan.commands.get(page_address)
+            if command is None:
+                continue
+            await self.write_page(_plane_page_number(plane, page_address),
+                                  data, plane, command)
+        for plane in planes:
+            await self.efc_wready(plane)
+
+    async def verify(self, image, start_page=0):
+        """
+        Verify the contents of flash against image, given as for write().
+        Returns the total number of words with errors.
+        """
+        image = self._image(image, start_page)
+        words = [(page_address + i, bytes(data[i:i+4]))
+                 for page_address, data in image.pages()
+                 for i in range(0, len(data), 4)]
+        responses = await self.pipeline(
+            "w{0},#".format(_adrstr(address)) for address, _ in words
+        )
+        errors = 0
+        for (address, word), actual in zip(words, responses):
+            expected = hexlify(word[::-1]).decode()
+            if not actual.strip().upper()[2:] == expected.upper():
+                logger.error("Verification Failed at {0} - {1} {2}"
+                             "".format(hex(address), actual.strip(),
+                                       expected))
+                errors = errors + 1
+        return errors
@@ -0,0 +1,219 @@
+# Copyright (c) 2019 Chintalagiri Shashank
+#
+# This file is part of pysamloader.
+
+# pysamloader is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pysamloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysamloader.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import struct
+import logging
+
+from . import log
+
+logger = logging.getLogger('applet')
+log.loggers.append(logger)
+
+
+def _adrstr(address):
+    return hex(address)[2:].zfill(8)
+
+
+class FlashWriterApplet(object):
+    """
+    Flash programming applet which runs from SRAM on the target.
+
+    The applet is uploaded to the device's APPLET_ADDRESS and started with
+    the SAM-BA G command. Page data is staged in two alternating SRAM
+    buffers described by APPLET_BUFFERS and APPLET_BUFFER_SIZE. Each call
+    to the applet programs the pages in one buffer, polling the EFC
+    locally, and returns as soon as the write of the last page has been
+    started. The host uploads the other buffer while that page is being
+    programmed.
+
+    Data is uploaded to the target using the provided writer, which is
+    called as writer(samba, address, data).
+
+    The source for CODE is applets/flash_writer.S.
+
+    """
+    CODE = (
+        b'\x00\x00\x00\x00\x00\x00\x00\x00\xf0\xb5\x14\xa7'
+        b'\x38\x68\x81\x00\xc9\x19\x49\x68\x01\x22\x50\x40'
+        b'\x38\x60\xfe\x68\x3d\x69\x78\x69\x01\xb4\x0b\x68'
+        b'\x4a\x68\x8c\x68\x0c\x31\xb0\x68\x00\x9f\x07\x43'
+        b'\x00\x97\x40\x08\xf9\xd3\x00\x20\x0f\x58\x17\x50'
+        b'\x04\x30\xa8\x42\xfa\xd1\x73\x60\x49\x19\x52\x19'
+        b'\x01\x20\x00\x02\x1b\x18\x01\x3c\xeb\xd1\x01\xbc'
+        b'\x01\xa7\x78\x61\xf0\xbd\x00\xbf'
+    )
+    ENTRY_OFFSET = 0x08
+    MAILBOX_OFFSET = len(CODE)
+    EFC_OFFSET = MAILBOX_OFFSET + 12
+    STATUS_OFFSET = MAILBOX_OFFSET + 20
+
+    # Buffer header : EFC_FCR command for the first page, flash address
+    # of the first page, and the number of pages which follow.
+    HEADER_SIZE = 12
+
+    # Room left at the end of each buffer for XMODEM block padding
+    BUFFER_SLACK = 128
+
+    # EFC_FSR error bits : FCMDE and FLOCKE
+    FSR_ERRORS = 0x06
+
+    # Upper bound on the time taken to program one page, in seconds. Only
+    # used to decide when to give up waiting for the applet to return.
+    PAGE_TIMEOUT = 0.05
+
+    def __init__(self, samba, device, writer):
+        self._samba = samba
+        self._device = device
+        self._writer = writer
+        self._address = int(device.APPLET_ADDRESS, 16)
+        self._buffers = [int(x, 16) for x in device.APPLET_BUFFERS]
+        self._next = 0
+        self._wpc = int(device().WPC, 16)
+        # EFC the applet is pointed at, and the status registers of every
+        # EFC it has been used with
+        self._efc = device.EFC_FMR
+        self._fsrs = [device.EFC_FSR]
+        self.capacity = (device.APPLET_BUFFER_SIZE - self.HEADER_SIZE -
+                         self.BUFFER_SLACK) // device.PAGE_SIZE
+
+    @staticmethod
+    def supported(device):
+        return bool(device.APPLET_ADDRESS)
+
+    def load(self):
+        """ Upload the applet and initialize its mailbox """
+        image = bytearray(self.CODE)
+        struct.pack_into('<II', image, 0,
+                         int(self._device.APPLET_STACK, 16),
+                         (self._address + self.ENTRY_OFFSET) | 1)
+        image += struct.pack('<IIIIII', 0,
+                             self._buffers[0], self._buffers[1],
+                             int(self._device.EFC_FMR, 16),
+                             self._device.PAGE_SIZE, 0)
+        logger.debug("Loading flash writer applet at {0}"
+                     "".format(self._device.APPLET_ADDRESS))
+        self._writer(self._samba, self._address, bytes(image))
+        self._next = 0
+        self._efc = self._device.EFC_FMR
+        self._fsrs = [self._device.EFC_FSR]
+
+    def program(self, page_no, data, plane=None, command=None):
+        """
+        Program whole pages of data starting at page_no. The length of
+        data must be a multiple of the page size, and no more than
+        capacity pages long.
+
+        If plane, one of the device's planes(), is given, the pages are
+        in that plane and page_no is counted from its start. The pages
+        are written with the EFC command given, the device's WPC if none.
+        """
+        plane = plane or self._device
+        if plane.EFC_FMR != self._efc:
+            self._samba.write_word(
+                _adrstr(self._address + self.EFC_OFFSET), plane.EFC_FMR)
+            self._efc = plane.EFC_FMR
+            if plane.EFC_FSR not in self._fsrs:
+                self._fsrs.append(plane.EFC_FSR)
+        count = len(data) // self._device.PAGE_SIZE
+        wpc = int(command, 16) if command else self._wpc
+        fcr = (0x5A << 24) | (page_no << 8) | wpc
+        page_address = int(plane.FS_ADDRESS, 16) + \
+            page_no * self._device.PAGE_SIZE
+        header = struct.pack('<III', fcr, page_address, count)
+        buffer_address = self._buffers[self._next]
+        logger.debug("Staging pages {0} to {1} at {2}"
+                     "".format(page_no, page_no + count - 1,
+                               _adrstr(buffer_address)))
+        self._writer(self._samba, buffer_address, b''.join((header, data)))
+        self._samba.go(_adrstr(self._address),
+                       timeout=self._samba.response_timeout() +
+                       count * self.PAGE_TIMEOUT)
+        self._next = self._next ^ 1
+
+    def finish(self):
+        """ Wait for the last pages to be written and check for errors """
+        status = int(self._samba.read_word(
+            _adrstr(self._address + self.STATUS_OFFSET)).strip(), 0)
+        for efc_fsr in self._fsrs:
+            fsr = 0
+            while not fsr & 0x01:
+                fsr = int(self._samba.read_word(efc_fsr).strip(), 0)
+                status = status | fsr
+        if status & self.FSR_ERRORS:
+            raise IOError("Flash programming failed. EFC_FSR : {0}"
+                          "".format(hex(status)))
+
+
+class CRC32Applet(object):
+    """
+    CRC32 applet which runs from SRAM on the target.
+
+    The applet is uploaded to the device's APPLET_ADDRESS and started with
+    the SAM-BA G command. Each call computes the CRC32 of one region of
+    the target's memory, so that flash can be verified without reading
+    it back over the link. The CRC is the same as that of zlib.crc32.
+
+    The source for CODE is applets/crc32.S.
+
+    """
+    CODE = (
+        b'\x00\x00\x00\x00\x00\x00\x00\x00\x30\xb5\x0b\xa3'
+        b'\x18\x68\x59\x68\x08\x4c\x00\x22\xd2\x43\x51\xb1'
+        b'\x10\xf8\x01\x5b\x6a\x40\x08\x25\x52\x08\x28\xbf'
+        b'\x62\x40\x01\x3d\xfa\xd1\x01\x39\xf4\xd1\xd2\x43'
+        b'\x9a\x60\x30\xbd\x20\x83\xb8\xed'
+    )
+    ENTRY_OFFSET = 0x08
+    MAILBOX_OFFSET = len(CODE)
+    CRC_OFFSET = MAILBOX_OFFSET + 8
+
+    # Upper bound on the time taken per byte, in seconds. Only used to
+    # decide when to give up waiting for the applet to return.
+    BYTE_TIMEOUT = 5e-6
+
+    def __init__(self, samba, device):
+        self._samba = samba
+        self._device = device
+        self._address = int(device.APPLET_ADDRESS, 16)
+
+    @staticmethod
+    def supported(device):
+        return bool(device.APPLET_ADDRESS)
+
+    def load(self):
+        """ Upload the applet and clear its mailbox """
+        image = bytearray(self.CODE)
+        struct.pack_into('<II', image, 0,
+                         int(self._device.APPLET_STACK, 16),
+                         (self._address + self.ENTRY_OFFSET) | 1)
+        image += struct.pack('<III', 0, 0, 0)
+        logger.debug("Loading CRC32 applet at {0}"
+                     "".format(self._device.APPLET_ADDRESS))
+        with self._samba.command_queue() as queue:
+            queue.write_block(self._address, image)
+
+    def crc(self, address, length):
+        """ Returns the CRC32 of length bytes at address on the target """
+        with self._samba.command_queue() as queue:
+            queue.write_block(self._address + self.MAILBOX_OFFSET,
+                              struct.pack('<II', address, length))
+        self._samba.go(_adrstr(self._address),
+                       timeout=self._samba.response_timeout() +
+                       length * self.BYTE_TIMEOUT)
+        return int(self._samba.read_word(
+            _adrstr(self._address + self.CRC_OFFSET)).strip(), 16)
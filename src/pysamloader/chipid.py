@@ -27,6 +27,33 @@ class SamChipID(object):
     def _get_value(self, bs, be):
         return self._cidr[31-bs:32-be].uint
 
+    @property
+    def cidr(self):
+        return self._cidr.uint
+
+    @property
+    def exid(self):
+        return self._exid.uint
+
+    @property
+    def key(self):
+        """ CIDR and EXID, which together identify the part """
+        return '{0:08X}:{1:08X}'.format(self.cidr, self.exid)
+
+    @property
+    def valid(self):
+        """
+        Whether this looks like a chip ID at all, rather than whatever
+        happened to be read from an address with no chip ID register.
+        """
+        if not self.cidr:
+            return False
+        try:
+            self.eproc, self.nvpsiz, self.arch
+        except KeyError:
+            return False
+        return True
+
     @property
     def version(self):
         return self._get_value(4, 0)
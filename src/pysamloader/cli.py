@@ -19,35 +19,40 @@
 # along with pysamloader.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
+import json
 import logging
 import argparse
+from collections import OrderedDict
 
-from serial.tools import list_ports
-
-from .terminal import ProgressBar
-from .samba import SamBAConnection
-from .pysamloader import write
-from .pysamloader import verify
-from .pysamloader import set_boot
-from .pysamloader import get_device
-from .pysamloader import get_supported_devices
-from .pysamloader import read_chipid
-from .pysamloader import read_flash_descriptors
-from .pysamloader import read_unique_identifier
-from . import __version__
-
+# Everything else is imported by the functions which need it, so that
+# the informational commands (-V, --lp, --ld) start up quickly. See
+# tests/test_startup.py.
 from . import log
 logger = logging.getLogger('cli')
 log.loggers.append(logger)
 
 
+def _positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            "{0} is not a positive integer".format(value))
+    return number
+
+
 def print_supported_devices():
+    from .registry import registry
     print("Supported devices : ")
-    for d in get_supported_devices():
-        print(" - {0}".format(d[0]))
+    for name in registry.names():
+        print(" - {0}".format(name))
 
 
 def print_serial_ports():
+    from serial.tools import list_ports
     print("Detected serial ports : ")
     for p in list_ports.comports():
         print(" - {0:15} {1:20} {2:18} {3:18}"
@@ -56,40 +61,160 @@ def print_serial_ports():
 
 
 def print_chipid(*args, **kwargs):
+    from .pysamloader import read_chipid
     chipid = read_chipid(*args, **kwargs)
     print(chipid)
 
 
 def print_flash_descriptors(*args, **kwargs):
+    from .pysamloader import read_flash_descriptors
     descriptors = read_flash_descriptors(*args, **kwargs)
     print(descriptors)
 
 
 def print_unique_identifier(*args, **kwargs):
+    from .pysamloader import read_unique_identifier
     uid = read_unique_identifier(*args, **kwargs)
     print(uid)
 
 
+def submit_write_and_verify(args):
+    """
+    Write and verify the file on args.port using the flashing daemon
+    listening on args.socket. Returns the number of words with
+    verification errors, or None if verification was not performed.
+    """
+    from .daemon import submit
+    from .daemon import FlashDaemonError
+    from .samdevice import SAMDevice
+    logger.info("Submitting job to daemon on {0}".format(args.socket))
+    # An unsupported device is left for the daemon to detect
+    device = args.device
+    if device is SAMDevice:
+        device = None
+    result = submit({'action': 'program',
+                     'port': args.port,
+                     'baud': args.baud,
+                     'link_baud': args.link_baud,
+                     'window': args.window,
+                     'terminal': args.terminal or None,
+                     'slow_connect': args.slow_connect or None,
+                     'device': device and device.__name__,
+                     'filename': os.path.abspath(args.filename),
+                     'write': not args.nw,
+                     'verify': not args.nv,
+                     'boot': args.g,
+                     'xmodem': args.xm,
+                     'applet': args.applet,
+                     'bulk': not args.wv,
+                     'skip_erased': args.skip_erased,
+                     'erase': args.erase,
+                     'resume': args.resume,
+                     'crc': args.crc}, args.socket)
+    if result['status'] == 'error':
+        raise FlashDaemonError(result['message'])
+    logger.info("Daemon job completed in {0:.2f} s".format(result['elapsed']))
+    return result['errors']
+
+
 def write_and_verify(args, progress_class=None):
-    samba = SamBAConnection(port=args.port, baud=args.baud, device=args.device)
-    if not args.nw:
-        write(samba, args.device, args.filename, progress_class=progress_class)
-    errors = None
-    if not args.nv:
-        errors = verify(samba, args.device, args.filename,
-                        progress_class=progress_class)
-    if not errors and args.g:
-        set_boot(samba, args.device)
-    else:
-        logger.warning("Not setting GPNVM bit.")
-        logger.warning("Invoke with -g to have that happen.")
+    """
+    Write and verify the file on args.port. Returns the number of words
+    with verification errors, or None if verification was not performed.
+
+    If a flashing daemon is listening on args.socket, the job is handed
+    to it instead, unless args.no_daemon is set or connection statistics
+    are to be collected. Statistics are added to args.collected_stats.
+    """
+    from .daemon import ping
+    from .samba import SamBAConnection
+    from .pysamloader import program
+    from .pysamloader import identify_device
+    collect_stats = bool(args.stats or args.stats_file)
+    if not args.no_daemon and not collect_stats and ping(args.socket):
+        return submit_write_and_verify(args)
+    samba = SamBAConnection(port=args.port, baud=args.baud,
+                            device=args.device, window=args.window,
+                            slow_connect=args.slow_connect,
+                            terminal=args.terminal,
+                            link_baud=args.link_baud,
+                            stats=collect_stats)
+    try:
+        device = identify_device(samba)
+        return program(samba, device, args.filename,
+                       write_flash=not args.nw, verify_flash=not args.nv,
+                       boot=args.g, progress_class=progress_class,
+                       xmodem=args.xm, applet=args.applet,
+                       bulk=not args.wv, skip_erased=args.skip_erased,
+                       crc=args.crc, erase=args.erase,
+                       resume=args.resume)
+    finally:
+        samba.close()
+        if samba.stats is not None:
+            args.collected_stats[args.port] = samba.stats
+
+
+def report_stats(args):
+    """ Print and save the statistics collected for --stats """
+    collected = args.collected_stats
+    if args.stats:
+        for port in sorted(collected):
+            print("SAM-BA statistics for {0} :".format(port))
+            print(collected[port].summary())
+    if args.stats_file:
+        with open(args.stats_file, 'w') as f:
+            json.dump(OrderedDict((port, collected[port].as_dict())
+                                  for port in sorted(collected)),
+                      f, indent=2)
+
+
+def run_daemon(args):
+    """
+    Run the flashing daemon on args.socket. If --gang ports are given,
+    the daemon only accepts jobs for those ports.
+    """
+    from .gang import expand_ports
+    from .daemon import FlashDaemon
+    from .daemon import serve
+    ports = expand_ports(args.gang) if args.gang else None
+    daemon = FlashDaemon(ports=ports, window=args.window,
+                         slow_connect=args.slow_connect,
+                         terminal=args.terminal)
+    serve(daemon, args.socket)
+
+
+def gang_write_and_verify(args):
+    """
+    Write and verify the file on every port in args.gang concurrently.
+    Returns True if all boards passed.
+    """
+    from .gang import expand_ports
+    from .gang import gang_run
+    from .gang import print_gang_report
+    ports = expand_ports(args.gang)
+    if not ports:
+        logger.error("No ports to program.")
+        return False
+
+    def _job(port):
+        port_args = argparse.Namespace(**vars(args))
+        port_args.port = port
+        return write_and_verify(port_args)
+
+    logger.info("Gang programming {0} boards".format(len(ports)))
+    results = gang_run(_job, ports)
+    print_gang_report(results)
+    return all(r.passed for r in results)
 
 
 def set_boot_from_flash(*args, **kwargs):
+    from .samba import SamBAConnection
+    from .pysamloader import set_boot
+    from .pysamloader import identify_device
     samba = kwargs.pop('samba', None)
     if not samba:
         samba = SamBAConnection(*args, **kwargs)
-    return set_boot(samba, kwargs['device'])
+    return set_boot(samba, identify_device(samba))
 
 
 def _get_parser():
@@ -100,14 +225,46 @@ def _get_parser():
                         help="Verbose debug information")
     parser.add_argument('-P', '--port', metavar='port',
                         default="/dev/ttyUSB1",
-                        help="Port on which SAM-BA is listening. "
+                        help="Port on which SAM-BA is listening. May also "
+                             "be a pyserial URL, such as socket://host:port "
+                             "for a serial port server. "
                              "Default /dev/ttyUSB1"),
+    parser.add_argument('--gang', metavar='port', action='append',
+                        help="Write and verify on this port concurrently "
+                             "with any other --gang ports. May be given "
+                             "more than once, and may be a glob such as "
+                             "'/dev/ttyUSB*'. Overrides --port."),
     parser.add_argument('-b', '--baud', metavar='baud', type=int,
                         default=115200,
                         help="Baud rate of serial communication. "
                              "Default 115200"),
+    parser.add_argument('--link-baud', metavar='baud', type=int,
+                        help="Baud rate to switch to once connected, if "
+                             "both the device and the serial adapter can "
+                             "run at it. Falls back to --baud if not."),
     parser.add_argument('-d', '--device', metavar='device',
-                        help="Atmel SAM Device. Default ATSAM3U4E")
+                        help="Atmel SAM Device. Detected from the chip "
+                             "ID if not given.")
+    parser.add_argument('--window', metavar='window', type=_positive_int,
+                        help="Maximum number of SAM-BA commands kept in "
+                             "flight at a time. Use 1 to wait for each "
+                             "response before sending the next command. "
+                             "Default 8")
+    parser.add_argument('--slow-connect', action='store_true',
+                        help="Connect to SAM-BA using fixed delays instead "
+                             "of probing for its prompt. Slower, but may "
+                             "help with unusual bootloaders or adapters.")
+    parser.add_argument('--terminal', action='store_true',
+                        help="Leave SAM-BA in terminal mode instead of "
+                             "switching it to binary mode. Slower, but "
+                             "easier to follow when debugging.")
+    parser.add_argument('--socket', metavar='path',
+                        help="Unix socket of the flashing daemon. Jobs are "
+                             "submitted to a daemon listening here, if "
+                             "there is one. Default daemon.sock in the "
+                             "user cache directory")
+    parser.add_argument('--no-daemon', action='store_true',
+                        help="Do not submit jobs to a running daemon.")
 
     action = parser.add_mutually_exclusive_group(required=False)
     action.add_argument('-V', action='store_true',
@@ -116,6 +273,11 @@ def _get_parser():
                         help="List available serial ports and exit")
     action.add_argument('--ld', '--list-devices', action='store_true',
                         help="List supported devices and exit")
+    action.add_argument('--daemon', action='store_true',
+                        help="Run as a flashing daemon, keeping SAM-BA "
+                             "connections open across jobs submitted on "
+                             "--socket. Serves only the --gang ports, if "
+                             "any are given.")
     action.add_argument('--rc', '--read-chipid', action='store_true',
                         help="Read Chip ID and exit")
     action.add_argument('--rd', '--read-descriptor', action='store_true',
@@ -131,14 +293,59 @@ def _get_parser():
                         help="Do not verify after write.")
     parser.add_argument('--nw', '--no-write', action='store_true',
                         help="Do not write only. Verify only.")
+    parser.add_argument('--xm', '--xmodem', action='store_true',
+                        help="Write flash using XMODEM transfers instead "
+                             "of SAM-BA word writes.")
+    parser.add_argument('--applet', action='store_true',
+                        help="Program flash using an applet running from "
+                             "SRAM on the target, where supported.")
+    parser.add_argument('--skip-erased', action='store_true',
+                        help="Erase the whole flash before writing, and do "
+                             "not program pages which are entirely erased "
+                             "in the image. Same as --erase all.")
+    parser.add_argument('--erase', default='auto',
+                        choices=('auto', 'any', 'page', 'all'),
+                        help="How to erase flash before writing. 'auto' "
+                             "picks the fastest plan which leaves flash "
+                             "outside the image as it was, 'any' the "
+                             "fastest plan, 'page' erases each page as it "
+                             "is written, and 'all' erases the whole flash "
+                             "first. Default auto.")
+    parser.add_argument('--resume', action='store_true',
+                        help="If an earlier write of the same file to the "
+                             "same chip on the same port did not complete, "
+                             "continue it from the last page known to be "
+                             "written instead of starting over. Not "
+                             "available with --applet.")
+    parser.add_argument('--wv', '--word-verify', action='store_true',
+                        help="Verify by reading flash one word at a time "
+                             "instead of using XMODEM block reads.")
+    parser.add_argument('--crc', action='store_true',
+                        help="Verify using CRCs computed by an applet on "
+                             "the target, reading back only regions whose "
+                             "CRC does not match.")
+    parser.add_argument('--stats', action='store_true',
+                        help="Print a summary of the SAM-BA commands sent, "
+                             "their latencies and time spent waiting for "
+                             "the EFC once done.")
+    parser.add_argument('--stats-file', metavar='file',
+                        help="Save the SAM-BA command statistics to this "
+                             "file as JSON.")
     parser.add_argument('filename', metavar='file', nargs='?',
-                        help="Binary file to be burnt into the chip")
+                        help="File to be burnt into the chip. Intel HEX "
+                             "(.hex), Motorola S-record (.srec, .s19, .s28, "
+                             ".s37) and ELF files are written at their own "
+                             "addresses, and anything else is written as a "
+                             "raw binary to the start of flash.")
     return parser
 
 
 def main():
     parser = _get_parser()
     arguments = parser.parse_args()
+    if arguments.resume and arguments.applet:
+        parser.error("--resume cannot be used with --applet, whose writes "
+                     "are not journaled")
 
     if arguments.v:
         log.set_level(logging.DEBUG)
@@ -146,6 +353,7 @@ def main():
         log.set_level(logging.INFO)
 
     if arguments.V:
+        from . import __version__
         print("pysamloader {0}".format(__version__))
         return
 
@@ -155,46 +363,74 @@ def main():
     if arguments.ld:
         return print_supported_devices()
 
-    if not arguments.device:
-        logger.info("Device not specified. Assuming ATSAM3U4E.")
-        arguments.device = 'ATSAM3U4E'
+    if arguments.device:
+        from .registry import registry
+        try:
+            dev = registry.get(arguments.device)
+        except ImportError:
+            from .samdevice import SAMDevice
+            dev = SAMDevice
+            logger.warning("Device is not supported!")
+            print_supported_devices()
+        arguments.device = dev
+    else:
+        logger.info("Device not specified. Detecting from chip ID.")
 
-    try:
-        dev = get_device(arguments.device)
-    except ImportError:
-        from .samdevice import SAMDevice
-        dev = SAMDevice
-        logger.warning("Device is not supported!")
-        print_supported_devices()
+    if not arguments.socket:
+        from .daemon import default_socket
+        arguments.socket = default_socket()
 
-    arguments.device = dev
+    if arguments.daemon:
+        return run_daemon(arguments)
 
     if arguments.rc:
         return print_chipid(port=arguments.port,
                             baud=arguments.baud,
-                            device=arguments.device)
+                            device=arguments.device,
+                            slow_connect=arguments.slow_connect,
+                            terminal=arguments.terminal,
+                            link_baud=arguments.link_baud)
 
     if arguments.rd:
         return print_flash_descriptors(port=arguments.port,
                                        baud=arguments.baud,
-                                       device=arguments.device)
+                                       device=arguments.device,
+                                       slow_connect=arguments.slow_connect,
+                                       terminal=arguments.terminal,
+                                       link_baud=arguments.link_baud)
 
     if arguments.ri:
         return print_unique_identifier(port=arguments.port,
                                        baud=arguments.baud,
-                                       device=arguments.device)
+                                       device=arguments.device,
+                                       slow_connect=arguments.slow_connect,
+                                       terminal=arguments.terminal,
+                                       link_baud=arguments.link_baud)
 
     if arguments.g and not arguments.filename:
         return set_boot_from_flash(port=arguments.port,
                                    baud=arguments.baud,
-                                   device=arguments.device)
+                                   device=arguments.device,
+                                   slow_connect=arguments.slow_connect,
+                                   terminal=arguments.terminal,
+                                   link_baud=arguments.link_baud)
 
     if not arguments.filename:
         print("No bin file provided and no list actions requested.")
         parser.print_help()
         return
 
-    write_and_verify(arguments, progress_class=ProgressBar)
+    arguments.collected_stats = {}
+    try:
+        if arguments.gang:
+            if not gang_write_and_verify(arguments):
+                raise SystemExit(1)
+            return
+
+        from .terminal import ProgressBar
+        write_and_verify(arguments, progress_class=ProgressBar)
+    finally:
+        report_stats(arguments)
 
 
 if __name__ == "__main__":
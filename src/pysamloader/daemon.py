@@ -0,0 +1,328 @@
+# Copyright (c) 2019 Chintalagiri Shashank
+#
+# This file is part of pysamloader.
+
+# pysamloader is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pysamloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysamloader.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Flashing daemon, which keeps SAM-BA connections open across jobs.
+
+The daemon listens on a local Unix socket. Each client connection
+carries a single job, as one line of JSON, and receives a single line
+of JSON with the result. A job looks like :
+
+    {"action": "program", "port": "/dev/ttyUSB1", "baud": 115200,
+     "link_baud": 230400, "window": 8, "terminal": false,
+     "slow_connect": false,
+     "device": "ATSAM3U4E", "filename": "/path/to/app.bin",
+     "write": true, "verify": true, "boot": false,
+     "xmodem": false, "applet": false, "bulk": true,
+     "skip_erased": false, "crc": false, "erase": "auto",
+     "resume": false}
+
+and its result like :
+
+    {"port": "/dev/ttyUSB1", "status": "ok", "errors": 0,
+     "elapsed": 1.52, "message": ""}
+
+where status is one of 'ok', 'failed' (verification errors) or 'error'
+(the job could not be completed, see message). The 'ping' and
+'shutdown' actions are also accepted.
+
+If a job does not give a device, it is detected from the chip ID of
+the board on the port, before each job. If it does not give window,
+terminal or slow_connect, those the daemon was started with are used.
+
+Connections are kept per port, and are checked with a prompt probe
+before each job so boards can be swapped between jobs. Device
+definitions and parsed images are cached, with images reloaded when
+the file on disk changes. Jobs on different ports run concurrently,
+while jobs on the same port are run one after the other.
+"""
+
+import os
+import json
+import time
+import socket
+import logging
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+# The connection and programming modules are imported by the methods
+# which need them, so that clients can submit jobs without loading them.
+from . import log
+
+logger = logging.getLogger('daemon')
+log.loggers.append(logger)
+
+
+def default_socket():
+    """ daemon.sock in the user's cache directory """
+    import appdirs
+    return os.path.join(
+        appdirs.user_cache_dir('pysamloader',
+                               appauthor='Quazar Technologies'),
+        'daemon.sock')
+
+
+class FlashDaemonError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class _Session(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samba = None
+        self.key = None
+
+
+class FlashDaemon(object):
+    """
+    Runs programming jobs against a set of ports, keeping a warm
+    SamBAConnection open on each. If ports is provided, jobs for any
+    other port are rejected.
+    """
+    def __init__(self, ports=None, window=None, slow_connect=False,
+                 terminal=False):
+        self.ports = ports
+        self.window = window
+        self.slow_connect = slow_connect
+        self.terminal = terminal
+        self._sessions = {}
+        self._devices = {}
+        self._images = {}
+        self._lock = threading.Lock()
+
+    def device(self, name):
+        from .pysamloader import get_device
+        with self._lock:
+            if name not in self._devices:
+                self._devices[name] = get_device(name)
+            return self._devices[name]
+
+    def image(self, filename, device):
+        from .image import load_image
+        st = os.stat(filename)
+        key = (filename, device)
+        with self._lock:
+            cached = self._images.get(key)
+            if not cached or cached[0] != (st.st_mtime, st.st_size):
+                logger.info("Loading image {0}".format(filename))
+                # Not memory mapped, so that cached images are unaffected
+                # if the file is rewritten while the daemon is running.
+                cached = ((st.st_mtime, st.st_size),
+                          load_image(filename, device, mapped=False))
+                self._images[key] = cached
+        return cached[1]
+
+    def _session(self, port):
+        with self._lock:
+            if port not in self._sessions:
+                self._sessions[port] = _Session()
+            return self._sessions[port]
+
+    def _connect(self, session, port, baud, link_baud, name, window=None,
+                 terminal=None, slow_connect=None):
+        """
+        The connection on port, and the device on it. The device is
+        detected from its chip ID if name is None. window, terminal and
+        slow_connect default to those of the daemon.
+        """
+        from .samba import SamBAConnection
+        from .pysamloader import identify_device
+        if terminal is None:
+            terminal = self.terminal
+        if slow_connect is None:
+            slow_connect = self.slow_connect
+        if window is None:
+            window = self.window
+        key = (baud, link_baud, name, terminal, slow_connect)
+        if session.samba is not None:
+            if session.key == key and session.samba.resync():
+                session.samba.window = SamBAConnection.PIPELINE_WINDOW \
+                    if window is None else window
+                if name is None:
+                    # The board may have been swapped for another part
+                    session.samba.set_device(None)
+                return session.samba, identify_device(session.samba)
+            self._drop(session)
+        device = self.device(name) if name else None
+        logger.info("Opening SAM-BA connection")
+        session.samba = SamBAConnection(port, baud, device,
+                                        window=window,
+                                        slow_connect=slow_connect,
+                                        terminal=terminal,
+                                        link_baud=link_baud)
+        session.key = key
+        return session.samba, identify_device(session.samba)
+
+    @staticmethod
+    def _drop(session):
+        if session.samba is not None:
+            try:
+                session.samba.close()
+            except Exception:  # noqa
+                pass
+        session.samba = None
+        session.key = None
+
+    def run_job(self, job):
+        """ Run a single job, given as a dict. Returns the result dict. """
+        port = job.get('port')
+        result = {'port': port, 'status': 'error', 'errors': None,
+                  'elapsed': None, 'message': ''}
+        if self.ports is not None and port not in self.ports:
+            result['message'] = "Port {0} is not served by this " \
+                                "daemon".format(port)
+            return result
+        start_time = time.time()
+        session = self._session(port)
+        with session.lock, log.context(port):
+            try:
+                samba, device = self._connect(session, port,
+                                              job.get('baud', 115200),
+                                              job.get('link_baud'),
+                                              job.get('device'),
+                                              job.get('window'),
+                                              job.get('terminal'),
+                                              job.get('slow_connect'))
+                image = self.image(job['filename'], device)
+                from .pysamloader import program
+                errors = program(samba, device, image,
+                                 write_flash=job.get('write', True),
+                                 verify_flash=job.get('verify', True),
+                                 boot=job.get('boot', False),
+                                 xmodem=job.get('xmodem', False),
+                                 applet=job.get('applet', False),
+                                 bulk=job.get('bulk', True),
+                                 skip_erased=job.get('skip_erased', False),
+                                 crc=job.get('crc', False),
+                                 erase=job.get('erase', 'auto'),
+                                 resume=job.get('resume', False))
+                result['errors'] = errors
+                result['status'] = 'failed' if errors else 'ok'
+            except Exception as e:
+                logger.error("Job failed : {0}".format(e))
+                result['message'] = str(getattr(e, 'msg', e)) or \
+                    type(e).__name__
+                self._drop(session)
+        result['elapsed'] = time.time() - start_time
+        return result
+
+    def close(self):
+        for session in self._sessions.values():
+            with session.lock:
+                self._drop(session)
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        daemon = self.server.daemon
+        try:
+            job = json.loads(self.rfile.readline().decode('utf-8'))
+            action = job.get('action', 'program')
+        except ValueError:
+            job, action = {}, None
+        if action == 'program':
+            result = daemon.run_job(job)
+        elif action == 'ping':
+            from . import __version__
+            result = {'status': 'ok', 'version': __version__}
+        elif action == 'shutdown':
+            result = {'status': 'ok'}
+            threading.Thread(target=self.server.shutdown).start()
+        else:
+            result = {'status': 'error',
+                      'message': "Unrecognized job : {0}".format(job)}
+        self.wfile.write(json.dumps(result).encode('utf-8') + b'\n')
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class _JobServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+        daemon_threads = True
+else:
+    _JobServer = None
+
+
+def serve(daemon, socket_path=None):
+    """
+    Serve jobs for daemon on socket_path, by default default_socket(),
+    until shut down.
+    """
+    socket_path = socket_path or default_socket()
+    if _JobServer is None:
+        raise FlashDaemonError("The flashing daemon requires Unix domain "
+                               "sockets, which are not available here.")
+    if os.path.exists(socket_path):
+        if ping(socket_path):
+            raise FlashDaemonError("A daemon is already listening on "
+                                   "{0}".format(socket_path))
+        os.unlink(socket_path)
+    folder = os.path.dirname(socket_path)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    server = _JobServer(socket_path, _JobHandler)
+    server.daemon = daemon
+    logger.info("Listening for jobs on {0}".format(socket_path))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        daemon.close()
+        os.unlink(socket_path)
+
+
+def submit(job, socket_path=None, timeout=None):
+    """
+    Send a job to the daemon on socket_path, by default default_socket(),
+    and return its result. Raises FlashDaemonError if no daemon is
+    listening.
+    """
+    socket_path = socket_path or default_socket()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(socket_path)
+        except socket.error:
+            raise FlashDaemonError("No daemon listening on "
+                                   "{0}".format(socket_path))
+        sock.sendall(json.dumps(job).encode('utf-8') + b'\n')
+        response = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+    if not response:
+        raise FlashDaemonError("Daemon closed the connection")
+    return json.loads(response.decode('utf-8'))
+
+
+def ping(socket_path=None):
+    """ Returns True if a daemon is listening on socket_path """
+    socket_path = socket_path or default_socket()
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return False
+    try:
+        return submit({'action': 'ping'}, socket_path, timeout=1)['status'] \
+            == 'ok'
+    except (FlashDaemonError, socket.error, ValueError):
+        return False
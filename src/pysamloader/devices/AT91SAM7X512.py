@@ -20,18 +20,33 @@ from pysamloader.samdevice import SAMDevice
 
 
 class AT91SAM7X512(SAMDevice):
+    CHIPID_CIDR = 'FFFFF240'
+    CHIPID_EXID = 'FFFFF244'
+    CHIPID_ARCH = 'AT91SAM7Xxx'
+    CHIPID_NVPSIZ = '512K'
+    EFC_FMR = 'FFFFFF60'
     EFC_FCR = 'FFFFFF64'
     EFC_FSR = 'FFFFFF68'
     AutoBaud = True
     FullErase = True
+    XmodemRead = True
     WP_COMMAND = '01'
     EWP_COMMAND = None
     EA_COMMAND = '08'
     FS_ADDRESS = '00100000'
     PAGE_SIZE = 256
+    EFC_FSR_ERRORS = 0x0C
+    UART_BRGR = 'FFFFF220'
+    UART_MCK = 48000000
     SGPB_CMD = '0B'
     CGPB_CMD = '0D'
     SGP = [0, 0, 1]
+    EFC_PLANES = [
+        {'FS_ADDRESS': '00100000', 'EFC_FMR': 'FFFFFF60',
+         'EFC_FCR': 'FFFFFF64', 'EFC_FSR': 'FFFFFF68'},
+        {'FS_ADDRESS': '00140000', 'EFC_FMR': 'FFFFFF70',
+         'EFC_FCR': 'FFFFFF74', 'EFC_FSR': 'FFFFFF78'},
+    ]
 
     def __init__(self):
         super(AT91SAM7X512, self).__init__()
@@ -26,19 +26,37 @@ class ATSAM3U4E(SAMDevice):
     EFC_FRR = '400E080C'
     CHIPID_CIDR = '400E0740'
     CHIPID_EXID = '400E0744'
+    CHIPID_ARCH = 'SAM3UxE'
+    CHIPID_NVPSIZ = '256K'
     AutoBaud = False
     FullErase = False
-    WP_COMMAND = None
+    XmodemRead = True
+    WP_COMMAND = '01'
     EWP_COMMAND = '03'
-    EA_COMMAND = None
+    EA_COMMAND = '05'
     FS_ADDRESS = '00080000'
     PAGE_SIZE = 256
+    XMODEM_FMR = '00000600'
+    APPLET_ADDRESS = '20001000'
+    APPLET_STACK = '20008000'
+    APPLET_BUFFERS = ['20002000', '20004000']
+    APPLET_BUFFER_SIZE = 0x2000
+    UART_BRGR = '400E0620'
+    UART_MCK = 48000000
     SGPB_CMD = '0B'
     CGPB_CMD = '0C'
     GD_CMD = '00'
     STUI_CMD = '0E'
     SPUI_CMD = '0F'
     SGP = [0, 1, 0]
+    EFC_PLANES = [
+        {'FS_ADDRESS': '00080000', 'EFC_FMR': '400E0800',
+         'EFC_FCR': '400E0804', 'EFC_FSR': '400E0808',
+         'EFC_FRR': '400E080C'},
+        {'FS_ADDRESS': '00100000', 'EFC_FMR': '400E0A00',
+         'EFC_FCR': '400E0A04', 'EFC_FSR': '400E0A08',
+         'EFC_FRR': '400E0A0C'},
+    ]
 
     def __init__(self):
         super(ATSAM3U4E, self).__init__()
@@ -19,22 +19,34 @@
 class EFCFlashDescriptor(object):
     def __init__(self, samba):
         self._samba = samba
-        self.id = samba.efc_readfrr()
-        self.size = self._read_number()
-        self.page_size = self._read_number()
+        fl_id, size, page_size, plane_count = self._read_responses(4)
+        self.id = fl_id
+        self.size = int(size.strip(), 0)
+        self.page_size = int(page_size.strip(), 0)
 
-        self.plane_count = self._read_number()
-        self.planes = {}
-        for plane in range(self.plane_count):
-            self.planes[plane] = self._read_number()
+        self.plane_count = int(plane_count.strip(), 0)
+        numbers = self._read_numbers(self.plane_count + 1)
+        self.planes = dict(enumerate(numbers[:-1]))
 
-        self.lock_count = self._read_number()
-        self.locks = {}
-        for lock in range(self.lock_count):
-            self.locks[lock] = self._read_number()
+        self.lock_count = numbers[-1]
+        self.locks = dict(enumerate(self._read_numbers(self.lock_count)))
+
+    def _read_responses(self, count):
+        # Successive reads of EFC_FRR return successive words of the
+        # descriptor, so a known number of them can be pipelined.
+        with self._samba.command_queue() as queue:
+            commands = [queue.efc_readfrr() for _ in range(count)]
+        return [command.response for command in commands]
+
+    def _read_numbers(self, count):
+        return [int(x.strip(), 0) for x in self._read_responses(count)]
 
-    def _read_number(self):
-        return int(self._samba.efc_readfrr().strip(), 0)
+    def geometry(self):
+        """ The flash geometry, as a dict which can be saved as JSON """
+        return {'size': self.size,
+                'page_size': self.page_size,
+                'planes': [self.planes[i] for i in range(self.plane_count)],
+                'locks': [self.locks[i] for i in range(self.lock_count)]}
 
     def __repr__(self):
         rstr = "Flash Descriptor : \n"
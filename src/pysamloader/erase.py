@@ -0,0 +1,256 @@
+# Copyright (c) 2019 Chintalagiri Shashank
+#
+# This file is part of pysamloader.
+
+# pysamloader is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pysamloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysamloader.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Planning of how flash is erased when an image is written.
+
+The EFC can erase and write each page of the image in one command (EWP),
+or the flash can be erased beforehand, a whole plane at a time (EA) or
+a group of pages at a time (EPA, where the EFC has it), and the pages
+then written without erasing (WP). Pages which are entirely erased in
+the image need not be sent at all once they have been erased. Which is
+fastest depends on how much of each plane the image covers, how long
+the EFC takes for each command, and how long each page takes to send.
+
+Each plane's pages are planned separately. The candidate strategies
+are costed using the device's timing model (WP_TIME, EWP_TIME, EA_TIME
+and EPA_TIME) and the estimated time to send a page, and the cheapest
+is used. The modes are :
+
+  * auto : the fastest plan which leaves flash outside the image as it
+    was. A plane is only erased as a whole if the image covers all of
+    it, and groups of pages only if the image covers the whole group.
+  * any : the fastest plan, which may erase flash outside the image.
+  * page : erase and write each page of the image.
+  * all : erase every plane the image touches as a whole first.
+
+Devices which need the flash erased before writing (FullErase) are
+always erased as a whole.
+
+EraseSequence runs a plan. It decides what to erase, and what to do
+when the EFC reports errors erasing, for every writer, synchronous or
+not, while the writer only runs the erases it is given.
+"""
+
+import json
+import hashlib
+import logging
+
+from .samdevice import plane_index
+from . import log
+
+logger = logging.getLogger('erase')
+log.loggers.append(logger)
+
+ERASE_MODES = ('auto', 'any', 'page', 'all')
+
+ERASE_WRITE = 'erase-write'
+ERASE_ALL = 'erase-all'
+ERASE_PAGES = 'erase-pages'
+
+
+class ErasePlan(object):
+    """
+    How the pages of an image are to be erased and written.
+
+    erase_all holds the planes to be erased as a whole, and erase_pages
+    (plane, argument) pairs of erase pages commands, in the order they
+    are to be run. commands maps the address of each page which is to be
+    written to the EFC command which writes it. Pages of the image which
+    are not in commands are not written at all.
+    """
+    def __init__(self):
+        self.strategies = []
+        self.erase_all = []
+        self.erase_pages = []
+        self.commands = {}
+        self.time = 0.0
+
+    @property
+    def name(self):
+        return ', '.join(sorted(set(self.strategies))) or 'nothing'
+
+    def __len__(self):
+        return len(self.commands)
+
+    def digest(self):
+        """ SHA-1 of the erases and writes of the plan, as hex """
+        content = [[plane.FS_ADDRESS for plane in self.erase_all],
+                   [[plane.FS_ADDRESS, farg]
+                    for plane, farg in self.erase_pages],
+                   sorted(self.commands.items())]
+        return hashlib.sha1(json.dumps(content).encode('utf-8')).hexdigest()
+
+    def add(self, strategy, cost, commands, erase_all=None,
+            erase_pages=None):
+        self.strategies.append(strategy)
+        self.time += cost
+        self.commands.update(commands)
+        if erase_all is not None:
+            self.erase_all.append(erase_all)
+        if erase_pages:
+            self.erase_pages.extend(erase_pages)
+
+
+def _erase_write(plane, pages, page_time):
+    commands = dict((address, plane.WPC) for address, _ in pages)
+    cost = len(pages) * (page_time + plane.EWP_TIME)
+    return ERASE_WRITE, cost, commands, None, None
+
+
+def _plane_pages(plane):
+    if not plane.FLASH_SIZE:
+        return None
+    return plane.FLASH_SIZE // plane.PAGE_SIZE
+
+
+def _erase_all(plane, pages, page_time):
+    # Once erased, pages which are entirely erased in the image are
+    # already as they should be.
+    wpc = plane.WP_COMMAND or plane.WPC
+    commands = dict((address, wpc) for address, erased in pages
+                    if not erased)
+    cost = plane.EA_TIME + len(commands) * (page_time + plane.WP_TIME)
+    return ERASE_ALL, cost, commands, plane, None
+
+
+def _erase_pages(plane, pages, page_time, code, size, keep):
+    base = int(plane.FS_ADDRESS, 16)
+    groups = {}
+    for address, erased in pages:
+        page_no = (address - base) // plane.PAGE_SIZE
+        groups.setdefault(page_no // size, []).append((address, erased))
+    wpc = plane.WP_COMMAND or plane.WPC
+    cost = 0.0
+    commands = {}
+    erase_pages = []
+    for group, group_pages in sorted(groups.items()):
+        ewp_cost = len(group_pages) * (page_time + plane.EWP_TIME)
+        written = [address for address, erased in group_pages
+                   if not erased]
+        epa_cost = plane.EPA_TIME + \
+            len(written) * (page_time + plane.WP_TIME)
+        if (keep and len(group_pages) < size) or ewp_cost <= epa_cost:
+            cost += ewp_cost
+            commands.update((address, plane.WPC)
+                            for address, _ in group_pages)
+        else:
+            cost += epa_cost
+            commands.update((address, wpc) for address in written)
+            erase_pages.append((plane, group * size | code))
+    return ERASE_PAGES, cost, commands, None, erase_pages
+
+
+def _candidates(plane, pages, page_time, mode):
+    if plane.FullErase or mode == 'all':
+        return [_erase_all(plane, pages, page_time)]
+    candidates = [_erase_write(plane, pages, page_time)]
+    if mode == 'page':
+        return candidates
+    keep = mode != 'any'
+    if plane.EA_COMMAND and \
+            (not keep or len(pages) == _plane_pages(plane)):
+        candidates.append(_erase_all(plane, pages, page_time))
+    if plane.EPA_COMMAND:
+        for code, size in enumerate(plane.EPA_SIZES):
+            if size:
+                candidates.append(_erase_pages(plane, pages, page_time,
+                                               code, size, keep))
+    return candidates
+
+
+def plan_erase(planes, image, page_time, mode='auto'):
+    """
+    Plan how to erase and write image, a FlashImage, to the device whose
+    planes() are given, in the given mode, one of ERASE_MODES. page_time
+    is the estimated time to send one page to the target, in seconds.
+    Returns the ErasePlan with the lowest estimated time.
+    """
+    if mode not in ERASE_MODES:
+        raise ValueError("Unknown erase mode : {0}".format(mode))
+    by_plane = [[] for _ in planes]
+    for page_address, data in image.pages():
+        by_plane[plane_index(planes, page_address)].append(
+            (page_address, image.is_erased(data)))
+    plan = ErasePlan()
+    for plane, pages in zip(planes, by_plane):
+        if not pages:
+            continue
+        candidates = _candidates(plane, pages, page_time, mode)
+        plan.add(*min(candidates, key=lambda c: c[1]))
+    return plan
+
+
+class EraseSequence(object):
+    """
+    The erases needed to write image to device, in the given mode, and
+    what to do if they fail. A writer runs the erases and reports back
+    until there are none left, and then writes following plan :
+
+        sequence = EraseSequence(device, image, page_time, mode)
+        erases = sequence.erases
+        while erases:
+            ok = all([run(plane, farg) for plane, farg in erases])
+            erases = sequence.erased(ok)
+        plan = sequence.plan
+
+    Each erase is a (plane, farg) pair, where farg is None to erase the
+    whole plane, and the argument of the erase pages command otherwise.
+
+    If the EFC reports errors erasing, the flash is not known to be
+    erased, and every page is erased and written instead. Devices which
+    cannot erase pages as they are written (FullErase) are erased again,
+    and IOError is raised if that fails too.
+    """
+    def __init__(self, device, image, page_time, mode='auto'):
+        if mode == 'all' and not device.EA_COMMAND:
+            logger.warning("Device has no erase all command. "
+                           "Erasing page by page.")
+            mode = 'page'
+        self._device = device
+        self._image = image
+        self._page_time = page_time
+        self._retried = False
+        self.plan = plan_erase(device.planes(), image, page_time, mode)
+        logger.info("Erase plan : {0}, writing {1} of {2} pages, estimated "
+                    "{3:.2f} s".format(self.plan.name, len(self.plan),
+                                       image.num_pages, self.plan.time))
+        # Each plane's EFC erases only its own plane
+        self.erases = [(plane, None) for plane in self.plan.erase_all] + \
+            list(self.plan.erase_pages)
+
+    def erased(self, ok):
+        """
+        Given whether the last erases completed without errors, returns
+        the erases to run next, an empty list once plan can be written.
+        """
+        if ok:
+            return []
+        if self._device.FullErase:
+            # Pages cannot be erased as they are written, so the only
+            # way on is an erase which succeeds.
+            if self._retried:
+                raise IOError("Flash erase failed. The flash cannot be "
+                              "written without erasing it.")
+            logger.warning("EFC reported errors during erase. Retrying.")
+            self._retried = True
+            return [(plane, None) for plane in self._device.planes()]
+        logger.warning("EFC reported errors during erase. "
+                       "Writing every page.")
+        self.plan = plan_erase(self._device.planes(), self._image,
+                               self._page_time, 'page')
+        return []
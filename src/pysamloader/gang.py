@@ -0,0 +1,112 @@
+# Copyright (c) 2019 Chintalagiri Shashank
+#
+# This file is part of pysamloader.
+
+# pysamloader is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pysamloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysamloader.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Gang programming support, running the same job against many serial
+ports concurrently. Each port is handled in its own thread, with log
+messages tagged with the port they relate to.
+"""
+
+import glob
+import time
+import logging
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from . import log
+
+logger = logging.getLogger('gang')
+log.loggers.append(logger)
+
+
+def expand_ports(patterns):
+    """
+    Expand a list of ports and port globs such as /dev/ttyUSB* into a
+    sorted list of unique ports. URLs such as socket://host:port are
+    taken as they are.
+    """
+    ports = []
+    for pattern in patterns:
+        if '://' not in pattern and any(c in pattern for c in '*?['):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                logger.warning("No ports match {0}".format(pattern))
+        else:
+            matches = [pattern]
+        for port in matches:
+            if port not in ports:
+                ports.append(port)
+    return ports
+
+
+class GangResult(object):
+    def __init__(self, port):
+        self.port = port
+        self.errors = None
+        self.exception = None
+        self.elapsed = None
+
+    @property
+    def passed(self):
+        return self.exception is None and not self.errors
+
+    @property
+    def summary(self):
+        if self.exception is not None:
+            msg = getattr(self.exception, 'msg', None) or str(self.exception)
+            return "{0} : {1}".format(type(self.exception).__name__,
+                                      ' '.join(msg.split()))
+        if self.errors:
+            return "{0} words with errors".format(self.errors)
+        return ""
+
+
+def _run_one(job, port):
+    result = GangResult(port)
+    start_time = time.time()
+    with log.context(port):
+        try:
+            result.errors = job(port)
+        except Exception as e:  # noqa
+            logger.error("Failed : {0}".format(e))
+            result.exception = e
+    result.elapsed = time.time() - start_time
+    return result
+
+
+def gang_run(job, ports, processes=None):
+    """
+    Run job(port) for every port concurrently. The return value of job is
+    taken to be the number of verification errors. Returns a list of
+    GangResult, one per port, in the order of ports.
+    """
+    pool = ThreadPool(processes or len(ports))
+    try:
+        return pool.map(partial(_run_one, job), ports)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def print_gang_report(results):
+    print("Gang programming results : ")
+    for result in results:
+        print(" - {0:20} {1:4} {2:7.2f} s  {3}"
+              "".format(result.port, "PASS" if result.passed else "FAIL",
+                        result.elapsed, result.summary))
+    passed = len([r for r in results if r.passed])
+    print("{0}/{1} boards passed".format(passed, len(results)))
@@ -0,0 +1,353 @@
+# Copyright (c) 2019 Chintalagiri Shashank
+#
+# This file is part of pysamloader.
+
+# pysamloader is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pysamloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysamloader.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Flash images, and loaders for the file formats they can be read from.
+
+A FlashImage is a sparse map of the flash pages which hold data, with
+each page at its real address. Raw binaries are placed at the start of
+flash (or at a given page), while Intel HEX, Motorola S-record and ELF
+files carry their own addresses. Only pages which hold data are
+written and verified, so gaps between the parts of an image cost
+nothing.
+"""
+
+import os
+import mmap
+import hashlib
+import struct
+from binascii import hexlify
+from binascii import unhexlify
+from binascii import Error as BinasciiError
+from six import PY2
+from six import string_types
+
+
+class ImageError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class FlashImage(object):
+    """
+    Sparse, page aligned image of flash contents. Bytes within a page
+    which are not covered by the image are set to fill, which should be
+    the erased value of the flash.
+
+    Pages are not copied out of the data they are added from. Each page
+    refers to a slice of its source buffer, typically a memory mapped
+    file, and pages and runs of pages are handed out as memoryviews of
+    it. Only pages which are partially covered by the data, such as the
+    last page of a binary, are copied into a buffer of their own, where
+    the fill is applied.
+    """
+    def __init__(self, base, page_size, fill=b'\xff', regions=None):
+        self.base = base
+        # (start, end) address ranges data may be placed in, with ranges
+        # which adjoin merged, or None if only base is known.
+        self.regions = None
+        if regions:
+            self.regions = []
+            for start, end in sorted(regions):
+                if self.regions and self.regions[-1][1] == start:
+                    self.regions[-1] = (self.regions[-1][0], end)
+                else:
+                    self.regions.append((start, end))
+        self.page_size = page_size
+        self.fill = fill
+        self._erased = bytes(fill * page_size)
+        # Page address -> (buffer, offset of the page within buffer)
+        self._pages = {}
+        self._owned = set()
+
+    def add(self, address, data):
+        """ Place data at address, which is an absolute address """
+        if address < self.base:
+            raise ImageError("Image data at {0} is below the start of "
+                             "flash at {1}".format(hex(address),
+                                                   hex(self.base)))
+        if self.regions is not None and \
+                not any(start <= address and address + len(data) <= end
+                        for start, end in self.regions):
+            raise ImageError("Image data from {0} to {1} is outside the "
+                             "flash".format(hex(address),
+                                            hex(address + len(data))))
+        data = _view(data)
+        offset = 0
+        while offset < len(data):
+            page_address = address + offset
+            page_offset = (page_address - self.base) % self.page_size
+            page_address -= page_offset
+            count = min(self.page_size - page_offset, len(data) - offset)
+            if count == self.page_size:
+                self._pages[page_address] = (data, offset)
+                self._owned.discard(page_address)
+            else:
+                page = self._own_page(page_address)
+                page[page_offset:page_offset + count] = \
+                    data[offset:offset + count]
+            offset += count
+
+    def _own_page(self, page_address):
+        """ Writable copy of a page, made the first time it is needed """
+        if page_address not in self._owned:
+            if page_address in self._pages:
+                page = bytearray(self.page(page_address))
+            else:
+                page = bytearray(self.fill * self.page_size)
+            self._pages[page_address] = (_view(page), 0)
+            self._owned.add(page_address)
+        return self._pages[page_address][0]
+
+    @property
+    def num_pages(self):
+        return len(self._pages)
+
+    @property
+    def nbytes(self):
+        return len(self._pages) * self.page_size
+
+    @property
+    def num_erased(self):
+        """ Number of pages which are entirely set to fill """
+        return sum(1 for _, page in self.pages() if self.is_erased(page))
+
+    def is_erased(self, data):
+        return data == self._erased
+
+    def page_number(self, page_address):
+        """ Page number of the page at page_address, counted from base """
+        return (page_address - self.base) // self.page_size
+
+    def page(self, page_address):
+        buf, offset = self._pages[page_address]
+        return buf[offset:offset + self.page_size]
+
+    def digest(self):
+        """ SHA-1 of the pages of the image and their addresses, as hex """
+        h = hashlib.sha1()
+        for page_address, data in self.pages():
+            h.update(struct.pack('<I', page_address))
+            h.update(data)
+        return h.hexdigest()
+
+    def pages(self):
+        """ Yield (address, data) for each page, in address order """
+        for page_address in sorted(self._pages):
+            yield page_address, self.page(page_address)
+
+    def runs(self, max_size=None, skip_erased=False, erased=False):
+        """
+        Yield (address, data) for each run of contiguous pages, in
+        address order. Runs are split so that they are no longer than
+        max_size, rounded down to whole pages.
+
+        If skip_erased is True, pages which are entirely set to fill are
+        left out. If erased is True, only those pages are included.
+        """
+        max_pages = None
+        if max_size:
+            max_pages = max(max_size // self.page_size, 1)
+        run = []
+        for page_address in sorted(self._pages):
+            if (skip_erased or erased) and \
+                    self.is_erased(self.page(page_address)) != erased:
+                continue
+            if run and (page_address != run[0] + len(run) * self.page_size or
+                        len(run) == max_pages):
+                yield run[0], self._run(run)
+                run = []
+            run.append(page_address)
+        if run:
+            yield run[0], self._run(run)
+
+    def _run(self, run):
+        # A run which lies contiguously in one buffer is handed out as a
+        # view of it. Anything else has to be joined into a new buffer.
+        buf, offset = self._pages[run[0]]
+        for i, page_address in enumerate(run):
+            page_buf, page_offset = self._pages[page_address]
+            if page_buf is not buf or \
+                    page_offset != offset + i * self.page_size:
+                return b''.join(self.page(p) for p in run)
+        return buf[offset:offset + len(run) * self.page_size]
+
+
+def _view(data):
+    if PY2:
+        return data
+    return memoryview(data)
+
+
+def _map(f):
+    """
+    Map the contents of the file object f into memory, or read them in
+    if that is not possible. The file can be closed once this returns.
+    """
+    if not PY2:
+        try:
+            return memoryview(mmap.mmap(f.fileno(), 0,
+                                        access=mmap.ACCESS_READ))
+        except (ValueError, EnvironmentError):
+            # Empty files cannot be mapped, and neither can pipes and the
+            # like.
+            pass
+    return _view(f.read())
+
+
+def _records(data):
+    for lineno, line in enumerate(bytes(data).splitlines(), 1):
+        line = line.strip()
+        if line:
+            yield lineno, line
+
+
+def _unhexlify(line, lineno):
+    try:
+        return bytearray(unhexlify(line))
+    except (BinasciiError, TypeError):
+        raise ImageError("Malformed record on line {0}".format(lineno))
+
+
+def load_hex(data, image):
+    """ Load Intel HEX records from data into image """
+    base = 0
+    for lineno, line in _records(data):
+        if not line.startswith(b':'):
+            raise ImageError("Malformed record on line {0}".format(lineno))
+        record = _unhexlify(line[1:], lineno)
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise ImageError("Bad record length on line {0}".format(lineno))
+        if sum(record) & 0xFF:
+            raise ImageError("Bad checksum on line {0}".format(lineno))
+        rtype = record[3]
+        data = record[4:-1]
+        if rtype == 0x00:
+            image.add(base + (record[1] << 8 | record[2]), data)
+        elif rtype == 0x01:
+            break
+        elif rtype in (0x02, 0x04):
+            if len(data) != 2:
+                raise ImageError("Bad address record on line {0}"
+                                 "".format(lineno))
+            shift = 4 if rtype == 0x02 else 16
+            base = (data[0] << 8 | data[1]) << shift
+
+
+def load_srec(data, image):
+    """ Load Motorola S-records from data into image """
+    address_lengths = {b'1': 2, b'2': 3, b'3': 4}
+    for lineno, line in _records(data):
+        if not line.startswith(b'S'):
+            raise ImageError("Malformed record on line {0}".format(lineno))
+        rtype = line[1:2]
+        record = _unhexlify(line[2:], lineno)
+        if len(record) < 3 or record[0] != len(record) - 1:
+            raise ImageError("Bad record length on line {0}".format(lineno))
+        if sum(record) & 0xFF != 0xFF:
+            raise ImageError("Bad checksum on line {0}".format(lineno))
+        alen = address_lengths.get(rtype)
+        if alen:
+            address = int(hexlify(record[1:1 + alen]), 16)
+            image.add(address, record[1 + alen:-1])
+        elif rtype in (b'7', b'8', b'9'):
+            break
+
+
+def load_elf(data, image):
+    """
+    Load the PT_LOAD segments of the ELF file in data into image.
+    Segments are placed at their physical (load) addresses.
+    """
+    if len(data) < 52 or data[:4] != b'\x7fELF':
+        raise ImageError("Not an ELF file")
+    if data[4:6] != b'\x01\x01':
+        raise ImageError("Only 32 bit little endian ELF files are supported")
+    phoff, = struct.unpack_from('<I', data, 28)
+    phentsize, phnum = struct.unpack_from('<HH', data, 42)
+    if phnum and phentsize < 32:
+        raise ImageError("Bad ELF program header size {0}".format(phentsize))
+    if phoff + phnum * phentsize > len(data):
+        raise ImageError("ELF program headers extend past the end of the "
+                         "file")
+    for i in range(phnum):
+        p_type, p_offset, _, p_paddr, p_filesz = \
+            struct.unpack_from('<5I', data, phoff + i * phentsize)
+        if p_type == 1 and p_filesz:
+            image.add(p_paddr, data[p_offset:p_offset + p_filesz])
+
+
+def load_bin(data, image, address):
+    """ Load the raw binary in data into image at address """
+    image.add(address, data)
+
+
+_loaders = {
+    '.hex': load_hex,
+    '.ihex': load_hex,
+    '.srec': load_srec,
+    '.s19': load_srec,
+    '.s28': load_srec,
+    '.s37': load_srec,
+    '.mot': load_srec,
+    '.elf': load_elf,
+    '.axf': load_elf,
+}
+
+
+def load_image(filename, device, start_page=0, mapped=True):
+    """
+    Load the image from filename, which may also be a file object or an
+    already loaded FlashImage, for the given device. The format is
+    determined from the file extension, which for file objects is taken
+    from their name if they have one, or from the contents in the case
+    of ELF files. Anything else is treated as a raw binary, and placed
+    at start_page.
+
+    Files are memory mapped unless mapped is False. The image then
+    depends on the file remaining as it is for as long as it is used.
+    """
+    if isinstance(filename, FlashImage):
+        return filename
+    image = FlashImage(int(device.FS_ADDRESS, 16), device.PAGE_SIZE,
+                       fill=bytes(bytearray([device.ERASED_VALUE])),
+                       regions=device.flash_regions())
+    if hasattr(filename, 'read'):
+        name = getattr(filename, 'name', None)
+    else:
+        name = filename
+    loader = None
+    if isinstance(name, string_types):
+        loader = _loaders.get(os.path.splitext(name)[1].lower())
+    if hasattr(filename, 'read'):
+        data = _view(filename.read())
+    else:
+        with open(filename, 'rb') as f:
+            if mapped:
+                data = _map(f)
+            else:
+                data = _view(f.read())
+    if loader is None and data[:4] == b'\x7fELF':
+        loader = load_elf
+    if loader is None:
+        load_bin(data, image, image.base + start_page * device.PAGE_SIZE)
+    else:
+        loader(data, image)
+    return image
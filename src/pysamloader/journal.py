@@ -0,0 +1,171 @@
+# Copyright (c) 2019 Chintalagiri Shashank
+#
+# This file is part of pysamloader.
+
+# pysamloader is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pysamloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysamloader.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Checkpoint journal for resuming interrupted writes.
+
+While an image is written, a small journal records how far the write
+has got, so that a write which fails part way, say because the cable
+was disturbed, can later be continued rather than started over. There
+is one journal for each port, chip (by its unique identifier, or its
+chip ID where it has none) and image, kept as a file in the journals
+folder in the user's config directory.
+
+The journal is only written once the erases the write needs are done,
+and it records the erase plan, so that a resumed write neither erases
+again nor continues a different plan. It then records, as positions in
+the order the pages are written :
+
+  * done : every page before this one is known to have been written,
+    the EFC having since reported it ready
+  * issued : the last page whose write was started
+
+Pages from done to issued may or may not have been written when the
+write stopped. These are the only pages read back when resuming. The
+journal is removed once the write completes.
+
+So that the journal does not cost a file write for every page, what is
+committed is saved every SAVE_PAGES pages or SAVE_INTERVAL seconds, and
+by flush(), which the writer calls when the write fails. If the process
+dies without saving, pages after the saved issued may also have been
+written. They are written again when resuming, with the same data.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+
+from .registry import CONFIG_DIR
+from . import log
+
+logger = logging.getLogger('journal')
+log.loggers.append(logger)
+
+
+JOURNAL_DIR = os.path.join(CONFIG_DIR, 'journals')
+
+
+def _replace(src, dst):
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+class WriteJournal(object):
+
+    # Commits are saved once this many pages have been issued since the
+    # last save, or this many seconds have passed.
+    SAVE_PAGES = 32
+    SAVE_INTERVAL = 1.0
+
+    def __init__(self, port, uid, image_digest, folder=JOURNAL_DIR):
+        self.key = '{0}|{1}|{2}'.format(port, uid, image_digest)
+        name = hashlib.sha1(self.key.encode('utf-8')).hexdigest()
+        self.path = os.path.join(folder, name + '.json')
+        self.plan = None
+        self.done = 0
+        self.issued = -1
+        self._saved_issued = -1
+        self._saved_at = 0
+        self._dirty = False
+
+    def load(self, plan):
+        """
+        Load the journal of an earlier write following plan, the digest
+        of an ErasePlan. Returns True if there is one, in which case its
+        erases are done and done and issued say how far it got.
+        """
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (EnvironmentError, ValueError):
+            return False
+        if state.get('key') != self.key or state.get('plan') != plan:
+            return False
+        self.plan = plan
+        self.done = state['done']
+        self.issued = state['issued']
+        self._saved_issued = self.issued
+        self._saved_at = time.time()
+        return True
+
+    def discard(self):
+        """ Forget any earlier write, before the flash is erased again """
+        self.plan = None
+        self.done = 0
+        self.issued = -1
+        try:
+            os.remove(self.path)
+        except EnvironmentError:
+            pass
+
+    def start(self, plan):
+        """ Start journaling a write following plan, once erased for it """
+        self.plan = plan
+        self.done = 0
+        self.issued = -1
+        self._save()
+
+    def commit(self, done, issued):
+        """
+        Record that pages before done are written, and issued started.
+        This is saved along with later commits, see SAVE_PAGES.
+        """
+        if (done, issued) == (self.done, self.issued):
+            return
+        self.done = done
+        self.issued = issued
+        self._dirty = True
+        if issued - self._saved_issued >= self.SAVE_PAGES or \
+                time.time() - self._saved_at >= self.SAVE_INTERVAL:
+            self._save()
+
+    def flush(self):
+        """ Save whatever has been committed since the last save """
+        if self._dirty:
+            self._save()
+
+    def finish(self):
+        """ The write is complete. The journal is no longer needed. """
+        self.discard()
+
+    def _save(self):
+        self._dirty = False
+        if self.plan is None:
+            return
+        self._saved_issued = self.issued
+        self._saved_at = time.time()
+        tmp = self.path + '.tmp'
+        try:
+            folder = os.path.dirname(self.path)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            with open(tmp, 'w') as f:
+                json.dump({'key': self.key, 'plan': self.plan,
+                           'done': self.done, 'issued': self.issued}, f)
+            # The journal is replaced whole, so that it is never seen
+            # half written if the process dies while saving it.
+            _replace(tmp, self.path)
+        except EnvironmentError as e:
+            # Without the journal, a failed write can only be started over
+            logger.warning("Could not write {0} : {1}".format(self.path, e))
+            self.plan = None
@@ -1,12 +1,59 @@
 
 
 import logging
+import threading
+from contextlib import contextmanager
 
-logging.basicConfig(format='[%(levelname)8s][%(name)s] %(message)s')
 
-loggers = []
+_context = threading.local()
+
+
+class _ContextFilter(logging.Filter):
+    """ Adds the current thread's logging context, if any, to records """
+    def filter(self, record):
+        context = getattr(_context, 'value', None)
+        record.context = '[{0}]'.format(context) if context else ''
+        return True
+
+
+logging.basicConfig(format='[%(levelname)8s][%(name)s]%(context)s '
+                           '%(message)s')
+for _handler in logging.getLogger().handlers:
+    _handler.addFilter(_ContextFilter())
+
+
+class _Loggers(list):
+    """
+    The loggers whose level is set by set_level. Modules are imported
+    only as they are needed, so loggers appended after set_level has
+    been called are given the level last set.
+    """
+    level = None
+
+    def append(self, logger):
+        if self.level is not None:
+            logger.setLevel(self.level)
+        super(_Loggers, self).append(logger)
+
+
+loggers = _Loggers()
+
+
+@contextmanager
+def context(value):
+    """
+    Tag log messages from the current thread with value, typically the
+    port being worked on, for the duration of the context.
+    """
+    previous = getattr(_context, 'value', None)
+    _context.value = value
+    try:
+        yield
+    finally:
+        _context.value = previous
 
 
 def set_level(level):
+    loggers.level = level
     for logger in loggers:
         logger.setLevel(level)
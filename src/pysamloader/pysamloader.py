@@ -18,108 +18,377 @@
 # You should have received a copy of the GNU General Public License
 # along with pysamloader.  If not, see <http://www.gnu.org/licenses/>.
 
-import os
-import sys
+import zlib
+import time
+import struct
 import logging
-import appdirs
 
+from functools import partial
 from xmodem import XMODEM
 from binascii import hexlify
-from six import PY2
 from io import BytesIO
 
 from .samba import SamBAConnection
+from .applet import FlashWriterApplet
+from .applet import CRC32Applet
+from .image import load_image
+from .erase import EraseSequence
+from .journal import WriteJournal
+from .samdevice import plane_index
+from .registry import registry
+from .registry import SupportedDevices
+from .registry import INTERFACE
+from .registry import UnknownDeviceError
 from . import log
 
-if sys.version_info.major == 3 and sys.version_info.minor >= 5:
-    import importlib.util
-elif sys.version_info.major == 3 and 3 <= sys.version_info.minor <= 4:
-    import importlib.machinery
-else:
-    import imp
-
 logger = logging.getLogger('pysamloader')
 log.loggers.append(logger)
 
+XM_READ_BLOCK_SIZE = 8192
+CRC_REGION_SIZE = 8192
+
 
 def raw_write_page(samba, page_address, data):
-    for i in range(0, 256, 4):
-        wbytes = bytearray(data[i:i+4])
-        wbytes.reverse()
-        if PY2:
-            wbytes = hexlify(wbytes)
-        else:
-            wbytes = wbytes.hex()
-        adrstr = hex(page_address + i)[2:].zfill(8)
-        samba.write_word(adrstr, wbytes)
+    with samba.command_queue() as queue:
+        queue.write_block(page_address, data)
+
+
+class XmodemPageWriter(object):
+    """
+    Writes pages to the chip using SAM-BA XMODEM send file transfers.
+
+    A single XMODEM instance and send buffer are reused for every page.
+    The XMODEM implementation uses CRC checksums whenever SAM-BA asks for
+    them. Pages are sent in 128 byte blocks. No supported page size is a
+    whole number of 1K blocks, and padding the last 1K block of a page
+    would spill into the flash latch.
+
+    """
+    def __init__(self, samba):
+        self._modem = XMODEM(samba.xm_getc, samba.xm_putc)
+        self._sendbuf = BytesIO()
+
+    def __call__(self, samba, page_address, data):
+        self._sendbuf.seek(0)
+        self._sendbuf.truncate()
+        self._sendbuf.write(data)
+        self._sendbuf.seek(0)
+        adrstr = hex(page_address)[2:].zfill(8)
+        samba.xm_init_sf(adrstr)
+        if not self._modem.send(self._sendbuf, quiet=True):
+            raise IOError("XMODEM Transfer Failure")
+        samba.xm_finish()
 
 
 def xm_write_page(samba, page_address, data):
-    adrstr = hex(page_address)[2:].zfill(8)
-    samba.xm_init_sf(adrstr)
-    sendbuf = BytesIO(data)
+    XmodemPageWriter(samba)(samba, page_address, data)
+
+
+def xm_read_block(samba, address, size):
+    """ Read size bytes starting at address from the chip using XMODEM """
+    adrstr = hex(address)[2:].zfill(8)
+    samba.xm_init_rf(adrstr, hex(size)[2:].zfill(8))
+    recvbuf = BytesIO()
     modem = XMODEM(samba.xm_getc, samba.xm_putc)
-    if not modem.send(sendbuf, quiet=True):
+    if modem.recv(recvbuf, crc_mode=1, quiet=True) is None:
         raise IOError("XMODEM Transfer Failure")
-    sendbuf.close()
+    samba.xm_finish()
+    data = recvbuf.getvalue()[:size]
+    recvbuf.close()
+    return data
 
 
-def _page_writer(_writer, samba, device, page_address, bin_file):
+def _page_time(samba, device, xmodem=False):
     """
-        Send a single page worth of data from the file to the chip.
-        Returns 1 as long as data remains.
-        Returns 0 when end of file is reached.
+    Estimated time to send one page to the target, in seconds, as used
+    to plan erasing. Only the bytes sent are counted.
     """
-    data = bin_file.read(device.PAGE_SIZE)
-    if len(data) == device.PAGE_SIZE:
-        status = 1
+    if xmodem:
+        # 133 byte blocks, and the S command and EOT around them
+        nbytes = -(-device.PAGE_SIZE // 128) * 133 + 24
     else:
-        if len(data) < device.PAGE_SIZE:
-            if PY2:
-                padding = "\255"
-            else:
-                padding = bytes("\255".encode())
-            data += padding * (device.PAGE_SIZE - len(data))
-        status = 0
-    logger.debug('Sending file chunk : \n {0}CEND'.format(hexlify(data)))
-    _writer(samba, page_address, data)
-    return status
-
-
-def _file_writer(_writer, samba, device, filename,
-                 start_page=0, progress_class=None):
-    stat = 1
-    if device.FullErase:
-        samba.efc_eraseall()
-    page_no = start_page
-    bin_file = open(filename, "rb")
-    num_pages = int((os.fstat(bin_file.fileno())[6] + 128) / 256)
+        # One W command, address and value for each word
+        nbytes = device.PAGE_SIZE // 4 * 20
+    return nbytes * 10.0 / samba.ser.baudrate
+
+
+def _open_journal(samba, device, image):
+    """
+    The WriteJournal for writing image to the chip on samba. The chip is
+    identified by its unique identifier where the EFC can read it, and
+    by its chip ID otherwise.
+    """
+    if device.STUI_CMD:
+        uid = samba.efc_getuid()
+    else:
+        chipid = samba.getchipid()
+        uid = chipid.key if chipid else None
+    return WriteJournal(getattr(samba.ser, 'port', None), uid,
+                        image.digest())
+
+
+def _read_back(samba, device, address, size):
+    """ Read size bytes starting at address from the chip """
+    if device.XmodemRead:
+        return xm_read_block(samba, address, size)
+    words = [samba.read_word(hex(address + i)[2:].zfill(8))
+             for i in range(0, size, 4)]
+    return b''.join(struct.pack('<I', int(w.strip(), 16)) for w in words)
+
+
+def _erase(samba, device, image, page_time, erase='auto', journal=None,
+           resume=False):
+    """
+    Plan how image is to be erased and written, and run the erases the
+    plan needs, see EraseSequence in the erase module. Returns the
+    ErasePlan.
+
+    If resume is True and journal holds an earlier write of the same
+    plan, the erases were already done, and are not done again.
+    Otherwise, journal is started for the plan once erased.
+    """
+    sequence = EraseSequence(device, image, page_time, erase)
+    if journal is not None:
+        if resume and journal.load(sequence.plan.digest()):
+            logger.info("Resuming earlier write from page {0} of {1}"
+                        "".format(journal.done + 1, image.num_pages))
+            return sequence.plan
+        if resume:
+            logger.warning("No earlier write of this image to this chip to "
+                           "resume. Starting over.")
+        journal.discard()
+    erases = sequence.erases
+    if erases:
+        logger.info("Erasing Flash")
+    while erases:
+        ok = all([_run_erase(samba, plane, farg) for plane, farg in erases])
+        erases = sequence.erased(ok)
+    if journal is not None:
+        journal.start(sequence.plan.digest())
+    return sequence.plan
+
+
+def _run_erase(samba, plane, farg):
+    """ Run one erase of an EraseSequence. Returns True if it succeeded. """
+    if farg is None:
+        return samba.efc_eraseall(plane)
+    return samba.efc_erasepages(farg, plane)
+
+
+def _plane_page_number(plane, page_address):
+    """ Page number of the page at page_address within plane """
+    return (page_address - int(plane.FS_ADDRESS, 16)) // plane.PAGE_SIZE
+
+
+def _interleave(planes, pages):
+    """
+    Yield (plane, page address, data) for each of pages, taking pages
+    from each plane in turn, so that the EFC of one plane can program a
+    page while the next page is being sent to another.
+    """
+    queues = [[] for _ in planes]
+    for page_address, data in pages:
+        queues[plane_index(planes, page_address)].append(
+            (page_address, data))
+    for i in range(max(len(queue) for queue in queues)):
+        for plane, queue in zip(planes, queues):
+            if i < len(queue):
+                yield (plane, ) + queue[i]
+
+
+def _split_planes(planes, runs):
+    """
+    Yield (plane, address, data) for each of runs, splitting runs which
+    cross from one plane into the next.
+    """
+    bases = [int(plane.FS_ADDRESS, 16) for plane in planes]
+    for address, data in runs:
+        while data:
+            index = plane_index(planes, address)
+            size = len(data)
+            if index + 1 < len(bases):
+                size = min(size, bases[index + 1] - address)
+            yield planes[index], address, data[:size]
+            address, data = address + size, data[size:]
+
+
+def _file_writer(_writer, samba, device, filename, start_page=0,
+                 progress_class=None, erase='auto', page_time=None,
+                 resume=False):
+    image = load_image(filename, device, start_page)
+    if page_time is None:
+        page_time = _page_time(samba, device)
+    journal = _open_journal(samba, device, image)
+    plan = _erase(samba, device, image, page_time, erase, journal, resume)
+    num_pages = image.num_pages
     if progress_class:
         p = progress_class(max=num_pages)
     else:
         p = None
 
     logger.info("Writing to Flash")
-    while stat:
-        samba.efc_wready()
-        page_address = int(device.FS_ADDRESS, 16) + \
-            (page_no * device.PAGE_SIZE)
-        adrstr = hex(page_address)[2:].zfill(8)
-        logger.debug("Start Address of page {0} : {1}".format(page_no, adrstr))
-        stat = _page_writer(_writer, samba, device, page_address, bin_file)
-        samba.efc_ewp(page_no)
-        logger.debug("Page done : {0}".format(page_no))
-        page_no = page_no + 1
-        if p:
-            p.next(note="Page {0}/{1}".format(page_no, num_pages))
+    start_time = time.time()
+    skipped = 0
+    resumed = 0
+    planes = device.planes()
+    pages = _interleave(planes, image.pages())
+    # Plane -> position of the last page written to it, until its EFC is
+    # next seen ready
+    pending = {}
+    try:
+        for index, (plane, page_address, data) in enumerate(pages):
+            page_no = _plane_page_number(plane, page_address)
+            command = plan.commands.get(page_address)
+            if index < journal.done:
+                if command is None:
+                    skipped = skipped + 1
+                else:
+                    command = None
+                    resumed = resumed + 1
+            elif command is None:
+                logger.debug("Skipping erased page : {0}".format(page_no))
+                skipped = skipped + 1
+            elif index <= journal.issued:
+                # The earlier write may or may not have got to this page
+                samba.efc_wready(plane)
+                if _read_back(samba, device, page_address,
+                              len(data)) == bytes(data):
+                    logger.debug("Page already written : {0}".format(page_no))
+                    command = None
+                    resumed = resumed + 1
+                else:
+                    # It may be partly programmed
+                    command = plane.WPC
+            if command is not None:
+                samba.efc_wready(plane)
+                pending.pop(plane.FS_ADDRESS, None)
+                journal.commit(min(list(pending.values()) + [index]), index)
+                adrstr = hex(page_address)[2:].zfill(8)
+                logger.debug("Start Address of page {0} : {1}"
+                             "".format(page_no, adrstr))
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('Sending page : \n {0}CEND'
+                                 ''.format(hexlify(data)))
+                _writer(samba, page_address, data)
+                samba.efc_ewp(page_no, plane, command)
+                pending[plane.FS_ADDRESS] = index
+                logger.debug("Page done : {0}".format(page_no))
+            if p:
+                p.next(note=_progress_note(index + 1, num_pages, skipped))
+        for plane in planes:
+            samba.efc_wready(plane)
+    except BaseException:
+        # Save how far the write got, to resume from
+        journal.flush()
+        raise
+    journal.finish()
     if p:
         p.finish()
-    logger.info("Writing to Flash Complete")
+    if resumed:
+        logger.info("Resumed, {0} pages already written".format(resumed))
+    _log_write_rate((num_pages - skipped - resumed) * device.PAGE_SIZE,
+                    start_time, skipped)
+
 
+def _progress_note(count, num_pages, skipped):
+    note = "Page {0}/{1}".format(count, num_pages)
+    if skipped:
+        note += ", {0} skipped".format(skipped)
+    return note
 
-def xmodem_sendf(*args, **kwargs):
+
+def _log_write_rate(written, start_time, skipped=0):
+    elapsed = time.time() - start_time
+    logger.info("Writing to Flash Complete. Wrote {0} bytes in {1:.2f} s "
+                "({2:.0f} bytes/s)".format(written, elapsed,
+                                           written / max(elapsed, 1e-6)))
+    if skipped:
+        logger.info("Skipped {0} erased pages".format(skipped))
+
+
+def _command_runs(plan, page_size, address, data):
+    """
+    Split a run of pages into runs which are each written with the same
+    command, as given by plan, leaving out pages which are not written.
+    Yields (address, data, command).
+    """
+    start, command = 0, None
+    for offset in range(0, len(data), page_size):
+        page_command = plan.commands.get(address + offset)
+        if offset and page_command != command:
+            if command:
+                yield address + start, data[start:offset], command
+            start = offset
+        command = page_command
+    if command:
+        yield address + start, data[start:], command
+
+
+def applet_sendf(samba, device, filename, start_page=0,
+                 progress_class=None, xmodem=False, erase='auto',
+                 resume=False):
+    """
+    Function to burn file onto flash using the flash writer applet.
+    Data is staged in SRAM using XMODEM transfers if xmodem is True,
+    and using SAM-BA word writes otherwise.
+
+    Writes using the applet are not journaled, and cannot be resumed.
+    ValueError is raised if resume is True, rather than starting over.
+    """
+    if resume:
+        raise ValueError("Writes using the flash writer applet cannot be "
+                         "resumed.")
+    if xmodem:
+        upload = XmodemPageWriter(samba)
+    else:
+        upload = raw_write_page
+    applet = FlashWriterApplet(samba, device, upload)
+    image = load_image(filename, device, start_page)
+    plan = _erase(samba, device, image, _page_time(samba, device, xmodem),
+                  erase)
+    num_pages = len(plan)
+    skipped = image.num_pages - num_pages
+    if progress_class:
+        p = progress_class(max=num_pages)
+    else:
+        p = None
+
+    applet.load()
+    logger.info("Writing to Flash using the flash writer applet")
+    start_time = time.time()
+    written = 0
+    runs = image.runs(applet.capacity * device.PAGE_SIZE)
+    for plane, run_address, run_data in _split_planes(device.planes(), runs):
+        for address, data, command in _command_runs(
+                plan, device.PAGE_SIZE, run_address, run_data):
+            count = len(data) // device.PAGE_SIZE
+            applet.program(_plane_page_number(plane, address), data, plane,
+                           command)
+            written = written + count
+            if p:
+                p.next(n=count,
+                       note=_progress_note(written, num_pages, skipped))
+    applet.finish()
+    if p:
+        p.finish()
+    _log_write_rate(written * device.PAGE_SIZE, start_time, skipped)
+
+
+def xmodem_sendf(samba, device, *args, **kwargs):
     """ Function to burn file onto flash using XMODEM transfers """
-    return _file_writer(xm_write_page, *args, **kwargs)
+    fmrs = []
+    if device.XMODEM_FMR:
+        # See device errata. Flash mode is restored once writing is done.
+        for plane in device.planes():
+            fmrs.append((plane, samba.efc_readfmr(plane).strip()[2:]))
+            samba.efc_setfmr(device.XMODEM_FMR, plane)
+    kwargs.setdefault('page_time', _page_time(samba, device, xmodem=True))
+    try:
+        return _file_writer(XmodemPageWriter(samba),
+                            samba, device, *args, **kwargs)
+    finally:
+        for plane, fmr in fmrs:
+            samba.efc_setfmr(fmr, plane)
 
 
 def raw_sendf(*args, **kwargs):
@@ -127,59 +396,221 @@ def raw_sendf(*args, **kwargs):
     return _file_writer(raw_write_page, *args, **kwargs)
 
 
-def write(samba, device, filename, progress_class=None):
+def write(samba, device, filename, progress_class=None, xmodem=False,
+          applet=False, skip_erased=False, erase='auto', resume=False):
+    """
+    Write the file to flash. If xmodem is True, data is sent using
+    XMODEM transfers. Otherwise, it is sent using SAM-BA word writes.
+
+    The file may be a raw binary, Intel HEX, Motorola S-record or ELF
+    file. Only the flash pages which hold data are written.
+
+    If applet is True and the device supports it, pages are programmed
+    by the flash writer applet running on the target instead of by the
+    host driving the EFC.
+
+    How the flash is erased is planned according to erase, one of the
+    erase module's ERASE_MODES. By default, the fastest plan which leaves
+    flash outside the image as it was is used. skip_erased is the same
+    as erase='all' : the whole flash is erased first, and pages which are
+    entirely erased in the image are not programmed at all.
+
+    Progress is kept in a journal, see the journal module. If resume is
+    True and an earlier write of the same file to the same chip on the
+    same port did not complete, it is continued from where it stopped.
+    """
     if isinstance(device, str):
         device = get_device(device)
-    enable_xmodem = False
-    if enable_xmodem:
-        # See device errata in 3U4E datasheet
-        _ = samba.efc_readfmr().strip()[2:]
-        samba.efc_setfmr('00000600')
-        xmodem_sendf(samba, device, filename,
-                     progress_class=progress_class)
+    if skip_erased:
+        erase = 'all'
+    image = load_image(filename, device)
+    if applet:
+        if FlashWriterApplet.supported(device):
+            return applet_sendf(samba, device, image,
+                                progress_class=progress_class, xmodem=xmodem,
+                                erase=erase, resume=resume)
+        logger.warning("Flash writer applet not supported on this device.")
+    if xmodem:
+        xmodem_sendf(samba, device, image, progress_class=progress_class,
+                     erase=erase, resume=resume)
     else:
-        raw_sendf(samba, device, filename,
-                  progress_class=progress_class)
+        raw_sendf(samba, device, image, progress_class=progress_class,
+                  erase=erase, resume=resume)
 
 
-def verify(samba, device, filename, start_page=0, progress_class=None):
+def verify(samba, device, filename, start_page=0, progress_class=None,
+           bulk=True, crc=False):
     """
     Verify the contents of flash against the contents of the file.
     Returns the total number of words with errors.
+
+    If bulk is True and the device supports it, flash is read back in
+    large blocks using SAM-BA XMODEM reads. Otherwise, flash is read back
+    one word at a time, except for pages which are entirely erased. These
+    are still read back in blocks where the device supports it.
+
+    If crc is True and the device supports it, CRCs of regions of flash
+    are computed on the target instead, and only regions whose CRC does
+    not match are read back.
+    """
+    image = load_image(filename, device, start_page)
+    if crc:
+        if CRC32Applet.supported(device):
+            return _crc_verify(samba, device, image,
+                               progress_class=progress_class)
+        logger.warning("CRC verification not supported on this device.")
+    if bulk and device.XmodemRead:
+        return _bulk_verify(samba, device, image,
+                            progress_class=progress_class)
+    return _word_verify(samba, device, image,
+                        progress_class=progress_class)
+
+
+def _mismatch_ranges(expected, actual, address):
+    """
+    Compare two blocks word by word. Returns the number of words with
+    errors and a list of [start, end) address ranges which differ.
     """
-    bin_file = open(filename, "rb")
-    len_bytes = os.fstat(bin_file.fileno())[6]
-    address = int(device.FS_ADDRESS, 16) + (start_page * device.PAGE_SIZE)
+    errors = 0
+    ranges = []
+    for i in range(0, len(expected), 4):
+        if expected[i:i+4] == actual[i:i+4]:
+            continue
+        errors = errors + 1
+        end = address + min(i + 4, len(expected))
+        if ranges and ranges[-1][1] == address + i:
+            ranges[-1][1] = end
+        else:
+            ranges.append([address + i, end])
+    return errors, ranges
+
+
+def _verify_block(samba, address, expected):
+    """
+    Read back a block using XMODEM and compare it with expected. Returns
+    the number of words with errors.
+    """
+    actual = xm_read_block(samba, address, len(expected))
+    if actual == expected:
+        logger.debug("Verified Block at {0} - {1} bytes"
+                     "".format(hex(address), len(expected)))
+        return 0
+    errors, ranges = _mismatch_ranges(expected, actual, address)
+    for start, end in ranges:
+        logger.error("\nVerification Failed from {0} to {1}"
+                     "".format(hex(start), hex(end)))
+    return errors
+
+
+def _bulk_verify(samba, device, filename, start_page=0,
+                 progress_class=None, block_size=XM_READ_BLOCK_SIZE):
+    image = load_image(filename, device, start_page)
+    len_bytes = image.nbytes
     errors = 0
     byte_address = 0
     if progress_class:
         p = progress_class(max=len_bytes)
     else:
         p = None
-    logger.info("Verifying Flash")
-    reversed_word = bytearray(bin_file.read(4))
-    word = reversed_word
-    word.reverse()
-    while reversed_word:
+    logger.info("Verifying Flash using XMODEM reads")
+    for address, expected in image.runs(block_size):
+        errors = errors + _verify_block(samba, address, expected)
+        byte_address = byte_address + len(expected)
         if p:
-            p.next(n=4, note="{0}/{1} Bytes".format(byte_address, len_bytes))
-        actual = samba.read_word(hex(address)[2:].zfill(8)).strip()
-        if PY2:
-            expected = hexlify(word)
-        else:
-            expected = word.hex()
-        if not actual.upper()[2:] == expected.upper():
-            logger.error("\nVerification Failed at {0} - {1} {2}"
-                         "".format(hex(address), actual, expected))
-            errors = errors + 1
+            p.next(n=len(expected),
+                   note="{0}/{1} Bytes".format(byte_address, len_bytes))
+    if p:
+        p.finish()
+    logger.info("Verification Complete. Words with Errors : " + str(errors))
+    return errors
+
+
+def _check_word(errors, address, expected, actual):
+    actual = actual.strip()
+    if not actual.upper()[2:] == expected.upper():
+        logger.error("\nVerification Failed at {0} - {1} {2}"
+                     "".format(hex(address), actual, expected))
+        errors[0] = errors[0] + 1
+    else:
+        logger.debug("Verified Word at {0} - {1} {2}"
+                     "".format(hex(address), actual, expected))
+
+
+def _check_words(queue, errors, address, data):
+    """ Queue reads checking each word of data, which is at address """
+    words = struct.unpack('<{0}I'.format(len(data) // 4), data)
+    for i, word in enumerate(words):
+        queue.read_word(hex(address + 4 * i)[2:].zfill(8),
+                        callback=partial(_check_word, errors, address + 4 * i,
+                                         '{0:08x}'.format(word)))
+
+
+def _word_verify(samba, device, filename, start_page=0, progress_class=None):
+    image = load_image(filename, device, start_page)
+    len_bytes = image.nbytes
+    errors = [0]
+    byte_address = 0
+    if progress_class:
+        p = progress_class(max=len_bytes)
+    else:
+        p = None
+    logger.info("Verifying Flash")
+    with samba.command_queue() as queue:
+        for address, data in image.pages():
+            if device.XmodemRead and image.is_erased(data):
+                continue
+            _check_words(queue, errors, address, data)
+            byte_address = byte_address + len(data)
+            if p:
+                p.next(n=len(data),
+                       note="{0}/{1} Bytes".format(byte_address, len_bytes))
+    if device.XmodemRead:
+        for address, expected in image.runs(XM_READ_BLOCK_SIZE, erased=True):
+            errors[0] = errors[0] + _verify_block(samba, address, expected)
+            byte_address = byte_address + len(expected)
+            if p:
+                p.next(n=len(expected),
+                       note="{0}/{1} Bytes".format(byte_address, len_bytes))
+    if p:
+        p.finish()
+    logger.info("Verification Complete. Words with Errors : " +
+                str(errors[0]))
+    return errors[0]
+
+
+def _crc_verify(samba, device, filename, start_page=0, progress_class=None,
+                region_size=CRC_REGION_SIZE):
+    image = load_image(filename, device, start_page)
+    applet = CRC32Applet(samba, device)
+    len_bytes = image.nbytes
+    errors = 0
+    byte_address = 0
+    if progress_class:
+        p = progress_class(max=len_bytes)
+    else:
+        p = None
+    logger.info("Verifying Flash using CRCs computed on the target")
+    applet.load()
+    for address, expected in image.runs(region_size):
+        if applet.crc(address, len(expected)) == \
+                zlib.crc32(expected) & 0xFFFFFFFF:
+            logger.debug("Verified CRC of {0} bytes at {1}"
+                         "".format(len(expected), hex(address)))
         else:
-            logger.debug("Verified Word at {0} - {1} {2}"
-                         "".format(hex(address), actual, expected))
-        address = address + 4
-        reversed_word = bytearray(bin_file.read(4))
-        word = reversed_word
-        word.reverse()
-        byte_address = byte_address + 4
+            # Read the region back to find the words which differ
+            logger.warning("CRC mismatch in {0} bytes at {1}"
+                           "".format(len(expected), hex(address)))
+            if device.XmodemRead:
+                errors = errors + _verify_block(samba, address, expected)
+            else:
+                region_errors = [0]
+                with samba.command_queue() as queue:
+                    _check_words(queue, region_errors, address, expected)
+                errors = errors + region_errors[0]
+        byte_address = byte_address + len(expected)
+        if p:
+            p.next(n=len(expected),
+                   note="{0}/{1} Bytes".format(byte_address, len_bytes))
     if p:
         p.finish()
     logger.info("Verification Complete. Words with Errors : " + str(errors))
@@ -195,6 +626,69 @@ def set_boot(samba, device):
             samba.efc_cleargpnvm(i)
 
 
+def program(samba, device, filename, write_flash=True, verify_flash=True,
+            boot=False, progress_class=None, xmodem=False, applet=False,
+            bulk=True, skip_erased=False, crc=False, erase='auto',
+            resume=False):
+    """
+    Write and verify the file, and set the device to boot from flash if
+    boot is True and verification passed. Returns the number of words
+    with verification errors, or None if verification was not performed.
+    """
+    image = load_image(filename, device)
+    if write_flash:
+        write(samba, device, image, progress_class=progress_class,
+              xmodem=xmodem, applet=applet, skip_erased=skip_erased,
+              erase=erase, resume=resume)
+    errors = None
+    if verify_flash:
+        errors = verify(samba, device, image,
+                        progress_class=progress_class, bulk=bulk, crc=crc)
+    if not errors and boot:
+        set_boot(samba, device)
+    else:
+        logger.warning("Not setting GPNVM bit.")
+        logger.warning("Invoke with -g to have that happen.")
+    return errors
+
+
+def identify_device(samba):
+    """
+    The device definition for the chip on samba, which is also set on
+    the connection.
+
+    If the connection was not given a device, the chip ID is read and
+    the device is looked up by it. If the device's EFC can describe its
+    flash, the page size, planes and lock regions are taken from the
+    flash descriptor rather than the device definition. The descriptor
+    is only read the first time a part is seen, and its geometry saved
+    by chip ID after that.
+    """
+    device = samba.device
+    chipid = None
+    if device is None:
+        chipid = samba.getchipid()
+        if chipid is None:
+            raise UnknownDeviceError("Could not read the chip ID. Specify "
+                                     "the device.")
+        device = registry.find(chipid)
+        logger.info("Detected {0}".format(device.__name__))
+        samba.set_device(device)
+    if not device.GD_CMD or device.FLASH_SIZE:
+        return device
+    if chipid is None:
+        chipid = samba.getchipid()
+    geometry = registry.geometry(chipid) if chipid.valid else None
+    if geometry is None:
+        logger.debug("Reading flash descriptor")
+        geometry = samba.efc_getflashdescriptor().geometry()
+        if chipid.valid:
+            registry.save_geometry(chipid, geometry)
+    device = registry.with_geometry(device, geometry)
+    samba.set_device(device)
+    return device
+
+
 def read_chipid(*args, **kwargs):
     samba = kwargs.pop('samba', None)
     if not samba:
@@ -206,6 +700,7 @@ def read_flash_descriptors(*args, **kwargs):
     samba = kwargs.pop('samba', None)
     if not samba:
         samba = SamBAConnection(*args, **kwargs)
+    identify_device(samba)
     return samba.efc_getflashdescriptor()
 
 
@@ -213,63 +708,16 @@ def read_unique_identifier(*args, **kwargs):
     samba = kwargs.pop('samba', None)
     if not samba:
         samba = SamBAConnection(*args, **kwargs)
+    identify_device(samba)
     return samba.efc_getuid()
 
 
-def _get_device_folder():
-    devices_folder_candidates = [
-        os.path.join(appdirs.user_config_dir('pysamloader',
-                                             appauthor='Quazar Technologies',
-                                             roaming=True),
-                     'devices'),
-        os.path.join(os.path.split(__file__)[0], 'devices')
-    ]
-    for candidate in devices_folder_candidates:
-        if os.path.exists(candidate):
-            return candidate
-    else:
-        raise FileNotFoundError("Devices folder not found!")
-
-
 def get_device(name):
-    # See : https://stackoverflow.com/a/67692/1934174
-    devices_folder = _get_device_folder()
-    if sys.version_info.major == 3 and sys.version_info.minor >= 5:
-        spec = importlib.util.spec_from_file_location(
-            'pysamloader.devices.{}'.format(name),
-            os.path.join(devices_folder, '{0}.py'.format(name))
-        )
-        dev_mod = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(dev_mod)
-    elif sys.version_info.major == 3 and 3 <= sys.version_info.minor <= 4:
-        dev_mod = importlib.machinery.SourceFileLoader(
-            'pysamloader.devices.{}'.format(name),
-            os.path.join(devices_folder, '{0}.py'.format(name))
-        ).load_module()
-    else:
-        dev_mod = imp.load_source(
-            'pysamloader.devices.{}'.format(name),
-            os.path.join(devices_folder, '{0}.py'.format(name))
-        )
-    return getattr(dev_mod, name)
+    return registry.get(name)
 
 
 def get_supported_devices():
-    devices_folder = _get_device_folder()
-
-    candidates = [f for f in os.listdir(devices_folder)
-                  if os.path.isfile(os.path.join(devices_folder, f))
-                  and not f.startswith('_')]
-    _supported_devices = []
-    for candidate in candidates:
-        name, ext = os.path.splitext(candidate)
-        if ext == '.py':
-            try:
-                _ = get_device(name)
-                _supported_devices.append((name, "SAM-BA UART"))
-            except ImportError:
-                continue
-    return _supported_devices
+    return [(name, INTERFACE) for name in registry.names()]
 
 
-supported_devices = get_supported_devices()
+supported_devices = SupportedDevices(registry)
@@ -0,0 +1,306 @@
+# Copyright (c) 2019 Chintalagiri Shashank
+#
+# This file is part of pysamloader.
+
+# pysamloader is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pysamloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysamloader.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Registry of the device definitions pysamloader knows about.
+
+Device definitions are modules in a devices folder, each defining a
+SAMDevice subclass named after the module. The folder used is the one
+in the user's config directory if it exists, and the one installed with
+pysamloader otherwise.
+
+Nothing is loaded until it is needed. The names of the devices in the
+folder are kept in an index file in the user's config directory, which
+is rebuilt only when files in the folder are added, removed or
+modified. Device modules are loaded when first asked for, and are then
+kept for the life of the process.
+
+Frozen builds, which have no devices folder on disk, use the device
+modules bundled into the pysamloader.devices package instead.
+
+The index also holds the chip ID fields (architecture and flash size)
+each device declares, so that a device can be found from its chip ID.
+The flash geometry read from the EFC of each part seen is kept in
+another file in the same directory, keyed by chip ID.
+"""
+
+import os
+import sys
+import json
+import pkgutil
+import logging
+import importlib
+import threading
+
+import appdirs
+
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
+
+from . import log
+
+if sys.version_info.major == 3 and sys.version_info.minor >= 5:
+    import importlib.util
+elif sys.version_info.major == 3 and 3 <= sys.version_info.minor <= 4:
+    import importlib.machinery
+else:
+    import imp
+
+logger = logging.getLogger('registry')
+log.loggers.append(logger)
+
+
+CONFIG_DIR = appdirs.user_config_dir('pysamloader',
+                                     appauthor='Quazar Technologies',
+                                     roaming=True)
+INDEX_FILE = os.path.join(CONFIG_DIR, 'device_index.json')
+GEOMETRY_FILE = os.path.join(CONFIG_DIR, 'device_geometry.json')
+
+INTERFACE = "SAM-BA UART"
+
+
+def _get_device_folder():
+    devices_folder_candidates = [
+        os.path.join(CONFIG_DIR, 'devices'),
+        os.path.join(os.path.split(__file__)[0], 'devices')
+    ]
+    for candidate in devices_folder_candidates:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def _load_source(name, path):
+    # See : https://stackoverflow.com/a/67692/1934174
+    module_name = 'pysamloader.devices.{}'.format(name)
+    if sys.version_info.major == 3 and sys.version_info.minor >= 5:
+        spec = importlib.util.spec_from_file_location(module_name, path)
+        dev_mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(dev_mod)
+    elif sys.version_info.major == 3 and 3 <= sys.version_info.minor <= 4:
+        dev_mod = importlib.machinery.SourceFileLoader(
+            module_name, path).load_module()
+    else:
+        dev_mod = imp.load_source(module_name, path)
+    return dev_mod
+
+
+class UnknownDeviceError(ImportError):
+    pass
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (EnvironmentError, ValueError):
+        return {}
+
+
+def _write_json(path, content):
+    try:
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(path, 'w') as f:
+            json.dump(content, f)
+    except EnvironmentError as e:
+        # These files are only caches. Without them, whatever they hold
+        # is just found out again next time.
+        logger.debug("Could not write {0} : {1}".format(path, e))
+
+
+def _identity(device):
+    """ The chip ID fields which identify device, if it declares them """
+    if device.CHIPID_ARCH and device.CHIPID_NVPSIZ:
+        return [device.CHIPID_ARCH, device.CHIPID_NVPSIZ]
+    return None
+
+
+class DeviceRegistry(object):
+    def __init__(self, folder=None, index_file=INDEX_FILE,
+                 geometry_file=GEOMETRY_FILE):
+        self._folder = folder
+        self._index_file = index_file
+        self._geometry_file = geometry_file
+        self._index = None
+        self._geometries = None
+        self._devices = {}
+        self._derived = {}
+        self._lock = threading.RLock()
+
+    @property
+    def folder(self):
+        if self._folder is None:
+            self._folder = _get_device_folder()
+        return self._folder
+
+    def get(self, name):
+        """
+        The device class for name. Raises UnknownDeviceError, which is an
+        ImportError, if there is none.
+        """
+        with self._lock:
+            if name not in self._devices:
+                self._devices[name] = self._load(name)
+            return self._devices[name]
+
+    def _load(self, name):
+        if self.folder is None:
+            try:
+                dev_mod = importlib.import_module(
+                    'pysamloader.devices.{0}'.format(name))
+            except ImportError:
+                raise UnknownDeviceError("No device definition for {0}"
+                                         "".format(name))
+        else:
+            path = os.path.join(self.folder, '{0}.py'.format(name))
+            if not os.path.isfile(path):
+                raise UnknownDeviceError("No device definition for {0}"
+                                         "".format(name))
+            dev_mod = _load_source(name, path)
+        try:
+            return getattr(dev_mod, name)
+        except AttributeError:
+            raise UnknownDeviceError("{0} does not define a device named "
+                                     "{0}".format(name))
+
+    def names(self):
+        """ Names of the supported devices, in alphabetical order """
+        return sorted(self._get_index())
+
+    def find(self, chipid):
+        """
+        The device class identified by chipid, a SamChipID. Raises
+        UnknownDeviceError if no supported device matches it.
+        """
+        identity = [chipid.arch[0], chipid.nvpsiz[0]]
+        for name, device_identity in sorted(self._get_index().items()):
+            if device_identity == identity:
+                return self.get(name)
+        raise UnknownDeviceError("No supported device matches chip ID {0} "
+                                 "({1}, {2})".format(chipid.key, *identity))
+
+    def _get_index(self):
+        with self._lock:
+            if self._index is None:
+                self._index = self._build_index()
+            return self._index
+
+    def _build_index(self):
+        # Device name -> the chip ID fields which identify it
+        if self.folder is None:
+            from . import devices
+            index = {}
+            for m in pkgutil.iter_modules(devices.__path__):
+                if not m[1].startswith('_'):
+                    index[m[1]] = _identity(self.get(m[1]))
+            return index
+        state = self._folder_state()
+        cached = _read_json(self._index_file)
+        if cached.get('folder') == self.folder and \
+                cached.get('files') == state and 'devices' in cached:
+            return cached['devices']
+        logger.debug("Rebuilding device index for {0}".format(self.folder))
+        if cached.get('folder') == self.folder:
+            known = cached.get('devices', {})
+            previous = cached.get('files', {})
+        else:
+            known, previous = {}, {}
+        index = {}
+        for filename in sorted(state):
+            name = os.path.splitext(filename)[0]
+            if previous.get(filename) == state[filename]:
+                # Unchanged since the index was built, so it need not be
+                # loaded again to know whether it defines a device.
+                if name in known:
+                    index[name] = known[name]
+                continue
+            try:
+                index[name] = _identity(self.get(name))
+            except ImportError:
+                continue
+        _write_json(self._index_file, {'folder': self.folder,
+                                       'files': state, 'devices': index})
+        return index
+
+    def _folder_state(self):
+        # Modification times of the candidate modules in the folder. Any
+        # change to these invalidates the index.
+        state = {}
+        for filename in os.listdir(self.folder):
+            path = os.path.join(self.folder, filename)
+            if filename.endswith('.py') and not filename.startswith('_') \
+                    and os.path.isfile(path):
+                state[filename] = os.path.getmtime(path)
+        return state
+
+    def geometry(self, chipid):
+        """
+        The flash geometry saved for the part with chipid, as given to
+        save_geometry(), or None.
+        """
+        with self._lock:
+            if self._geometries is None:
+                self._geometries = _read_json(self._geometry_file)
+            return self._geometries.get(chipid.key)
+
+    def save_geometry(self, chipid, geometry):
+        """
+        Save the flash geometry of the part with chipid, as returned by
+        EFCFlashDescriptor.geometry(), so that the descriptor need not be
+        read the next time the part is seen.
+        """
+        with self._lock:
+            self.geometry(chipid)
+            self._geometries[chipid.key] = geometry
+            _write_json(self._geometry_file, self._geometries)
+
+    def with_geometry(self, device, geometry):
+        """
+        device with the flash geometry given. The same class is returned
+        for the same device and geometry, so the result can be used as a
+        cache key.
+        """
+        key = (device, json.dumps(geometry, sort_keys=True))
+        with self._lock:
+            if key not in self._derived:
+                self._derived[key] = device.with_geometry(geometry)
+            return self._derived[key]
+
+
+class SupportedDevices(Sequence):
+    """
+    The supported devices, as a sequence of (name, interface) pairs,
+    which is read from registry only when first used.
+    """
+    def __init__(self, registry):
+        self._registry = registry
+
+    def _devices(self):
+        return [(name, INTERFACE) for name in self._registry.names()]
+
+    def __getitem__(self, index):
+        return self._devices()[index]
+
+    def __len__(self):
+        return len(self._registry.names())
+
+
+registry = DeviceRegistry()
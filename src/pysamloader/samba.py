@@ -15,11 +15,17 @@
 # You should have received a copy of the GNU General Public License
 # along with pysamloader.  If not, see <http://www.gnu.org/licenses/>.
 
+import struct
 import logging
+from collections import deque
 from time import sleep
-from serial import Serial
+from time import time
+from serial import SerialException
 
 from .samdevice import SAMDevice
+from .stats import ConnectionStats
+from .transport import open_transport
+from .transport import fixed_baud
 from .chipid import SamChipID
 from .efcdescriptor import EFCFlashDescriptor
 from . import log
@@ -33,46 +39,461 @@ class SamBAConnectionError(Exception):
         self.msg = msg
 
 
+class SamBAResponseBuffer(object):
+    """
+    Receive buffer for the byte stream coming from SAM-BA.
+
+    Bytes are fed in as they are read from the port, in whatever chunks
+    happen to be available. Responses are split off the front of the
+    buffer at each prompt, and any bytes which follow a prompt are
+    retained for the next response.
+
+    """
+    def __init__(self, prompt=b'>'):
+        self.prompt = prompt
+        self._buf = bytearray()
+        self._scanned = 0
+
+    def __len__(self):
+        return len(self._buf)
+
+    def feed(self, data):
+        self._buf += data
+
+    def pop_response(self):
+        """
+        Remove and return the first complete response, excluding its
+        prompt, or None if no complete response is available yet.
+
+        """
+        idx = self._buf.find(self.prompt, self._scanned)
+        if idx < 0:
+            self._scanned = len(self._buf)
+            return None
+        data = bytes(self._buf[:idx])
+        del self._buf[:idx + len(self.prompt)]
+        self._scanned = 0
+        return data
+
+    def take(self, size):
+        """ Remove and return upto size bytes from the buffer """
+        data = bytes(self._buf[:size])
+        del self._buf[:size]
+        self._scanned = 0
+        return data
+
+    def clear(self):
+        del self._buf[:]
+        self._scanned = 0
+
+
+class SamBAWriteEncoder(object):
+    """
+    Encodes a block of data into the SAM-BA W commands which write it,
+    in a single pass and as a single buffer. Every command is exactly
+    COMMAND_SIZE bytes long, so the buffer can be split between commands
+    without parsing it.
+
+    The struct and format string for each block length are built once
+    and reused for every block of that length.
+
+    """
+    COMMAND_SIZE = len('W00000000,00000000#')
+
+    def __init__(self):
+        self._formats = {}
+
+    def encode(self, address, data):
+        """
+        Returns the commands writing data to address, and the number of
+        commands. A partial final word is padded with zeros.
+        """
+        if len(data) % 4:
+            data = bytes(data) + b'\0' * (4 - len(data) % 4)
+        nwords = len(data) // 4
+        fmt = self._formats.get(nwords)
+        if fmt is None:
+            fmt = (struct.Struct('<{0}I'.format(nwords)),
+                   'W%08x,%08x#' * nwords)
+            self._formats[nwords] = fmt
+        args = [0] * (2 * nwords)
+        args[0::2] = range(address, address + 4 * nwords, 4)
+        args[1::2] = fmt[0].unpack(data)
+        return (fmt[1] % tuple(args)).encode('ascii'), nwords
+
+
+_write_encoder = SamBAWriteEncoder()
+
+
+# Sizes of the values returned by the o, h and w read commands in binary
+# mode, and the formats used to unpack them.
+_value_formats = {1: '<B', 2: '<H', 4: '<I'}
+
+
+def _format_value(data):
+    """
+    Format a value read in binary mode the way SAM-BA prints it in
+    terminal mode, so callers see the same responses in either mode.
+    """
+    value, = struct.unpack(_value_formats[len(data)], data)
+    return '0x{0:0{1}x}'.format(value, 2 * len(data))
+
+
+class SamBACommand(object):
+    """ A command sent through a SamBACommandQueue, and its response """
+    def __init__(self, msg, callback=None, size=0):
+        self.msg = msg
+        self.callback = callback
+        self.size = size
+        self.response = None
+        self.sent = None
+
+
+class SamBACommandQueue(object):
+    """
+    Pipeline for bursts of independent commands on a SamBAConnection.
+
+    Upto window commands are kept in flight at a time. SAM-BA answers
+    commands strictly in order, so each response received is matched to
+    the oldest outstanding command. In binary mode, writes have no
+    response at all, and only reads are kept in flight. Responses are
+    stored on the SamBACommand returned by submit(), and are also handed
+    to the command's callback, if one is provided.
+
+    Use as a context manager, which waits for all outstanding responses
+    on exit. If an exception occurs while commands are in flight, the
+    connection is recovered so stale responses do not leak into later
+    commands.
+
+    """
+    def __init__(self, samba, window):
+        if window < 1:
+            raise ValueError("The command window must be at least 1, "
+                             "not {0}".format(window))
+        self._samba = samba
+        self.window = window
+        self._inflight = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.drain()
+        else:
+            self._inflight.clear()
+            self._samba.recover()
+        return False
+
+    def submit(self, msg, callback=None, size=0):
+        """
+        Send msg. size is the length of its response in binary mode,
+        which is 0 for commands which do not respond in that mode.
+        """
+        command = SamBACommand(msg, callback, size)
+        if not self._samba.terminal and not size:
+            self._samba.write_message(msg)
+            command.response = ''
+            if callback:
+                callback(command.response)
+            return command
+        while len(self._inflight) >= self.window:
+            self._complete()
+        command.sent = time()
+        self._samba.write_message(msg)
+        self._inflight.append(command)
+        return command
+
+    def _complete(self):
+        command = self._inflight.popleft()
+        command.response = self._samba.retrieve_response(size=command.size)
+        kind = command.msg[:1] if command.msg else 'W'
+        if not self._samba.terminal:
+            self._samba.account(kind, command.size, command.sent)
+            command.response = _format_value(command.response)
+        else:
+            self._samba.account(kind, len(command.response) + 1,
+                                command.sent)
+        if command.callback:
+            command.callback(command.response)
+
+    def drain(self):
+        """ Wait for the responses to all outstanding commands """
+        while self._inflight:
+            self._complete()
+
+    def submit_encoded(self, data, count, callback=None):
+        """
+        Send count commands of equal length, already encoded back to back
+        into data. Commands are written in batches as room in the window
+        allows, rather than one at a time. A single SamBACommand, which is
+        returned, is shared by all the commands in the batch.
+        """
+        size = len(data) // count
+        view = memoryview(data)
+        command = SamBACommand(None, callback)
+        stats = self._samba.stats
+        if stats is not None:
+            stats.sent('W', len(data), count)
+        if not self._samba.terminal:
+            self._samba.write_encoded(view)
+            command.response = ''
+            if callback:
+                callback(command.response)
+            return command
+        sent = 0
+        while sent < count:
+            if len(self._inflight) >= self.window:
+                while len(self._inflight) > self.window // 2:
+                    self._complete()
+            n = min(count - sent, self.window - len(self._inflight))
+            command.sent = time()
+            self._samba.write_encoded(view[sent * size:(sent + n) * size])
+            self._inflight.extend([command] * n)
+            sent = sent + n
+        return command
+
+    def write_word(self, address, contents, callback=None):
+        return self.submit("W{0},{1}#".format(address, contents), callback)
+
+    def write_block(self, address, data, callback=None):
+        """ Write a block of data, a word at a time, starting at address """
+        return self.submit_encoded(*_write_encoder.encode(address, data),
+                                   callback=callback)
+
+    def read_word(self, address, callback=None):
+        return self.submit("w{0},#".format(address), callback, size=4)
+
+    def efc_readfrr(self, callback=None):
+        return self.read_word(self._samba._device.EFC_FRR, callback)
+
+
 class SamBAConnection(object):
 
-    ser = Serial()
+    # Default number of commands a SamBACommandQueue keeps in flight.
+    PIPELINE_WINDOW = 8
+
+    # Time allowed for SAM-BA to start responding, in seconds. The time
+    # taken by the response itself on the wire is added to this based on
+    # the baud rate.
+    RESPONSE_LATENCY = 0.1
+
+    # Number of probes the fast handshake sends before giving up, and
+    # the time the line must stay quiet after a prompt, in seconds.
+    CONNECT_RETRIES = 4
+    CONNECT_QUIET_TIME = 0.02
+
+    # Where the chip ID registers may be, if the device is not known. The
+    # word after the reset vector tells ARM7 parts, where it is a branch
+    # instruction, from Cortex-M parts, where it is the reset handler's
+    # address.
+    CHIPID_ARM7 = [('FFFFF240', 'FFFFF244')]
+    CHIPID_CORTEXM = [('400E0740', '400E0744'), ('400E0940', '400E0944')]
+
+    def __init__(self, port='/dev/ttyUSB1', baud=115200, device=None,
+                 window=None, slow_connect=False, terminal=False,
+                 link_baud=None, stats=False):
+        """
+        Opens the serial port for the SAM-BA connection. port may also
+        be a pyserial URL, such as socket://host:port, or an open
+        transport object. See the transport module.
 
-    def __init__(self, port='/dev/ttyUSB1', baud=115200, device=None):
-        """ Opens the serial port for the SAM-BA connection """
-        self.ser.baudrate = baud
-        self.ser.port = port
-        self.ser.timeout = 1
+        SAM-BA is always reached at baud. If link_baud is given, the baud
+        rate is then changed to it with set_baud(), staying at baud if
+        that does not work out.
+
+        The monitor is switched to binary mode once connected, where it
+        neither echoes commands nor decorates its responses. If terminal
+        is True, it is left in terminal mode instead, which is easier to
+        follow in a debug log or on a serial sniffer.
+
+        If stats is True, commands are accounted for in a ConnectionStats
+        on the stats attribute. See the stats module.
+
+        """
+        self._rx = SamBAResponseBuffer()
+        self.stats = ConnectionStats() if stats else None
+        self._xm = None
+        self.terminal = True
+        self.version = None
+        # Estimated time at which everything written so far will have
+        # left the wire
+        self._tx_done = 0
+        self.window = self.PIPELINE_WINDOW if window is None else window
         try:
-            self.ser.open()
+            self.ser = open_transport(port, baud)
+            self.ser.timeout = self.response_timeout()
         except:  # noqa
             raise SamBAConnectionError(
                 "Unable to open serial port.\n\
                 Check your connections and try again.")
+        self.set_device(device)
+        if self.ser.is_open:
+            self.make_connection(auto_baud=self._device.AutoBaud,
+                                 slow=slow_connect)
+            if slow_connect:
+                sleep(1)
+            if link_baud and link_baud != baud:
+                self.set_baud(link_baud)
+            if not terminal:
+                self.set_binary()
+
+    def set_device(self, device):
+        """
+        Use the device definition device, a SAMDevice subclass, for the
+        rest of the connection. With None, device specific commands are
+        unavailable until a device is set, see identify_device().
+        """
+        self.device = device
         if not device:
             self._device = SAMDevice()
         else:
             self._device = device()
-        if self.ser.isOpen():
-            self.make_connection(auto_baud=self._device.AutoBaud)
-            sleep(1)
 
-    def retrieve_response(self):
-        """ Read a response from SAM-BA, delimited by > """
-        char = ''
-        data = ''
-        while char != '>':
-            data += char
-            char = self.ser.read(1).decode()
-            if not char:
+    def response_timeout(self, nbytes=64):
+        """ Time to wait for a response of upto nbytes at the current baud """
+        return self.RESPONSE_LATENCY + (nbytes * 10.0) / self.ser.baudrate
+
+    def _receive(self, size):
+        """
+        Pull whatever the port has waiting, or at least one byte, into the
+        receive buffer. Returns the number of bytes received.
+
+        """
+        chunk = self.ser.read(max(self.ser.in_waiting, size))
+        self._rx.feed(chunk)
+        return len(chunk)
+
+    def _sent(self, nbytes):
+        """ Account for nbytes handed to the port for transmission """
+        self._tx_done = max(self._tx_done, time()) + \
+            (nbytes * 10.0) / self.ser.baudrate
+
+    def _deadline(self, timeout):
+        """
+        Deadline for a response, allowing timeout once whatever is still
+        queued for transmission has been sent. In binary mode, writes are
+        not throttled by responses, so a page or more of commands can be
+        waiting in the port ahead of a read.
+        """
+        return max(time(), self._tx_done) + timeout
+
+    def _read(self, size, timeout=None):
+        """ Read upto size bytes, consuming buffered bytes first """
+        if timeout is None:
+            timeout = self.response_timeout(size)
+        deadline = self._deadline(timeout)
+        while len(self._rx) < size:
+            if not self._receive(size - len(self._rx)) and time() > deadline:
+                break
+        return self._rx.take(size)
+
+    def retrieve_response(self, timeout=None, size=None):
+        """
+        Read a response from SAM-BA. In terminal mode, responses are
+        delimited by >, and are returned as strings. In binary mode, they
+        are size bytes long, and are returned as bytes.
+
+        """
+        if timeout is None:
+            timeout = self.response_timeout()
+        if not self.terminal:
+            data = self._read(size, timeout=timeout)
+            if len(data) < size:
+                self._timed_out()
                 self.ser.close()
                 raise SamBAConnectionError(
                     "Read byte timed out on SAM-BA. Check your connections "
                     "and device configuration and retry.")
+            return data
+        data = self._pop_response(self._deadline(timeout))
+        if data is None:
+            self._timed_out()
+            self.ser.close()
+            raise SamBAConnectionError(
+                "Read byte timed out on SAM-BA. Check your connections "
+                "and device configuration and retry.")
+        data = data.decode('latin-1')
         logger.debug("Got response : {0}".format(data.strip()))
         return data
 
-    def make_connection(self, auto_baud=False):
-        """ Test connection to SAM-BA by reading its version """
+    def account(self, kind, nbytes, start):
+        """
+        Account for a response of nbytes to a command of type kind sent
+        at start, if statistics are being kept.
+        """
+        if self.stats is not None:
+            self.stats.received(kind, nbytes, time() - start)
+
+    def _timed_out(self):
+        if self.stats is not None:
+            self.stats.timeout()
+
+    def _pop_response(self, deadline):
+        """ Wait for a terminal mode response, or None after deadline """
+        data = self._rx.pop_response()
+        while data is None:
+            if not self._receive(1) and time() > deadline:
+                return None
+            data = self._rx.pop_response()
+        return data
+
+    def _await_quiet_prompt(self):
+        """
+        Drain the port until it has been quiet for CONNECT_QUIET_TIME.
+        Returns True if the last byte received before the line went quiet
+        was a prompt.
+
+        """
+        self._rx.clear()
+        timeout = self.ser.timeout
+        quiet = self.CONNECT_QUIET_TIME + self.response_timeout(2) - \
+            self.RESPONSE_LATENCY
+        prompt = False
+        deadline = time() + self.response_timeout()
+        try:
+            while True:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return prompt
+                self.ser.timeout = remaining
+                data = self.ser.read(max(self.ser.in_waiting, 1))
+                if data:
+                    prompt = data.endswith(b'>')
+                    deadline = time() + quiet
+        finally:
+            self.ser.timeout = timeout
+
+    def fast_connect(self):
+        """
+        Find the SAM-BA prompt without any fixed delays.
+
+        Sends a bare '#', which SAM-BA answers with a prompt in terminal
+        mode, and then T# in case the monitor was left in binary mode.
+        Whatever the monitor sends is drained until a prompt is followed
+        by a quiet line. Returns False if that does not happen within
+        CONNECT_RETRIES probes.
+
+        """
+        for attempt in range(self.CONNECT_RETRIES):
+            probe = "T#" if attempt % 2 else "#"
+            logger.debug("Probing for SAM-BA prompt with {0}".format(probe))
+            self.ser.write(probe.encode())
+            if self.stats is not None:
+                self.stats.sent(probe[0], len(probe))
+            if self._await_quiet_prompt():
+                return True
+        return False
+
+    def make_connection(self, auto_baud=False, slow=False):
+        """
+        Test connection to SAM-BA by reading its version.
+
+        The prompt is found using fast_connect(), unless slow is True or
+        the fast handshake fails, in which case the original fixed delays
+        are used instead.
+
+        """
         logger.debug("Connecting to SAM-BA on {0} at {1}".format(
             self.ser.port, self.ser.baudrate))
         if auto_baud is True:
@@ -84,37 +505,187 @@ class SamBAConnection(object):
                 self.ser.write('\x80')
                 self.ser.write('#')
                 sleep(0.001)
-                resp = self.ser.read(1).decode()
+                resp = self._read(1).decode('latin-1')
                 if resp == '>':
                     status = 1
                     logger.info("SAM-BA Auto-Baud Successful")
         self.flush_all()
-        self.ser.read(22).decode()
-        sleep(1)
+        if not slow and not self.fast_connect():
+            logger.warning("No response to SAM-BA probes. "
+                           "Falling back to slow connect.")
+            slow = True
+        if slow:
+            self._read(22, timeout=1)
+            sleep(1)
+        start = time()
         self.write_message("V#")
-        sleep(0.01)
+        if slow:
+            sleep(0.01)
         resp = self.retrieve_response()
+        self.account('V', len(resp) + 1, start)
         logger.info("SAM-BA Version : ")
         logger.info(resp.strip())
         if resp:
+            self.version = resp.strip()
             return
         else:
             self.ser.close()
             raise SamBAConnectionError("SAM-BA did not respond to V#")
 
+    def set_binary(self):
+        """ Switch SAM-BA to binary mode with N# """
+        logger.debug("Switching SAM-BA to binary mode")
+        start = time()
+        self.write_message("N#")
+        self.account('N', len(self._read(2)), start)
+        self.terminal = False
+
+    def set_terminal(self):
+        """ Switch SAM-BA to terminal mode with T# """
+        logger.debug("Switching SAM-BA to terminal mode")
+        start = time()
+        self.write_message("T#")
+        self.terminal = True
+        self.account('T', len(self.retrieve_response()) + 1, start)
+
+    def resync(self):
+        """
+        Find the prompt again, as fast_connect() does, and restore the
+        mode the connection was in. Returns False if SAM-BA does not
+        respond.
+
+        """
+        binary = not self.terminal
+        self.terminal = True
+        if not self.fast_connect():
+            return False
+        if binary:
+            self.set_binary()
+        return True
+
+    def set_baud(self, baud):
+        """
+        Change the baud rate of the link to SAM-BA, by reprogramming the
+        baud rate generator of the UART it runs on and then switching the
+        serial port to match. The new rate is confirmed by reading back
+        the SAM-BA version.
+
+        Returns True if the link is now running at baud. Otherwise, the
+        link is returned to its previous rate and False is returned.
+        SamBAConnectionError is raised if SAM-BA cannot be found again at
+        either rate.
+
+        """
+        device = self._device
+        if fixed_baud(self.ser):
+            logger.warning("The baud rate cannot be changed over this "
+                           "transport. Staying at {0}."
+                           "".format(self.ser.baudrate))
+            return False
+        cd = device.baud_divisor(baud)
+        if cd is None:
+            logger.warning("Cannot run the {0} UART at {1} baud. Staying at "
+                           "{2}.".format(type(device).__name__, baud,
+                                         self.ser.baudrate))
+            return False
+        old_baud = self.ser.baudrate
+        old_cd = int(self.read_word(device.UART_BRGR).strip(), 16)
+        if old_cd != device.baud_divisor(old_baud):
+            # The clock SAM-BA runs from is not the one the device
+            # definition expects, so the new divisor cannot be trusted.
+            logger.warning("Unexpected UART divisor {0} at {1} baud. Staying "
+                           "at {1}.".format(old_cd, old_baud))
+            return False
+        # Make sure the serial port can run at baud before SAM-BA is
+        # moved to it.
+        try:
+            self.ser.baudrate = baud
+        except (ValueError, SerialException) as e:
+            logger.warning("Unable to set the serial port to {0} baud : "
+                           "{1}".format(baud, e))
+            return False
+        finally:
+            self.ser.baudrate = old_baud
+        binary = not self.terminal
+        logger.info("Switching to {0} baud".format(baud))
+        if self._switch_baud(cd, baud, binary):
+            return True
+        logger.warning("No response from SAM-BA at {0} baud. Falling back "
+                       "to {1}.".format(baud, old_baud))
+        # SAM-BA may well have switched even though it could not be heard,
+        # so it is told to switch back before the port does.
+        if self._switch_baud(old_cd, old_baud, binary):
+            return False
+        self.ser.close()
+        raise SamBAConnectionError("Lost SAM-BA while changing the baud "
+                                   "rate. Reset the device and retry.")
+
+    def _switch_baud(self, cd, baud, binary):
+        """
+        Write cd to the UART baud rate generator and move the serial port
+        to baud. Returns True if SAM-BA then answers V# with the version
+        it gave when connecting.
+
+        """
+        self.write_message("W{0},{1:08x}#".format(self._device.UART_BRGR, cd))
+        # Let the command, and anything SAM-BA sends back before it takes
+        # effect, finish at the old rate.
+        self.ser.flush()
+        sleep(self.response_timeout(4))
+        self.ser.baudrate = baud
+        self.flush_all()
+        self.terminal = True
+        if not self.fast_connect():
+            return False
+        self.write_message("V#")
+        resp = self._pop_response(time() + self.response_timeout())
+        if resp is None or resp.decode('latin-1').strip() != self.version:
+            return False
+        if binary:
+            self.set_binary()
+        return True
+
     def close(self):
         self.ser.close()
 
     def flush_all(self):
         """ Flush serial communication buffers  """
-        self.ser.flushInput()
-        self.ser.flushOutput()
+        self._rx.clear()
+        self.ser.reset_input_buffer()
+        self.ser.reset_output_buffer()
+
+    def recover(self):
+        """
+        Discard responses which may still be in flight after an error.
+        Nothing is done if the port was closed, as it is when a response
+        times out, so that the error which closed it is the one seen.
+        """
+        if not self.ser.is_open:
+            return
+        sleep(self.response_timeout())
+        self.flush_all()
+
+    def command_queue(self, window=None):
+        """ Returns a SamBACommandQueue to pipeline independent commands """
+        return SamBACommandQueue(
+            self, self.window if window is None else window)
+
+    def write_encoded(self, data):
+        """ Write commands which have already been encoded to bytes """
+        if self.ser.is_open:
+            self.ser.write(data)
+            self._sent(len(data))
+            return
+        else:
+            raise IOError("Serial port does not seem to be open!")
 
     def write_message(self, msg):
-        if self.ser.isOpen():
-            self.flush_all()
+        if self.ser.is_open:
             logger.debug("Writing to device : {0}".format(msg.encode()))
             self.ser.write(msg.encode())
+            self._sent(len(msg))
+            if self.stats is not None:
+                self.stats.sent(msg[:1], len(msg))
             return
         else:
             raise IOError("Serial port does not seem to be open!")
@@ -125,11 +696,9 @@ class SamBAConnection(object):
         Both address and contents expected to be character strings
 
         """
-        self.flush_all()
         logger.debug("Writing byte at {0} : {1}"
                      "".format(address, contents))
-        self.write_message("O{0},{1}#".format(address, contents))
-        return self.retrieve_response()
+        return self._write_command("O{0},{1}#".format(address, contents))
 
     def write_hword(self, address, contents):
         """
@@ -137,11 +706,9 @@ class SamBAConnection(object):
         Both address and contents expected to be character strings
 
         """
-        self.flush_all()
         logger.debug("Writing half word at {0} : {1}"
                      "".format(address, contents))
-        self.write_message("H{0},{1}#".format(address, contents))
-        return self.retrieve_response()
+        return self._write_command("H{0},{1}#".format(address, contents))
 
     def write_word(self, address, contents):
         """
@@ -149,11 +716,36 @@ class SamBAConnection(object):
         Both address and contents expected to be character strings
 
         """
-        self.flush_all()
         logger.debug("Writing word at {0} : {1}"
                      "".format(address, contents))
-        self.write_message("W{0},{1}#".format(address, contents))
-        return self.retrieve_response()
+        return self._write_command("W{0},{1}#".format(address, contents))
+
+    def _write_command(self, msg):
+        """ Send a command which has no response in binary mode """
+        start = time()
+        self.write_message(msg)
+        if self.terminal:
+            response = self.retrieve_response()
+            self.account(msg[:1], len(response) + 1, start)
+            return response
+        return ''
+
+    def _read_command(self, msg, size):
+        """
+        Send a command which reads a value of size bytes. The value is
+        returned formatted as it is in terminal mode, whichever mode
+        SAM-BA is in.
+
+        """
+        start = time()
+        self.write_message(msg)
+        if self.terminal:
+            response = self.retrieve_response()
+            self.account(msg[:1], len(response) + 1, start)
+            return response
+        response = self.retrieve_response(size=size)
+        self.account(msg[:1], size, start)
+        return _format_value(response)
 
     def read_byte(self, address):
         """
@@ -161,11 +753,9 @@ class SamBAConnection(object):
         Both address and returned contents are character strings
 
         """
-        self.flush_all()
         msg = "o{0},#".format(address)
         logger.debug("Reading byte with command : {0}".format(msg))
-        self.write_message(msg)
-        return self.retrieve_response().strip()
+        return self._read_command(msg, 1).strip()
 
     def read_hword(self, address):
         """
@@ -173,11 +763,9 @@ class SamBAConnection(object):
         Both address and returned contents are character strings
 
         """
-        self.flush_all()
         msg = "h{0},#".format(address)
         logger.debug("Reading half word with command : {0}".format(msg))
-        self.write_message(msg)
-        return self.retrieve_response().strip()
+        return self._read_command(msg, 2).strip()
 
     def read_word(self, address):
         """
@@ -185,28 +773,67 @@ class SamBAConnection(object):
         Both address and returned contents are character strings
 
         """
-        self.flush_all()
         msg = "w{0},#".format(address)
         logger.debug("Reading word with command : {0}".format(msg))
+        return self._read_command(msg, 4)
+
+    def go(self, address, timeout=None):
+        """
+        Execute code at a specific address, given as a character string.
+        Returns once the code returns control to SAM-BA.
+
+        In binary mode SAM-BA sends nothing when the code returns, so the
+        monitor is switched to terminal mode for the duration of the call
+        to wait for its prompt.
+
+        """
+        binary = not self.terminal
+        if binary:
+            self.set_terminal()
+        msg = "G{0}#".format(address)
+        logger.debug("Executing with command : {0}".format(msg))
+        start = time()
         self.write_message(msg)
-        return self.retrieve_response()
+        response = self.retrieve_response(timeout=timeout)
+        self.account('G', len(response) + 1, start)
+        if binary:
+            self.set_binary()
+        return response
 
     def xm_init_sf(self, address):
         """ Initialize XMODEM file send to specified address """
-        self.flush_all()
         msg = "S{0},#".format(address)
         logger.debug("Starting send file with command : {0}".format(msg))
+        self._xm = ('S', time())
         self.write_message(msg)
-        _ = self.ser.read(2)
+        if self.terminal:
+            _ = self._read(2)
         return
 
     def xm_init_rf(self, address, size):
         """ Initialize XMODEM file read from specified address """
-        pass
+        msg = "R{0},{1}#".format(address, size)
+        logger.debug("Starting receive file with command : {0}".format(msg))
+        self._xm = ('R', time())
+        self.write_message(msg)
+        if self.terminal:
+            _ = self._read(2)
+        return
+
+    def xm_finish(self):
+        """ Consume the prompt which follows an XMODEM transfer """
+        nbytes = 0
+        if self.terminal:
+            nbytes = len(self.retrieve_response()) + 3
+        if self._xm:
+            self.account(self._xm[0], nbytes, self._xm[1])
+            self._xm = None
 
     def xm_getc(self, size, timeout=1):
         """ getc function for the xmodem protocol """
-        data = self.ser.read(size)
+        data = self._read(size)
+        if self._xm and self.stats is not None:
+            self.stats.received(self._xm[0], len(data))
         logger.debug("XM_RESP [{0:>3}] : {1}".format(len(data), data))
         return data
 
@@ -214,43 +841,58 @@ class SamBAConnection(object):
         """ putc function for the xmodem protocol """
         logger.debug("XM_SEND [{0:>3}] : {1}".format(len(data), data))
         self.ser.write(data)
+        if self._xm and self.stats is not None:
+            self.stats.sent(self._xm[0], len(data), count=0)
         return len(data)
 
-    def efc_wready(self):
-        """ Wait for EFC to report ready """
-        status = self.efc_rstat()
+    def efc_wready(self, efc=None):
+        """
+        Wait for EFC to report ready. The efc_ functions which take efc
+        use the registers of that device instance, such as one of the
+        planes returned by SAMDevice.planes(), instead of the device's.
+        """
+        start = time()
+        polls = 1
+        status = self.efc_rstat(efc)
         while not status:
             logger.debug("Waiting for EFC")
             sleep(0.01)
-            status = self.efc_rstat()
+            status = self.efc_rstat(efc)
+            polls = polls + 1
+        if self.stats is not None:
+            self.stats.efc_wait(polls, time() - start)
         return
 
     def efc_readfrr(self):
         return self.read_word(self._device.EFC_FRR)
 
-    def efc_readfmr(self):
-        return self.read_word(self._device.EFC_FMR)
+    def efc_readfmr(self, efc=None):
+        return self.read_word((efc or self._device).EFC_FMR)
 
-    def efc_setfmr(self, mode):
-        return self.write_word(self._device.EFC_FMR, mode)
+    def efc_setfmr(self, mode, efc=None):
+        return self.write_word((efc or self._device).EFC_FMR, mode)
 
-    def efc_ewp(self, pno):
-        """ EFC trigger write page. Pno is an integer """
-        self.write_word(self._device.EFC_FCR,
+    def efc_ewp(self, pno, efc=None, command=None):
+        """
+        EFC trigger write page. Pno is an integer. The page is written
+        with the EFC command given, the device's WPC if none.
+        """
+        efc = efc or self._device
+        self.write_word(efc.EFC_FCR,
                         '5A{0}{1}'.format(
                             hex(pno)[2:].zfill(4),
-                            self._device.WPC
+                            command or efc.WPC
                         ))
 
-    def efc_rstat(self):
+    def efc_rstat(self, efc=None):
         """
         Read EFC status.
         Returns True if EFC is ready, False if busy.
 
         """
-        efc_status = self.read_word(self._device.EFC_FSR).strip()
+        efc_status = self.read_word((efc or self._device).EFC_FSR).strip()
         logger.debug("EFC Status : {0}".format(efc_status))
-        return efc_status[9] == "1"
+        return bool(int(efc_status, 16) & 0x01)
 
     def efc_cleargpnvm(self, bno):
         """
@@ -281,17 +923,75 @@ class SamBAConnection(object):
         self.efc_wready()
         return
 
-    def efc_eraseall(self):
-        """ EFC Function to Erase All """
-        self.efc_wready()
-        self.write_word(self._device.EFC_FCR,
-                        '5A0000{0}'.format(self._device.EAC))
-        self.efc_wready()
+    def efc_eraseall(self, efc=None):
+        """
+        EFC Function to Erase All.
+        Returns True if the EFC completed the erase without errors.
+
+        """
+        efc = efc or self._device
+        self.efc_wready(efc)
+        self.write_word(efc.EFC_FCR, '5A0000{0}'.format(efc.EAC))
+        return self._efc_wait_errors(efc)
+
+    def efc_erasepages(self, farg, efc=None):
+        """
+        EFC Function to Erase Pages. farg is the command argument, an
+        integer, which gives the first page and the number of pages.
+        Returns True if the EFC completed the erase without errors.
+
+        """
+        efc = efc or self._device
+        self.efc_wready(efc)
+        self.write_word(efc.EFC_FCR,
+                        '5A{0}{1}'.format(hex(farg)[2:].zfill(4),
+                                          efc.EPA_COMMAND))
+        return self._efc_wait_errors(efc)
+
+    def _efc_wait_errors(self, efc):
+        # Error flags are cleared by reading the status register, so they
+        # are collected from every read made while waiting for the erase.
+        start = time()
+        polls = 0
+        status = 0
+        fsr = 0
+        while not fsr & 0x01:
+            fsr = int(self.read_word(efc.EFC_FSR).strip(), 16)
+            status = status | fsr
+            polls = polls + 1
+            if not fsr & 0x01:
+                logger.debug("Waiting for EFC")
+                sleep(0.01)
+        if self.stats is not None:
+            self.stats.efc_wait(polls, time() - start)
+        return not status & efc.EFC_FSR_ERRORS
 
     def getchipid(self):
-        cidr = self.read_word(self._device.CHIPID_CIDR).strip()
-        exid = self.read_word(self._device.CHIPID_EXID).strip()
-        return SamChipID(cidr, exid)
+        """
+        Read the chip ID. If the device does not say where its chip ID
+        registers are, the likely places are tried in turn, and None is
+        returned if none of them holds a valid chip ID.
+        """
+        if self._device.CHIPID_CIDR:
+            return self._read_chipid(self._device.CHIPID_CIDR,
+                                     self._device.CHIPID_EXID)
+        vector = int(self.read_word('00000004').strip(), 16)
+        if vector >> 28 == 0xE:
+            candidates = self.CHIPID_ARM7
+        else:
+            candidates = self.CHIPID_CORTEXM
+        for cidr, exid in candidates:
+            chipid = self._read_chipid(cidr, exid)
+            if chipid.valid:
+                logger.debug("Found chip ID at {0}".format(cidr))
+                return chipid
+        return None
+
+    def _read_chipid(self, cidr, exid):
+        with self.command_queue() as queue:
+            cidr = queue.read_word(cidr)
+            exid = queue.read_word(exid)
+        return SamChipID(cidr.response.strip(), exid.response.strip())
 
     def efc_getflashdescriptor(self):
         self.efc_wready()
@@ -301,15 +1001,18 @@ class SamBAConnection(object):
         return EFCFlashDescriptor(self)
 
     def efc_getuid(self):
+        """
+        Read the unique identifier, which the EFC maps at the start of
+        the flash while it is in UID mode. The commands to enter and
+        leave UID mode and the reads between them are sent as one burst.
+        """
+        fcr = self._device.EFC_FCR
+        base = int(self._device.FS_ADDRESS, 16)
         self.efc_wready()
-        self.write_word(self._device.EFC_FCR,
-                        '5A0000{0}'.format(self._device.STUI_CMD))
-
-        uid = ""
-        for i in range(4):
-            uid += self.read_word(hex(0x80000 + i * 4)[2:]).strip()[2:]
-
-        self.write_word(self._device.EFC_FCR,
-                        '5A0000{0}'.format(self._device.SPUI_CMD))
+        with self.command_queue() as queue:
+            queue.write_word(fcr, '5A0000{0}'.format(self._device.STUI_CMD))
+            words = [queue.read_word('{0:08x}'.format(base + i * 4))
+                     for i in range(4)]
+            queue.write_word(fcr, '5A0000{0}'.format(self._device.SPUI_CMD))
         self.efc_wready()
-        return uid
+        return ''.join(word.response.strip()[2:] for word in words)
@@ -16,24 +16,152 @@
 # along with pysamloader.  If not, see <http://www.gnu.org/licenses/>.
 
 
+def plane_index(planes, address):
+    """ Index of the plane in planes, from SAMDevice.planes(), at address """
+    index = 0
+    for i, plane in enumerate(planes):
+        if address >= int(plane.FS_ADDRESS, 16):
+            index = i
+    return index
+
+
+def _parse_size(text):
+    """ Size in bytes given as by SamChipID, such as 256K or 2048K """
+    units = {'K': 1024, 'M': 1024 * 1024}
+    return int(text[:-1]) * units[text[-1]]
+
+
 class SAMDevice(object):
+    # Chip ID registers, and the architecture and flash size fields of the
+    # chip ID (as the short names SamChipID gives them) which identify
+    # the device when it is detected rather than named.
+    CHIPID_CIDR = None
+    CHIPID_EXID = None
+    CHIPID_ARCH = None
+    CHIPID_NVPSIZ = None
     EFC_FCR = None
     EFC_FSR = None
     AutoBaud = None
     FullErase = None
+    XmodemRead = None
     WP_COMMAND = None
     EWP_COMMAND = None
     EA_COMMAND = None
+    # Erase pages command, and the number of pages it erases for each
+    # value of the low bits of its argument (None where not allowed).
+    EPA_COMMAND = None
+    EPA_SIZES = None
+    # Timing model used to plan erasing, see the erase module. Times, in
+    # seconds, to write a page which is already erased, to erase and
+    # write a page, to erase a whole plane, and to erase a group of
+    # pages. These are typical of an EEFC, devices override them.
+    WP_TIME = 0.0015
+    EWP_TIME = 0.003
+    EA_TIME = 0.05
+    EPA_TIME = 0.01
     FS_ADDRESS = None
     PAGE_SIZE = None
+    # Flash geometry. Devices whose EFC has a get descriptor command
+    # (GD_CMD) have these filled in from the flash descriptor when
+    # identified, see with_geometry(). PAGE_SIZE is otherwise as given
+    # by the device definition.
+    GD_CMD = None
+    # Start and stop read unique identifier commands, where the EFC has
+    # them.
+    STUI_CMD = None
+    SPUI_CMD = None
+    FLASH_SIZE = None
+    FLASH_PLANES = None
+    LOCK_REGIONS = None
+    ERASED_VALUE = 0xFF
+    EFC_FSR_ERRORS = 0x06
+    XMODEM_FMR = None
+    APPLET_ADDRESS = None
+    APPLET_STACK = None
+    APPLET_BUFFERS = None
+    APPLET_BUFFER_SIZE = None
+    # Baud rate generator register of the UART (or DBGU) SAM-BA talks
+    # on, and the master clock it is fed from while SAM-BA is running,
+    # in Hz. Both are needed to change the baud rate after connecting.
+    UART_BRGR = None
+    UART_MCK = None
+    # Largest relative error allowed between the requested baud rate and
+    # the one the UART can actually generate.
+    BAUD_TOLERANCE = 0.02
     SGP = [0, 0, 0]
+    # Flash planes which each have an EFC of their own, in address order,
+    # as dicts of the FS_ADDRESS and EFC_ registers of each. None if the
+    # device has one EFC, as described by the attributes above.
+    EFC_PLANES = None
 
     def __init__(self):
         pass
 
+    @classmethod
+    def with_geometry(cls, geometry):
+        """
+        A subclass of this device with the flash geometry given, as
+        returned by EFCFlashDescriptor.geometry().
+        """
+        return type(cls.__name__, (cls, ), {
+            '__module__': cls.__module__,
+            'PAGE_SIZE': geometry['page_size'],
+            'FLASH_SIZE': geometry['size'],
+            'FLASH_PLANES': list(geometry['planes']),
+            'LOCK_REGIONS': list(geometry['locks']),
+        })
+
+    @classmethod
+    def planes(cls):
+        """
+        An instance of the device for each of its flash planes, with the
+        plane's flash address and EFC registers.
+        """
+        if not cls.EFC_PLANES:
+            return [cls()]
+        return [type(cls.__name__, (cls, ),
+                     dict(plane, __module__=cls.__module__))()
+                for plane in cls.EFC_PLANES]
+
+    @classmethod
+    def flash_regions(cls):
+        """
+        (start, end) addresses of the flash of each plane, in address
+        order, or None if the size of the flash is not known. The size is
+        taken from the flash descriptor if it has been read, and from the
+        flash size field of the chip ID (CHIPID_NVPSIZ) otherwise.
+        """
+        planes = cls.planes()
+        if cls.FLASH_SIZE:
+            size = cls.FLASH_SIZE
+        elif cls.CHIPID_NVPSIZ:
+            size = _parse_size(cls.CHIPID_NVPSIZ) // len(planes)
+        else:
+            return None
+        return [(int(plane.FS_ADDRESS, 16), int(plane.FS_ADDRESS, 16) + size)
+                for plane in planes]
+
     @property
     def WPC(self):
-        return self.WP_COMMAND or self.EWP_COMMAND
+        # The command which writes a page whether or not it is erased.
+        # WP_COMMAND is only that where there is no EWP_COMMAND.
+        return self.EWP_COMMAND or self.WP_COMMAND
+
+    def baud_divisor(self, baud):
+        """
+        Clock divisor (CD) which runs the UART at baud, or None if the
+        device does not support changing its baud rate or baud cannot be
+        generated within BAUD_TOLERANCE.
+        """
+        if not self.UART_BRGR or not self.UART_MCK:
+            return None
+        cd = int(round(self.UART_MCK / (16.0 * baud)))
+        if not 0 < cd < 0x10000:
+            return None
+        actual = self.UART_MCK / (16.0 * cd)
+        if abs(actual - baud) > baud * self.BAUD_TOLERANCE:
+            return None
+        return cd
 
     @property
     def EAC(self):
@@ -0,0 +1,173 @@
+# Copyright (c) 2019 Chintalagiri Shashank
+#
+# This file is part of pysamloader.
+
+# pysamloader is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pysamloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysamloader.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Instrumentation for SAM-BA connections.
+
+A SamBAConnection created with stats=True keeps a ConnectionStats on
+its stats attribute, which accounts for every command sent :
+
+  * per command type, the number sent, bytes sent and received, and a
+    histogram of the time from sending a command to receiving its
+    response
+  * time spent waiting for the EFC, and the number of status polls
+    that took
+  * responses which timed out
+
+Commands which get no response, such as writes in binary mode, are
+counted, but have no latency. XMODEM transfers (S and R) are timed as
+a whole, including the data. Otherwise, stats is None, and the
+connection does no accounting at all.
+"""
+
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+
+
+# Upper edges of the latency histogram buckets, in seconds. Latencies
+# above the last edge fall in one more bucket.
+LATENCY_BUCKETS = (1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 1e-1, 3e-1, 1.0)
+
+
+def _bucket_label(i):
+    if i == len(LATENCY_BUCKETS):
+        return '>{0}'.format(_fmt_seconds(LATENCY_BUCKETS[-1]))
+    return '<{0}'.format(_fmt_seconds(LATENCY_BUCKETS[i]))
+
+
+def _fmt_seconds(seconds):
+    if seconds < 1e-3:
+        return '{0:g}us'.format(seconds * 1e6)
+    elif seconds < 1:
+        return '{0:g}ms'.format(seconds * 1e3)
+    return '{0:g}s'.format(seconds)
+
+
+class CommandStats(object):
+    """ Accounting for one type of SAM-BA command """
+    def __init__(self):
+        self.count = 0
+        self.tx_bytes = 0
+        self.rx_bytes = 0
+        self.responses = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def as_dict(self):
+        return OrderedDict([
+            ('count', self.count),
+            ('tx_bytes', self.tx_bytes),
+            ('rx_bytes', self.rx_bytes),
+            ('responses', self.responses),
+            ('latency_total', self.latency),
+            ('latency_max', self.max_latency),
+            ('latency_histogram', OrderedDict(
+                (_bucket_label(i), n) for i, n in enumerate(self.histogram)
+            )),
+        ])
+
+
+class ConnectionStats(object):
+    def __init__(self):
+        self.commands = OrderedDict()
+        self.efc_waits = 0
+        self.efc_busy_waits = 0
+        self.efc_polls = 0
+        self.efc_wait_time = 0.0
+        self.timeouts = 0
+        self.start_time = time.time()
+
+    def _command(self, kind):
+        try:
+            return self.commands[kind]
+        except KeyError:
+            self.commands[kind] = CommandStats()
+            return self.commands[kind]
+
+    def sent(self, kind, nbytes, count=1):
+        """ Account for count commands of type kind, nbytes in all """
+        command = self._command(kind)
+        command.count += count
+        command.tx_bytes += nbytes
+
+    def received(self, kind, nbytes, latency=None):
+        """ Account for a response of nbytes to a command of type kind """
+        command = self._command(kind)
+        command.rx_bytes += nbytes
+        if latency is not None:
+            command.responses += 1
+            command.latency += latency
+            command.max_latency = max(command.max_latency, latency)
+            command.histogram[bisect_right(LATENCY_BUCKETS, latency)] += 1
+
+    def efc_wait(self, polls, elapsed):
+        """ Account for a wait for the EFC which took polls reads of FSR """
+        self.efc_waits += 1
+        if polls > 1:
+            self.efc_busy_waits += 1
+        self.efc_polls += polls
+        self.efc_wait_time += elapsed
+
+    def timeout(self):
+        self.timeouts += 1
+
+    @property
+    def tx_bytes(self):
+        return sum(c.tx_bytes for c in self.commands.values())
+
+    @property
+    def rx_bytes(self):
+        return sum(c.rx_bytes for c in self.commands.values())
+
+    def as_dict(self):
+        return OrderedDict([
+            ('elapsed', time.time() - self.start_time),
+            ('tx_bytes', self.tx_bytes),
+            ('rx_bytes', self.rx_bytes),
+            ('timeouts', self.timeouts),
+            ('efc', OrderedDict([
+                ('waits', self.efc_waits),
+                ('busy_waits', self.efc_busy_waits),
+                ('polls', self.efc_polls),
+                ('wait_time', self.efc_wait_time),
+            ])),
+            ('commands', OrderedDict(
+                (kind, c.as_dict()) for kind, c in self.commands.items()
+            )),
+        ])
+
+    def summary(self):
+        """ Human readable summary, as printed by --stats """
+        lines = ["{0:>4} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10}".format(
+            'Cmd', 'Count', 'Sent', 'Received', 'Mean', 'Max')]
+        for kind, c in self.commands.items():
+            mean = c.latency / c.responses if c.responses else None
+            lines.append("{0:>4} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10}"
+                         "".format(kind, c.count, c.tx_bytes, c.rx_bytes,
+                                   _fmt_seconds(mean) if mean else '-',
+                                   _fmt_seconds(c.max_latency)
+                                   if c.responses else '-'))
+        lines.append("Elapsed {0:.2f} s, {1} bytes sent, {2} bytes "
+                     "received, {3} timeouts"
+                     "".format(time.time() - self.start_time, self.tx_bytes,
+                               self.rx_bytes, self.timeouts))
+        lines.append("EFC : {0} waits, {1} busy, {2} polls, {3:.2f} s "
+                     "waiting".format(self.efc_waits, self.efc_busy_waits,
+                                      self.efc_polls, self.efc_wait_time))
+        return '\n'.join(lines)
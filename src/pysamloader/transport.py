@@ -0,0 +1,87 @@
+# Copyright (c) 2019 Chintalagiri Shashank
+#
+# This file is part of pysamloader.
+
+# pysamloader is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pysamloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysamloader.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Transports which carry SAM-BA sessions.
+
+A port is usually the name of a local serial port, but may also be any
+URL understood by pyserial's serial_for_url(), such as :
+
+    socket://fixture-rack-3:4001    raw TCP, e.g. a ser2net port
+    rfc2217://fixture-rack-3:4002   telnet with serial port control
+    loop://                         loopback, for testing
+
+or an object which is already open and provides the parts of the
+pyserial Serial interface SamBAConnection uses : read(), write(),
+flush(), reset_input_buffer(), reset_output_buffer(), close(),
+in_waiting, is_open, timeout and baudrate.
+
+The protocol is bound by round trips, so TCP transports have Nagle's
+algorithm turned off. Each command, or batch of commands, is already
+written in a single call, so nothing is lost by sending it at once.
+"""
+
+import socket
+from six import string_types
+from serial import serial_for_url
+from serial.urlhandler import protocol_loop
+from serial.urlhandler import protocol_socket
+
+
+# Transports which carry bytes to a serial port whose baud rate is set
+# at the far end, and cannot be changed from here.
+_fixed_baud_transports = (protocol_socket.Serial, protocol_loop.Serial)
+
+
+def open_transport(port, baud, timeout=None):
+    """
+    Open port, a serial port name or pyserial URL, at baud. Anything
+    other than a string is taken to be an already open transport, and
+    is returned as is.
+    """
+    if not isinstance(port, string_types):
+        return port
+    transport = serial_for_url(port, baudrate=baud, timeout=timeout)
+    sock = getattr(transport, '_socket', None)
+    if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return transport
+
+
+def fixed_baud(transport):
+    """
+    Returns True if changing the baud rate of transport would not change
+    the baud rate of the link to SAM-BA. Custom transports can declare
+    this with a fixed_baud attribute.
+    """
+    return getattr(transport, 'fixed_baud',
+                   isinstance(transport, _fixed_baud_transports))
+
+
+def transport_fd(transport):
+    """
+    The file descriptor which carries the bytes of transport as they are,
+    so that it can be watched by an event loop and read and written
+    directly, or None if there is none. Local serial ports on POSIX and
+    socket:// transports have one. Transports which wrap the bytes in a
+    protocol of their own, such as rfc2217://, do not.
+    """
+    if isinstance(transport, protocol_socket.Serial):
+        return transport._socket.fileno()
+    if type(transport).__module__ == 'serial.serialposix':
+        return transport.fileno()
+    return None
@@ -0,0 +1,108 @@
+import os
+import sys
+import struct
+import threading
+
+import pytest
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks')
+
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore.append('test_aiosamba.py')
+
+
+class _SamBAStandIn(socketserver.BaseRequestHandler):
+    """ Just enough of SAM-BA, over TCP, to hold a session with """
+    def handle(self):
+        memory = self.server.memory
+        terminal = True
+        command, number, address = None, 0, 0
+        dropped = False
+        self.request.sendall(self.server.banner)
+        while True:
+            data = self.request.recv(4096)
+            if not data:
+                return
+            for c in bytearray(data):
+                c = chr(c)
+                if c in '0123456789abcdefABCDEF' and command:
+                    number = (number << 4) | int(c, 16)
+                elif c == ',':
+                    address, number = number, 0
+                elif c == '#':
+                    out = b'\n\r' if terminal else b''
+                    if command == 'W':
+                        memory[address] = number
+                    elif command == 'w' and address in self.server.hangup:
+                        return
+                    elif command == 'w' and address in self.server.silent:
+                        # Nothing more is answered, as if the link dropped
+                        dropped = True
+                    elif command == 'w':
+                        value = memory.get(address, 0)
+                        if terminal:
+                            out += '0x{0:08x}\n\r'.format(value).encode()
+                        else:
+                            out += struct.pack('<I', value)
+                    elif command == 'V':
+                        out += b'v1.1 Dec 15 2010 19:25:04\n\r'
+                    elif command == 'N':
+                        terminal = False
+                    elif command == 'T':
+                        terminal = True
+                        out += b'\n\r'
+                    if terminal:
+                        out += b'>'
+                    if not dropped:
+                        self.request.sendall(out)
+                    command, number, address = None, 0, 0
+                elif c not in '\r\n\x80 ':
+                    command, number = c, 0
+
+
+@pytest.fixture
+def samba_server():
+    """
+    The stand-in, serving on url. Reading a word at an address in silent
+    drops the link, and at one in hangup closes the connection. banner
+    is sent as soon as a client connects.
+    """
+    server = socketserver.TCPServer(('127.0.0.1', 0), _SamBAStandIn)
+    server.memory = {}
+    server.silent = {0x20003008}
+    server.hangup = {0x20003010}
+    server.banner = b''
+    server.url = 'socket://127.0.0.1:{0}'.format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def samba_url(samba_server):
+    return samba_server.url
+
+
+@pytest.fixture
+def target():
+    """ The simulated ATSAM3U4E from the benchmarks, without pacing """
+    pytest.importorskip('pty')
+    sys.path.insert(0, BENCHMARKS)
+    try:
+        from samba_sim import SimulatedTarget
+    finally:
+        sys.path.remove(BENCHMARKS)
+    target = SimulatedTarget(baud=0)
+    yield target
+    target.close()
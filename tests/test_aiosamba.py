@@ -0,0 +1,149 @@
+import time
+import asyncio
+from io import BytesIO
+
+import pytest
+
+from pysamloader import aiosamba
+from pysamloader.aiosamba import AsyncSamBAConnection
+from pysamloader.samba import SamBAConnectionError
+from pysamloader.devices.ATSAM3U4E import ATSAM3U4E
+from pysamloader.image import load_image
+
+PAGE = 256
+VERSION = 'v1.1 Dec 15 2010 19:25:04'
+
+
+def _run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def _pages(count, erased=()):
+    return b''.join((b'\xff' if i in erased else bytes([i + 1])) * PAGE
+                    for i in range(count))
+
+
+async def _word(samba, address):
+    return int((await samba.read_word('{0:08x}'.format(address))).strip(), 16)
+
+
+@pytest.mark.parametrize('with_fd', [True, False])
+def test_connect_url(samba_server, monkeypatch, with_fd):
+    samba_server.banner = b'RomBOOT\n\r>garbage'
+    if not with_fd:
+        monkeypatch.setattr(aiosamba, 'transport_fd', lambda t: None)
+
+    async def session():
+        async with AsyncSamBAConnection(samba_server.url,
+                                        device=ATSAM3U4E) as samba:
+            assert samba.version == VERSION
+            await samba.write_word('20001000', 'deadbeef')
+            assert await _word(samba, 0x20001000) == 0xdeadbeef
+            responses = await samba.pipeline(
+                'w{0:08x},#'.format(0x20001000 + 4 * i) for i in range(3))
+            assert [r.strip() for r in responses] == \
+                ['0xdeadbeef', '0x00000000', '0x00000000']
+
+    # Made outside the loop, which is only taken when connecting
+    _run(session())
+
+
+@pytest.mark.parametrize('with_fd', [True, False])
+def test_hangup(samba_server, monkeypatch, with_fd):
+    if not with_fd:
+        monkeypatch.setattr(aiosamba, 'transport_fd', lambda t: None)
+
+    async def session():
+        async with AsyncSamBAConnection(samba_server.url,
+                                        device=ATSAM3U4E) as samba:
+            samba.RESPONSE_LATENCY = 5
+            start = time.time()
+            with pytest.raises(SamBAConnectionError):
+                await samba.read_word('20003010')
+            # Later commands fail at once too
+            with pytest.raises(SamBAConnectionError):
+                await samba.read_word('20001000')
+            assert time.time() - start < 1
+
+    _run(session())
+
+
+def test_efc_rstat_with_errors(target):
+    async def session():
+        async with AsyncSamBAConnection(target.port,
+                                        device=ATSAM3U4E) as samba:
+            # A command without the key sets an error flag
+            await samba.write_word(ATSAM3U4E.EFC_FCR, '00000001')
+            assert await samba.efc_rstat()
+
+    _run(session())
+
+
+def test_write_verify_planes(target):
+    target.load(0x80000, b'\x00' * 8 * PAGE)
+    image = load_image(BytesIO(_pages(3, erased=[1])), ATSAM3U4E, 1)
+    image.add(0x100000, _pages(2))
+
+    async def session():
+        async with AsyncSamBAConnection(target.port,
+                                        device=ATSAM3U4E) as samba:
+            await samba.write(image)
+            assert await samba.verify(image) == 0
+            # Flash outside the image is left as it was
+            assert await _word(samba, 0x80000) == 0
+            assert await _word(samba, 0x80000 + 4 * PAGE) == 0
+            assert await samba.verify(_pages(1), start_page=5) == PAGE // 4
+
+    _run(session())
+
+
+def test_write_erase_all(target):
+    target.load(0x80000, b'\x00' * 8 * PAGE)
+
+    async def session():
+        async with AsyncSamBAConnection(target.port,
+                                        device=ATSAM3U4E) as samba:
+            await samba.write(_pages(3, erased=[1]), erase='all')
+            assert await samba.verify(_pages(3, erased=[1])) == 0
+            assert await _word(samba, 0x80000 + 4 * PAGE) == 0xffffffff
+
+    _run(session())
+    # One erase, and two pages written. The erased page is not written.
+    assert target.stats()['commands']['W'] == 1 + 2 * (PAGE // 4 + 1)
+
+
+def test_full_erase(target):
+    class Device(ATSAM3U4E):
+        FullErase = True
+
+    target.load(0x80000, b'\x00' * 8 * PAGE)
+
+    async def session():
+        async with AsyncSamBAConnection(target.port, device=Device) as samba:
+            await samba.write(_pages(2), erase='page')
+            assert await samba.verify(_pages(2)) == 0
+            assert await _word(samba, 0x80000 + 4 * PAGE) == 0xffffffff
+
+    _run(session())
+
+
+def test_cancelled_write(target):
+    async def session():
+        async with AsyncSamBAConnection(target.port,
+                                        device=ATSAM3U4E) as samba:
+            task = asyncio.ensure_future(samba.write(_pages(8)))
+            # Cancelled with commands in flight
+            while not samba._outstanding:
+                await asyncio.sleep(0)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            # The connection is still usable
+            await samba.write_word('20001000', '00000007')
+            assert await _word(samba, 0x20001000) == 7
+
+    _run(session())
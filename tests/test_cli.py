@@ -0,0 +1,23 @@
+import sys
+
+import pytest
+
+from pysamloader import cli
+
+
+def _main(monkeypatch, *args):
+    monkeypatch.setattr(sys, 'argv', ['pysamloader'] + list(args))
+    return cli.main()
+
+
+def test_resume_with_applet(monkeypatch, capsys):
+    with pytest.raises(SystemExit):
+        _main(monkeypatch, '--applet', '--resume', 'app.bin')
+    assert '--resume cannot be used with --applet' in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('window', ['0', '-1', 'x'])
+def test_invalid_window(monkeypatch, capsys, window):
+    with pytest.raises(SystemExit):
+        _main(monkeypatch, '--window', window, 'app.bin')
+    assert 'is not a positive integer' in capsys.readouterr().err
@@ -0,0 +1,54 @@
+import sys
+import argparse
+import subprocess
+
+from pysamloader import cli
+from pysamloader import daemon
+from pysamloader.samdevice import SAMDevice
+from pysamloader.devices.ATSAM3U4E import ATSAM3U4E
+
+
+def _submitted(monkeypatch, **options):
+    jobs = []
+
+    def submit(job, socket_path=None, timeout=None):
+        jobs.append(job)
+        return {'status': 'ok', 'errors': 0, 'elapsed': 0.1}
+
+    monkeypatch.setattr(daemon, 'submit', submit)
+    args = argparse.Namespace(port='/dev/ttyUSB1', baud=115200,
+                              link_baud=None, window=None, terminal=False,
+                              slow_connect=False, device=None,
+                              filename='app.bin', nw=False, nv=False,
+                              g=False, xm=False, applet=False, wv=False,
+                              skip_erased=False, erase='auto', resume=False,
+                              crc=False, socket='daemon.sock')
+    for name, value in options.items():
+        setattr(args, name, value)
+    assert cli.submit_write_and_verify(args) == 0
+    return jobs[0]
+
+
+def test_submit_options(monkeypatch):
+    job = _submitted(monkeypatch, window=4, terminal=True, slow_connect=True,
+                     link_baud=230400, device=ATSAM3U4E)
+    assert job['window'] == 4 and job['link_baud'] == 230400
+    assert job['terminal'] is True and job['slow_connect'] is True
+    assert job['device'] == 'ATSAM3U4E'
+    # Options not given are left to the daemon
+    job = _submitted(monkeypatch)
+    assert job['window'] is None and job['terminal'] is None
+    assert job['slow_connect'] is None and job['device'] is None
+
+
+def test_submit_unsupported_device(monkeypatch):
+    assert _submitted(monkeypatch, device=SAMDevice)['device'] is None
+
+
+def test_light_import():
+    code = ("import sys, pysamloader.daemon; "
+            "print(' '.join(sorted(sys.modules)))")
+    modules = subprocess.check_output([sys.executable, '-c', code]).split()
+    for name in (b'appdirs', b'serial', b'pysamloader.samba',
+                 b'pysamloader.pysamloader'):
+        assert name not in modules
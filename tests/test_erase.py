@@ -0,0 +1,111 @@
+from io import BytesIO
+
+import pytest
+
+from pysamloader.devices.ATSAM3U4E import ATSAM3U4E
+from pysamloader.devices.AT91SAM7X512 import AT91SAM7X512
+from pysamloader.erase import plan_erase, EraseSequence
+from pysamloader.image import load_image
+from pysamloader.pysamloader import _erase
+
+PAGE_TIME = 0.005
+
+
+def _image(device, pages, erased=()):
+    data = bytearray()
+    for i in range(pages):
+        data += (b'\xff' if i in erased else b'\x5a') * device.PAGE_SIZE
+    return load_image(BytesIO(bytes(data)), device)
+
+
+def test_small_patch_erase_write():
+    image = _image(ATSAM3U4E, 4)
+    plan = plan_erase(ATSAM3U4E.planes(), image, PAGE_TIME, 'any')
+    assert plan.strategies == ['erase-write']
+    assert not plan.erase_all
+    assert set(plan.commands.values()) == {'03'}
+    assert len(plan) == 4
+
+
+def test_full_image_erase_all():
+    device = ATSAM3U4E.with_geometry({'size': 0x20000, 'page_size': 256,
+                                      'planes': [0x20000], 'locks': []})
+    pages = device.FLASH_SIZE // device.PAGE_SIZE
+    image = _image(device, pages, erased=range(0, pages, 4))
+    for mode in ('auto', 'any'):
+        plan = plan_erase(device.planes(), image, PAGE_TIME, mode)
+        assert plan.strategies == ['erase-all']
+        assert [p.FS_ADDRESS for p in plan.erase_all] == ['00080000']
+        assert set(plan.commands.values()) == {'01'}
+        assert len(plan) == pages - pages // 4
+    plan = plan_erase(device.planes(), image, PAGE_TIME, 'page')
+    assert plan.strategies == ['erase-write'] and len(plan) == pages
+
+
+def test_auto_keeps_flash_outside_image():
+    image = _image(ATSAM3U4E, 480, erased=range(0, 480, 2))
+    plan = plan_erase(ATSAM3U4E.planes(), image, PAGE_TIME, 'auto')
+    assert plan.strategies == ['erase-write'] and not plan.erase_all
+    plan = plan_erase(ATSAM3U4E.planes(), image, PAGE_TIME, 'any')
+    assert plan.strategies == ['erase-all'] and len(plan) == 240
+
+
+def test_erase_pages():
+    class Device(ATSAM3U4E):
+        EPA_COMMAND = '07'
+        EPA_SIZES = [None, 8, 16, 32]
+    # A whole group of 16 pages, mostly erased, and part of another
+    image = _image(Device, 20, erased=range(1, 16))
+    plan = plan_erase(Device.planes(), image, PAGE_TIME, 'auto')
+    assert plan.strategies == ['erase-pages']
+    assert [farg for _, farg in plan.erase_pages] == [0x02]
+    assert len(plan) == 1 + 4
+    assert plan.commands[0x80000] == '01'
+    assert plan.commands[0x80000 + 16 * 256] == '03'
+
+
+def test_full_erase_device():
+    image = _image(AT91SAM7X512, 2)
+    plan = plan_erase(AT91SAM7X512.planes(), image, PAGE_TIME, 'page')
+    assert plan.strategies == ['erase-all'] and len(plan) == 2
+
+
+class _FailingErase(object):
+    """ Just the EFC erase commands of a SamBAConnection, which fail """
+    def __init__(self, failures):
+        self.failures = failures
+        self.erases = 0
+
+    def efc_eraseall(self, efc=None):
+        self.erases += 1
+        return self.erases > self.failures
+
+
+def test_failed_erase_writes_every_page():
+    image = _image(ATSAM3U4E, 4, erased=[1])
+    samba = _FailingErase(1)
+    plan = _erase(samba, ATSAM3U4E, image, PAGE_TIME, 'all')
+    assert plan.strategies == ['erase-write'] and not plan.erase_all
+    assert len(plan) == 4 and set(plan.commands.values()) == {'03'}
+
+
+def test_failed_full_erase():
+    image = _image(AT91SAM7X512, 4, erased=[1])
+    plan = _erase(_FailingErase(1), AT91SAM7X512, image, PAGE_TIME, 'page')
+    assert plan.strategies == ['erase-all'] and len(plan) == 3
+    with pytest.raises(IOError):
+        _erase(_FailingErase(2), AT91SAM7X512, image, PAGE_TIME, 'page')
+
+
+def test_erase_sequence():
+    image = _image(AT91SAM7X512, 4, erased=[1])
+    sequence = EraseSequence(AT91SAM7X512, image, PAGE_TIME, 'page')
+    planes = AT91SAM7X512.planes()
+    assert [farg for _, farg in sequence.erases] == [None]
+    # A full erase device is erased again once, and never written unerased
+    erases = sequence.erased(False)
+    assert [(plane.FS_ADDRESS, farg) for plane, farg in erases] == \
+        [(plane.FS_ADDRESS, None) for plane in planes]
+    assert sequence.erased(True) == []
+    with pytest.raises(IOError):
+        sequence.erased(False)
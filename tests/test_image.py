@@ -0,0 +1,179 @@
+import struct
+from io import BytesIO
+from binascii import hexlify
+
+import pytest
+
+from pysamloader.devices.ATSAM3U4E import ATSAM3U4E
+from pysamloader.devices.AT91SAM7X512 import AT91SAM7X512
+from pysamloader.image import FlashImage
+from pysamloader.image import ImageError
+from pysamloader.image import load_image
+from pysamloader.image import load_hex
+from pysamloader.image import load_srec
+
+
+def _ihex(address, rtype, data=b''):
+    record = bytearray([len(data), address >> 8, address & 0xFF, rtype])
+    record += data
+    record.append(-sum(record) & 0xFF)
+    return b':' + hexlify(bytes(record)).upper() + b'\n'
+
+
+def _srec(rtype, address, data=b''):
+    alen = {0: 2, 1: 2, 2: 3, 3: 4, 9: 2}[rtype]
+    record = bytearray([alen + len(data) + 1])
+    record += bytearray(struct.pack('>I', address)[4 - alen:]) + data
+    record.append(0xFF - (sum(record) & 0xFF))
+    return 'S{0}'.format(rtype).encode() + \
+        hexlify(bytes(record)).upper() + b'\n'
+
+
+def _elf(segments):
+    """ A minimal ELF file with program headers for segments, given as
+    (p_type, p_paddr, data, p_memsz) """
+    phoff = 52
+    offset = phoff + 32 * len(segments)
+    headers, contents = b'', b''
+    for p_type, paddr, data, memsz in segments:
+        headers += struct.pack('<8I', p_type, offset + len(contents),
+                               paddr + 0x1000000, paddr, len(data), memsz,
+                               5, 4)
+        contents += data
+    header = b'\x7fELF\x01\x01\x01' + b'\x00' * 9 + \
+        struct.pack('<HHIIIIIHHHHHH', 2, 40, 1, 0, phoff, 0, 0, 52, 32,
+                    len(segments), 40, 0, 0)
+    return header + headers + contents
+
+
+def _flash(data, name=None, device=ATSAM3U4E):
+    f = BytesIO(data)
+    if name:
+        f.name = name
+    return load_image(f, device)
+
+
+def test_flash_regions():
+    assert ATSAM3U4E.flash_regions() == [(0x80000, 0xA0000),
+                                         (0x100000, 0x120000)]
+    geometry = {'size': 0x10000, 'page_size': 256, 'planes': [0x10000],
+                'locks': []}
+    assert ATSAM3U4E.with_geometry(geometry).flash_regions()[0] == \
+        (0x80000, 0x90000)
+
+
+def test_outside_flash():
+    image = FlashImage(0x80000, 256, regions=[(0x80000, 0x90000)])
+    image.add(0x8FF00, b'\x00' * 256)
+    with pytest.raises(ImageError):
+        image.add(0x20000000, b'\x00' * 4)
+    with pytest.raises(ImageError):
+        image.add(0x8FF00, b'\x00' * 257)
+    with pytest.raises(ImageError):
+        image.add(0x7FFFC, b'\x00' * 4)
+
+
+def test_adjoining_planes():
+    image = load_image(BytesIO(b'\x00' * 512), AT91SAM7X512, start_page=1023)
+    assert [a for a, _ in image.pages()] == [0x13FF00, 0x140000]
+    with pytest.raises(ImageError):
+        load_image(BytesIO(b'\x00' * 512), AT91SAM7X512, start_page=2047)
+
+
+def test_binary_too_large():
+    with pytest.raises(ImageError):
+        load_image(BytesIO(b'\x00' * 0x20100), ATSAM3U4E)
+
+
+def test_hex_records():
+    data = bytes(bytearray(range(16)))
+    content = _ihex(0, 0x04, b'\x00\x08') + \
+        _ihex(0x00F8, 0x00, data) + \
+        _ihex(0, 0x02, b'\x80\x20') + \
+        _ihex(0x0000, 0x00, b'\xAA\xBB') + \
+        _ihex(0, 0x01) + \
+        _ihex(0x0400, 0x00, b'\xCC')
+    image = _flash(content, 'app.hex')
+    assert [a for a, _ in image.pages()] == [0x80000, 0x80100, 0x80200]
+    assert bytes(image.page(0x80000)) == b'\xff' * 0xF8 + data[:8]
+    assert bytes(image.page(0x80100)) == data[8:] + b'\xff' * 0xF8
+    assert bytes(image.page(0x80200))[:3] == b'\xAA\xBB\xff'
+
+
+@pytest.mark.parametrize('line', [
+    # Bad checksum
+    b':0400000001020304F1\n',
+    # Length byte does not match the record
+    b':10000000010203040F\n',
+    b':00\n',
+    b'0400000001020304F2\n',
+    # Address records without their two bytes of address
+    b':0100000400FB\n',
+    b':00000002FE\n',
+])
+def test_hex_rejected(line):
+    with pytest.raises(ImageError):
+        load_hex(line, FlashImage(0, 256))
+
+
+def test_srec_records():
+    content = _srec(0, 0, b'header') + \
+        _srec(1, 0x0010, b'\x01\x02') + \
+        _srec(2, 0x010020, b'\x03\x04') + \
+        _srec(3, 0x01000130, b'\x05\x06') + \
+        _srec(9, 0)
+    image = FlashImage(0, 256)
+    load_srec(content, image)
+    assert [a for a, _ in image.pages()] == [0x0, 0x10000, 0x1000100]
+    assert bytes(image.page(0x0))[0x10:0x13] == b'\x01\x02\xff'
+    assert bytes(image.page(0x10000))[0x20:0x22] == b'\x03\x04'
+    assert bytes(image.page(0x1000100))[0x30:0x32] == b'\x05\x06'
+
+
+def test_srec_rejected():
+    line = bytearray(_srec(1, 0x10, b'\x01\x02'))
+    line[-2:-1] = b'0' if line[-2:-1] != b'0' else b'1'
+    with pytest.raises(ImageError):
+        load_srec(bytes(line), FlashImage(0, 256))
+    # Count byte does not match the record
+    with pytest.raises(ImageError):
+        load_srec(b'S10600100102E6\n', FlashImage(0, 256))
+
+
+def test_elf_segments():
+    text = b'\x11' * 300
+    content = _elf([(1, 0x80000, text, len(text)),
+                    # .bss, which has no contents to load
+                    (1, 0x20000000, b'', 0x100),
+                    # PT_NOTE, not loaded
+                    (4, 0x20001000, b'note', 4),
+                    (1, 0x80400, b'\x22' * 4, 4)])
+    image = _flash(content)
+    assert [a for a, _ in image.pages()] == [0x80000, 0x80100, 0x80400]
+    assert bytes(image.page(0x80100)) == b'\x11' * 44 + b'\xff' * 212
+    assert bytes(image.page(0x80400))[:5] == b'\x22' * 4 + b'\xff'
+
+
+@pytest.mark.parametrize('end, phentsize', [
+    # The last program header cut short
+    (52 + 5 * 32 - 1, 32),
+    # Program headers too small to hold the fields read
+    (52 + 5 * 32, 16),
+])
+def test_elf_truncated(end, phentsize):
+    content = bytearray(_elf([(1, 0x80000, b'\x11' * 32, 32)] * 5))
+    struct.pack_into('<H', content, 42, phentsize)
+    with pytest.raises(ImageError):
+        _flash(bytes(content[:end]))
+    # Just the header, claiming five program headers
+    with pytest.raises(ImageError):
+        _flash(bytes(content[:52]))
+
+
+def test_format_from_name():
+    content = _ihex(0, 0x04, b'\x00\x08') + _ihex(0, 0x00, b'\x01')
+    image = _flash(content, 'app.HEX')
+    assert bytes(image.page(0x80000))[:2] == b'\x01\xff'
+    # Without a name, the same file is a raw binary
+    image = _flash(content)
+    assert bytes(image.page(0x80000))[:1] == b':'
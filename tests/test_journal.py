@@ -0,0 +1,62 @@
+import os
+
+from pysamloader.journal import WriteJournal
+
+
+def _journal(folder, uid='UID0', image='abc'):
+    return WriteJournal('/dev/ttyUSB0', uid, image, folder=str(folder))
+
+
+def test_resume_same_plan(tmpdir):
+    journal = _journal(tmpdir)
+    assert not journal.load('plan')
+    journal.start('plan')
+    journal.commit(10, 11)
+    journal.commit(12, 12)
+    journal.flush()
+
+    resumed = _journal(tmpdir)
+    assert resumed.load('plan')
+    assert (resumed.done, resumed.issued) == (12, 12)
+    assert not resumed.load('other plan')
+    assert not _journal(tmpdir, uid='UID1').load('plan')
+    assert not _journal(tmpdir, image='def').load('plan')
+
+
+def test_finish_and_discard(tmpdir):
+    journal = _journal(tmpdir)
+    journal.start('plan')
+    journal.commit(3, 4)
+    assert os.path.exists(journal.path)
+    journal.finish()
+    assert not os.path.exists(journal.path)
+    assert not _journal(tmpdir).load('plan')
+    # Nothing is saved once discarded, until started again
+    journal.commit(5, 6)
+    assert not os.path.exists(journal.path)
+    assert (journal.done, journal.issued) == (5, 6)
+
+
+def test_batched_saves(tmpdir):
+    journal = _journal(tmpdir)
+    journal.SAVE_INTERVAL = 60
+    journal.start('plan')
+    for issued in range(journal.SAVE_PAGES - 1):
+        journal.commit(issued, issued)
+    resumed = _journal(tmpdir)
+    assert resumed.load('plan') and resumed.issued == -1
+    journal.commit(journal.SAVE_PAGES - 1, journal.SAVE_PAGES - 1)
+    assert resumed.load('plan') and resumed.issued == journal.SAVE_PAGES - 1
+    journal.commit(40, 41)
+    assert resumed.load('plan') and resumed.issued == journal.SAVE_PAGES - 1
+    journal.flush()
+    assert resumed.load('plan') and (resumed.done, resumed.issued) == (40, 41)
+
+
+def test_unwritable_folder(tmpdir):
+    blocker = tmpdir.join('journals')
+    blocker.write('')
+    journal = _journal(blocker)
+    journal.start('plan')
+    journal.commit(1, 2)
+    assert not _journal(blocker).load('plan')
@@ -0,0 +1,51 @@
+
+
+from io import BytesIO
+
+from pysamloader.devices.ATSAM3U4E import ATSAM3U4E
+from pysamloader.devices.AT91SAM7X512 import AT91SAM7X512
+from pysamloader.samdevice import SAMDevice
+from pysamloader.pysamloader import _interleave
+from pysamloader.pysamloader import _split_planes
+from pysamloader.pysamloader import _plane_page_number
+from pysamloader.erase import plan_erase
+from pysamloader.image import load_image
+
+
+def test_planes():
+    planes = ATSAM3U4E.planes()
+    assert [p.FS_ADDRESS for p in planes] == ['00080000', '00100000']
+    assert [p.EFC_FCR for p in planes] == ['400E0804', '400E0A04']
+    assert all(p.WPC == '03' and p.PAGE_SIZE == 256 for p in planes)
+    assert len(SAMDevice.planes()) == 1
+
+
+def test_sam7x_planes():
+    planes = AT91SAM7X512.planes()
+    assert [p.EFC_FCR for p in planes] == ['FFFFFF64', 'FFFFFF74']
+    assert AT91SAM7X512.flash_regions() == [(0x100000, 0x140000),
+                                            (0x140000, 0x180000)]
+    # An image across both planes erases both, as the part needs
+    image = load_image(BytesIO(b'\x5a' * 512), AT91SAM7X512, 1023)
+    plan = plan_erase(planes, image, 0.005, 'page')
+    assert [p.EFC_FCR for p in plan.erase_all] == ['FFFFFF64', 'FFFFFF74']
+    assert _plane_page_number(planes[1], 0x140000) == 0
+
+
+def test_interleave():
+    planes = ATSAM3U4E.planes()
+    pages = [(0x80000 + 256 * i, b'a') for i in range(3)] + \
+            [(0x100000 + 256 * i, b'b') for i in range(2)]
+    order = [(planes.index(plane), address)
+             for plane, address, _ in _interleave(planes, pages)]
+    assert order == [(0, 0x80000), (1, 0x100000), (0, 0x80100),
+                     (1, 0x100100), (0, 0x80200)]
+
+
+def test_split_planes():
+    planes = ATSAM3U4E.planes()
+    runs = [(0x80000, b'x' * 512), (0xFFF00, b'y' * 512)]
+    split = [(planes.index(plane), address, len(data))
+             for plane, address, data in _split_planes(planes, runs)]
+    assert split == [(0, 0x80000, 512), (0, 0xFFF00, 256),
+                     (1, 0x100000, 256)]
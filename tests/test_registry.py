@@ -0,0 +1,105 @@
+
+
+import os
+import time
+
+import pytest
+
+from pysamloader.chipid import SamChipID
+from pysamloader.registry import DeviceRegistry
+from pysamloader.registry import SupportedDevices
+from pysamloader.registry import UnknownDeviceError
+
+
+_DEVICE = """
+from pysamloader.samdevice import SAMDevice
+
+
+class {0}(SAMDevice):
+    CHIPID_ARCH = 'SAM3UxE'
+    CHIPID_NVPSIZ = '{1}'
+    PAGE_SIZE = 256
+"""
+
+
+@pytest.fixture
+def folder(tmpdir):
+    devices = tmpdir.mkdir('devices')
+    for name, nvpsiz in (('DEV1', '128K'), ('DEV2', '256K')):
+        devices.join(name + '.py').write(_DEVICE.format(name, nvpsiz))
+    devices.join('notadevice.py').write("x = 1\n")
+    devices.join('_private.py').write("raise RuntimeError\n")
+    return devices
+
+
+def test_lazy_index(folder, tmpdir):
+    index = str(tmpdir.join('index.json'))
+    registry = DeviceRegistry(str(folder), index)
+    assert registry.names() == ['DEV1', 'DEV2']
+    assert os.path.exists(index)
+
+    # A fresh process reads the names from the index, loading nothing
+    registry = DeviceRegistry(str(folder), index)
+    assert list(SupportedDevices(registry)) == [('DEV1', 'SAM-BA UART'),
+                                                ('DEV2', 'SAM-BA UART')]
+    assert registry._devices == {}
+    device = registry.get('DEV2')
+    assert device.__name__ == 'DEV2'
+    assert registry.get('DEV2') is device
+    with pytest.raises(ImportError):
+        registry.get('notadevice')
+    with pytest.raises(ImportError):
+        registry.get('DEV3')
+
+
+def test_index_invalidated(folder, tmpdir):
+    index = str(tmpdir.join('index.json'))
+    assert DeviceRegistry(str(folder), index).names() == ['DEV1', 'DEV2']
+
+    folder.join('DEV3.py').write(_DEVICE.format('DEV3', '512K'))
+    folder.join('DEV1.py').remove()
+    mtime = time.time() + 10
+    os.utime(str(folder.join('DEV2.py')), (mtime, mtime))
+    registry = DeviceRegistry(str(folder), index)
+    assert registry.names() == ['DEV2', 'DEV3']
+    # Only the changed and new modules are loaded to rebuild the index
+    assert sorted(registry._devices) == ['DEV2', 'DEV3']
+
+
+def test_unwritable_index(folder, tmpdir):
+    index = str(tmpdir.join('missing', 'index.json'))
+    tmpdir.join('missing').write('')
+    assert DeviceRegistry(str(folder), index).names() == ['DEV1', 'DEV2']
+
+
+def test_find(folder, tmpdir):
+    index = str(tmpdir.join('index.json'))
+    DeviceRegistry(str(folder), index).names()
+    registry = DeviceRegistry(str(folder), index)
+    device = registry.find(SamChipID('0x28100960', '0x00000000'))
+    assert device.__name__ == 'DEV2'
+    assert list(registry._devices) == ['DEV2']
+    with pytest.raises(UnknownDeviceError):
+        registry.find(SamChipID('0x28100a60', '0x00000000'))
+
+
+def test_geometry(folder, tmpdir):
+    index = str(tmpdir.join('index.json'))
+    cache = str(tmpdir.join('geometry.json'))
+    chipid = SamChipID('0x28100960', '0x00000000')
+    geometry = {'size': 0x20000, 'page_size': 512, 'planes': [0x20000],
+                'locks': [0x2000] * 16}
+    registry = DeviceRegistry(str(folder), index, cache)
+    assert registry.geometry(chipid) is None
+    registry.save_geometry(chipid, geometry)
+
+    registry = DeviceRegistry(str(folder), index, cache)
+    assert registry.geometry(chipid) == geometry
+    device = registry.get('DEV2')
+    detected = registry.with_geometry(device, registry.geometry(chipid))
+    assert registry.with_geometry(device, geometry) is detected
+    assert issubclass(detected, device)
+    assert detected.__name__ == 'DEV2'
+    assert detected.PAGE_SIZE == 512
+    assert detected.LOCK_REGIONS == [0x2000] * 16
+    assert device.PAGE_SIZE == 256
@@ -0,0 +1,232 @@
+import json
+from io import BytesIO
+
+import pytest
+
+from pysamloader import pysamloader
+from pysamloader.samba import SamBAConnection
+from pysamloader.samba import SamBAConnectionError
+from pysamloader.samba import SamBAResponseBuffer
+from pysamloader.samba import SamBAWriteEncoder
+from pysamloader.journal import WriteJournal
+from pysamloader.stats import ConnectionStats
+from pysamloader.devices.ATSAM3U4E import ATSAM3U4E
+
+
+@pytest.fixture
+def journals(tmpdir, monkeypatch):
+    """ Keep write journals in tmpdir """
+    def _open_journal(samba, device, image):
+        return WriteJournal(None, None, image.digest(), folder=str(tmpdir))
+    monkeypatch.setattr(pysamloader, '_open_journal', _open_journal)
+    return tmpdir
+
+
+def test_response_buffer():
+    rx = SamBAResponseBuffer()
+    rx.feed(b'\n\r0x12')
+    assert rx.pop_response() is None
+    # A prompt split from its response, and the start of the next one
+    rx.feed(b'345678\n\r')
+    assert rx.pop_response() is None
+    rx.feed(b'>\n\rv1.1>\n')
+    assert rx.pop_response() == b'\n\r0x12345678\n\r'
+    assert rx.pop_response() == b'\n\rv1.1'
+    assert rx.pop_response() is None
+    assert len(rx) == 1
+    rx.feed(b'\r>abc')
+    assert rx.pop_response() == b'\n\r'
+    assert rx.take(2) == b'ab' and rx.take(4) == b'c'
+    rx.feed(b'xyz')
+    rx.clear()
+    assert len(rx) == 0 and rx.pop_response() is None
+
+
+@pytest.mark.parametrize('terminal', [False, True])
+def test_queue_window(samba_url, terminal):
+    samba = SamBAConnection(samba_url, device=ATSAM3U4E, window=3,
+                            terminal=terminal)
+    responses = []
+    peak = 0
+    try:
+        with samba.command_queue() as queue:
+            for i in range(8):
+                address = '{0:08x}'.format(0x20001000 + 4 * i)
+                queue.write_word(address, '{0:08x}'.format(i))
+                peak = max(peak, len(queue._inflight))
+                queue.read_word(address, callback=responses.append)
+                peak = max(peak, len(queue._inflight))
+        assert peak == 3
+        assert [r.strip() for r in responses] == \
+            ['0x{0:08x}'.format(i) for i in range(8)]
+    finally:
+        samba.close()
+    for window in (0, -1):
+        with pytest.raises(ValueError):
+            samba.command_queue(window=window)
+
+
+def test_write_encoder():
+    encoder = SamBAWriteEncoder()
+    data, count = encoder.encode(0x20001000, b'\x01\x02\x03\x04\x05')
+    assert count == 2
+    assert data == b'W20001000,04030201#W20001004,00000005#'
+    assert len(data) == count * SamBAWriteEncoder.COMMAND_SIZE
+    # The format built for two words is reused
+    assert encoder.encode(0x80, b'\xff' * 8) == \
+        (b'W00000080,ffffffff#W00000084,ffffffff#', 2)
+
+
+@pytest.mark.parametrize('terminal', [False, True])
+def test_submit_encoded(samba_url, terminal):
+    samba = SamBAConnection(samba_url, device=ATSAM3U4E, window=4,
+                            terminal=terminal)
+    data = bytes(bytearray(range(40)))
+    responses = []
+    try:
+        with samba.command_queue() as queue:
+            command = queue.write_block(0x20002000, data,
+                                        callback=responses.append)
+            assert len(queue._inflight) <= 4
+        assert command.response is not None
+        if terminal:
+            # One callback for each command written
+            assert len(responses) == 10
+        words = [samba.read_word('{0:08x}'.format(0x20002000 + i)).strip()
+                 for i in range(0, 40, 4)]
+        assert words == ['0x{0:02x}{1:02x}{2:02x}{3:02x}'.format(
+            i + 3, i + 2, i + 1, i) for i in range(0, 40, 4)]
+    finally:
+        samba.close()
+
+
+@pytest.mark.parametrize('terminal', [False, True])
+def test_read_values(target, terminal):
+    samba = SamBAConnection(target.port, device=ATSAM3U4E,
+                            terminal=terminal)
+    try:
+        assert samba.terminal == terminal
+        samba.write_word('20001000', '89abcdef')
+        samba.write_hword('20001004', '1234')
+        samba.write_byte('20001006', '56')
+        # Values read in binary mode are formatted as SAM-BA prints them
+        assert samba.read_byte('20001000') == '0xef'
+        assert samba.read_byte('20001003') == '0x89'
+        assert samba.read_hword('20001002') == '0x89ab'
+        assert samba.read_word('20001000').strip() == '0x89abcdef'
+        assert samba.read_word('20001004').strip() == '0x00561234'
+    finally:
+        samba.close()
+
+
+def test_set_baud(target):
+    samba = SamBAConnection(target.port, device=ATSAM3U4E)
+    try:
+        assert samba.set_baud(230400)
+        assert samba.ser.baudrate == 230400 and not samba.terminal
+        assert int(samba.read_word(ATSAM3U4E.UART_BRGR), 16) == 13
+    finally:
+        samba.close()
+
+
+def test_set_baud_recovery(target):
+    samba = SamBAConnection(target.port, device=ATSAM3U4E)
+    fast_connect = samba.fast_connect
+    failures = [True]
+
+    def failing_fast_connect():
+        # Nothing is heard at the new rate, but SAM-BA answers at the old
+        if failures:
+            return not failures.pop()
+        return fast_connect()
+
+    samba.fast_connect = failing_fast_connect
+    try:
+        assert samba.set_baud(230400) is False
+        assert samba.ser.baudrate == 115200 and not samba.terminal
+        assert int(samba.read_word(ATSAM3U4E.UART_BRGR), 16) == 26
+    finally:
+        samba.close()
+
+
+def test_set_baud_lost(target):
+    samba = SamBAConnection(target.port, device=ATSAM3U4E)
+    samba.fast_connect = lambda: False
+    try:
+        with pytest.raises(SamBAConnectionError):
+            samba.set_baud(230400)
+        assert not samba.ser.is_open
+    finally:
+        samba.close()
+
+
+def test_stats_histogram():
+    stats = ConnectionStats()
+    stats.sent('w', 12, count=2)
+    stats.received('w', 4, 0.0005)
+    stats.received('w', 4, 2.0)
+    stats.sent('W', 19)
+    stats.received('W', 0)
+    w = stats.as_dict()['commands']['w']
+    assert (w['count'], w['tx_bytes'], w['rx_bytes']) == (2, 12, 8)
+    assert w['latency_max'] == 2.0
+    assert w['latency_histogram']['<1ms'] == 1
+    assert w['latency_histogram']['>1s'] == 1
+    assert stats.tx_bytes == 31 and stats.rx_bytes == 8
+    assert stats.commands['W'].responses == 0
+
+
+def test_connection_stats(target):
+    samba = SamBAConnection(target.port, device=ATSAM3U4E, stats=True)
+    try:
+        samba.write_word('20001000', '00000001')
+        samba.write_word('20001004', '00000002')
+        for i in range(3):
+            samba.read_word('{0:08x}'.format(0x20001000 + 4 * i))
+        samba.efc_wready()
+        stats = samba.stats
+        # Writes get no response in binary mode
+        assert stats.commands['W'].count == 2
+        assert stats.commands['W'].responses == 0
+        reads = stats.commands['w']
+        assert reads.count == 4 and reads.responses == 4
+        assert reads.rx_bytes == 16
+        assert stats.efc_waits == 1 and stats.efc_polls == 1
+        assert 'EFC : 1 waits' in stats.summary()
+        json.dumps(stats.as_dict())
+    finally:
+        samba.close()
+
+
+def test_stats_timeout(samba_url):
+    samba = SamBAConnection(samba_url, device=ATSAM3U4E, stats=True)
+    samba.RESPONSE_LATENCY = 0.05
+    try:
+        with pytest.raises(SamBAConnectionError):
+            samba.read_word('20003008')
+        assert samba.stats.timeouts == 1
+    finally:
+        samba.close()
+
+
+@pytest.mark.parametrize('terminal', [False, True])
+def test_getuid(target, terminal):
+    samba = SamBAConnection(target.port, device=ATSAM3U4E,
+                            terminal=terminal)
+    try:
+        assert samba.efc_getuid() == '03020100070605040b0a09080f0e0d0c'
+        # The EFC is out of UID mode again
+        assert samba.read_word('00080000').strip() == '0xffffffff'
+    finally:
+        samba.close()
+
+
+def test_xmodem_write(target, journals):
+    data = bytes(bytearray(range(256))) * 3 + b'\x5a' * 100
+    samba = SamBAConnection(target.port, device=ATSAM3U4E)
+    try:
+        pysamloader.write(samba, ATSAM3U4E, BytesIO(data), xmodem=True)
+        assert pysamloader.verify(samba, ATSAM3U4E, BytesIO(data),
+                                  bulk=False) == 0
+    finally:
+        samba.close()
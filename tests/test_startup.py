@@ -0,0 +1,86 @@
+
+
+import sys
+import subprocess
+
+import pytest
+
+
+# Dependencies which only the commands talking to a device need
+HEAVY = ['serial', 'bitstring', 'progress', 'colorama', 'six', 'xmodem',
+         'appdirs', 'pkg_resources', 'pysamloader.samba',
+         'pysamloader.pysamloader']
+
+ALLOWED = {
+    '--help': [],
+    '-V': [],
+    '--lp': ['serial'],
+    '--ld': ['appdirs'],
+}
+
+# Import time, in microseconds, of pysamloader's own modules and what
+# they import, well above what a cold start costs on a slow machine.
+IMPORT_BUDGET = 150000
+
+# Runs the CLI with the arguments given, and prints the modules it left
+# loaded, whether it returned or exited.
+_RUNNER = """
+import sys
+from pysamloader import cli
+sys.argv = ['pysamloader'] + sys.argv[1:]
+try:
+    cli.main()
+except SystemExit:
+    pass
+sys.stderr.write(' '.join(sorted(sys.modules)))
+"""
+
+
+def _run(args, options=()):
+    process = subprocess.Popen(
+        [sys.executable] + list(options) + ['-c', _RUNNER] + list(args),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, stderr = process.communicate()
+    assert process.returncode == 0, stderr
+    return stderr.decode()
+
+
+def _loaded_modules(*args):
+    """ The modules loaded by the CLI run with args """
+    return set(_run(args).splitlines()[-1].split())
+
+
+def _import_time(*args):
+    """
+    The cumulative import time, in microseconds, of the pysamloader
+    modules imported at the top level by the CLI run with args. Modules
+    they import are included in their time, and not counted again.
+    """
+    total = 0
+    for line in _run(args, ['-X', 'importtime']).splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if name.startswith(' pysamloader'):
+            total += int(cumulative)
+    return total
+
+
+@pytest.mark.parametrize('command', sorted(ALLOWED))
+def test_cold_start(command):
+    modules = _loaded_modules(command)
+    for name in HEAVY:
+        if name in ALLOWED[command]:
+            continue
+        assert name not in modules, \
+            "{0} imported by {1}".format(name, command)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason="-X importtime needs Python 3.7")
+@pytest.mark.parametrize('command', sorted(ALLOWED))
+def test_import_time(command):
+    # The best of a few runs, so that a busy machine does not fail it
+    elapsed = min(_import_time(command) for _ in range(3))
+    assert elapsed < IMPORT_BUDGET, \
+        "{0} spent {1} ms importing".format(command, elapsed // 1000)
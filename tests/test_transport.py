@@ -0,0 +1,63 @@
+
+
+import socket
+
+import pytest
+from serial import serial_for_url
+
+from pysamloader.samba import SamBAConnection
+from pysamloader.samba import SamBAConnectionError
+from pysamloader.devices.ATSAM3U4E import ATSAM3U4E
+
+
+@pytest.mark.parametrize('terminal', [False, True])
+def test_socket_url(samba_url, terminal):
+    samba = SamBAConnection(samba_url, device=ATSAM3U4E, terminal=terminal)
+    try:
+        assert samba.version == 'v1.1 Dec 15 2010 19:25:04'
+        assert samba.terminal == terminal
+        samba.write_word('20001000', 'deadbeef')
+        assert samba.read_word('20001000').strip() == '0xdeadbeef'
+        nodelay = samba.ser._socket.getsockopt(socket.IPPROTO_TCP,
+                                               socket.TCP_NODELAY)
+        assert nodelay
+    finally:
+        samba.close()
+
+
+def test_socket_fixed_baud(samba_url):
+    samba = SamBAConnection(samba_url, device=ATSAM3U4E, link_baud=230400)
+    try:
+        assert samba.ser.baudrate == 115200
+        assert samba.set_baud(500000) is False
+        assert samba.read_word('20001000').strip() == '0x00000000'
+    finally:
+        samba.close()
+
+
+def test_transport_object(samba_url):
+    transport = serial_for_url(samba_url, baudrate=115200)
+    samba = SamBAConnection(transport, device=ATSAM3U4E)
+    try:
+        assert samba.ser is transport
+        with samba.command_queue() as queue:
+            queue.write_block(0x20002000, b'\x01\x02\x03\x04\x05\x06\x07\x08')
+            command = queue.read_word('20002004')
+        assert command.response == '0x08070605'
+    finally:
+        samba.close()
+
+
+@pytest.mark.parametrize('terminal', [False, True])
+def test_queue_timeout(samba_url, terminal):
+    samba = SamBAConnection(samba_url, device=ATSAM3U4E, window=2,
+                            terminal=terminal)
+    samba.RESPONSE_LATENCY = 0.05
+    try:
+        with pytest.raises(SamBAConnectionError):
+            with samba.command_queue() as queue:
+                for i in range(5):
+                    queue.read_word('{0:08x}'.format(0x20003000 + 4 * i))
+        assert not samba.ser.is_open
+    finally:
+        samba.close()